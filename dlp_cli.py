@@ -0,0 +1,266 @@
+"""
+Headless DLP generator.
+
+Reads lesson inputs from a JSON or CSV file and writes one DOCX per lesson,
+without the Streamlit UI.
+
+    python dlp_cli.py lessons.csv --out-dir out --jobs 4
+
+JSON files hold one object or a list of objects. CSV files need a header row.
+Keys/columns: subject, grade, quarter, content_std, perf_std, competency and
+optionally obj_cognitive, obj_psychomotor, obj_affective, lesson_topic,
+teacher_name, principal_name, school, image (path) and output (file name).
+
+--school picks the school (an id from schools/schools.json) for lessons that
+don't name one. It sets the document header, positions, default signatories and
+the school named in the prompt.
+
+With --plan the input is one quarter: a JSON object with subject, grade,
+quarter, content_std, perf_std and a "competencies" list. The lessons are
+generated as one coherent sequence (see lesson_plan_app.plan_quarter).
+
+With --dual-language every lesson is also translated into the other language
+(English <-> Filipino) and written twice, with _EN and _FIL added to the name.
+
+With --handouts each lesson also gets its student handouts, made from the same
+content without more AI calls: quiz sheets (Sets A and B), the answer key and
+group activity cards, with _Quiz, _AnswerKey and _GroupCards added to the name.
+
+With --zip NAME the documents go into one ZIP archive in --out-dir instead of
+separate files. Each document is added as soon as it is rendered, so memory use
+stays flat however many lessons there are.
+
+The API key comes from --api-key or the GEMINI_API_KEY / GOOGLE_API_KEY
+environment variables.
+"""
+import argparse
+import csv
+import json
+import os
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+
+import lesson_plan_app as app
+
+REQUIRED_FIELDS = ('subject', 'grade', 'quarter', 'content_std', 'perf_std', 'competency')
+
+_print_lock = threading.Lock()
+
+
+def log(message):
+    with _print_lock:
+        print(message, file=sys.stderr, flush=True)
+
+
+def load_lessons(path):
+    """Load a list of lesson dicts from a .json or .csv file"""
+    if path.lower().endswith('.csv'):
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            return [dict(row) for row in csv.DictReader(f)]
+
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return data if isinstance(data, list) else [data]
+
+
+def default_file_name(lesson):
+    name = f"DLP_{lesson.get('subject')}_{lesson.get('grade')}_Q{lesson.get('quarter')}_{date.today()}"
+    return re.sub(r'[^A-Za-z0-9_.\-]+', '_', name) + ".docx"
+
+
+_archive_lock = threading.Lock()
+
+
+def write_output(args, archive, file_name, docx_bytes):
+    """Write one document to --out-dir, or into the ZIP archive when there is one"""
+    if archive is not None:
+        with _archive_lock:
+            name = app.add_to_bulk_archive(archive, file_name, docx_bytes)
+        return f"{args.zip}:{name}"
+    out_path = os.path.join(args.out_dir, file_name)
+    with open(out_path, 'wb') as f:
+        f.write(docx_bytes)
+    return out_path
+
+
+def open_archive(args):
+    return app.open_bulk_archive() if args.zip else None
+
+
+def close_archive(args, archive):
+    if archive is not None:
+        path = app.close_bulk_archive(archive, os.path.join(args.out_dir, args.zip))
+        log(f"wrote {path}")
+
+
+def build_one(number, lesson, args, archive=None):
+    """Generate and render a single lesson. Returns (output path or None, error count)"""
+    missing = [field for field in REQUIRED_FIELDS if not str(lesson.get(field) or '').strip()]
+    if missing:
+        log(f"[{number}] skipped: missing {', '.join(missing)}")
+        return None, 1
+
+    errors = []
+
+    def on_progress(message, level="info"):
+        if args.verbose:
+            log(f"[{number}] {message}")
+
+    def on_error(message):
+        errors.append(message)
+        log(f"[{number}] ERROR {message}")
+
+    generate = app.generate_dual_language_plans if args.dual_language else app.generate_lesson_plan
+    ai_data = generate(
+        lesson, args.api_key, on_progress=on_progress, on_error=on_error, hedge=args.hedge
+    )
+    if ai_data is None:
+        return None, len(errors) or 1
+
+    image = None
+    if lesson.get('image'):
+        with open(lesson['image'], 'rb') as f:
+            image = f.read()
+
+    handouts = {}
+    if args.handouts:
+        primary = next(iter(ai_data.values())) if args.dual_language else ai_data
+        handouts = app.start_lesson_handouts(lesson, primary)
+
+    school = app.get_school_config(lesson['school'])
+    teacher = lesson.get('teacher_name') or args.teacher or school['teacher_name']
+    principal = lesson.get('principal_name') or args.principal or school['principal_name']
+    if args.dual_language:
+        documents = app.render_dual_language_plans(lesson, ai_data, teacher, principal, image)
+        outputs = {
+            lesson['output'][:-len('.docx')] + f"_{app.LANGUAGE_FILE_SUFFIXES[language]}.docx": docx_bytes
+            for language, docx_bytes in documents.items()
+        }
+    else:
+        outputs = {lesson['output']: app.render_lesson_plan(lesson, ai_data, teacher, principal, image)}
+    for kind, future in handouts.items():
+        outputs[lesson['output'][:-len('.docx')] + f"_{app.HANDOUT_FILE_SUFFIXES[kind]}.docx"] = future.result()
+
+    for file_name, docx_bytes in outputs.items():
+        out_path = write_output(args, archive, file_name, docx_bytes)
+        log(f"[{number}] wrote {out_path}" + (" (with errors, check content)" if errors else ""))
+    return out_path, len(errors)
+
+
+def run_quarter_plan(args):
+    """Generate every lesson of one quarter as a connected sequence"""
+    with open(args.input, 'r', encoding='utf-8') as f:
+        plan = json.load(f)
+    plan['school'] = plan.get('school') or args.school
+
+    def on_progress(message, level="info"):
+        if args.verbose:
+            log(message)
+
+    errors = []
+
+    def on_error(message):
+        errors.append(message)
+        log(f"ERROR {message}")
+
+    def on_lesson(index, lesson_inputs, ai_data):
+        log(f"[{index + 1}] generated: {ai_data.get('topic', '')}")
+
+    results = app.plan_quarter(
+        plan, plan.get('competencies', []), args.api_key,
+        on_progress=on_progress, on_error=on_error, on_lesson=on_lesson, max_workers=args.jobs
+    )
+    if not results:
+        return 1
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    archive = open_archive(args)
+    school = app.get_school_config(plan['school'])
+    for number, (lesson_inputs, ai_data) in enumerate(results, 1):
+        handouts = app.start_lesson_handouts(lesson_inputs, ai_data) if args.handouts else {}
+        docx_bytes = app.render_lesson_plan(
+            lesson_inputs, ai_data,
+            plan.get('teacher_name') or args.teacher or school['teacher_name'],
+            plan.get('principal_name') or args.principal or school['principal_name']
+        )
+        file_name = default_file_name(lesson_inputs)[:-len('.docx')] + f"_L{number}.docx"
+        log(f"[{number}] wrote {write_output(args, archive, file_name, docx_bytes)}")
+        for kind, future in handouts.items():
+            handout_name = file_name[:-len('.docx')] + f"_{app.HANDOUT_FILE_SUFFIXES[kind]}.docx"
+            log(f"[{number}] wrote {write_output(args, archive, handout_name, future.result())}")
+    close_archive(args, archive)
+
+    return 1 if errors else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate DLP .docx files without the Streamlit UI")
+    parser.add_argument('input', help="JSON or CSV file with lesson inputs")
+    parser.add_argument('--out-dir', default='.', help="Folder for the generated .docx files")
+    parser.add_argument('--jobs', '-j', type=int, default=1, help="Number of lessons generated in parallel")
+    parser.add_argument('--api-key', default=os.environ.get('GEMINI_API_KEY') or os.environ.get('GOOGLE_API_KEY'))
+    parser.add_argument('--school', help="School id from schools/schools.json (default: the file's default)")
+    parser.add_argument('--teacher', help="Default teacher name (default: the school's)")
+    parser.add_argument('--principal', help="Default principal name (default: the school's)")
+    parser.add_argument('--hedge', action='store_true', help="Race a second model when the first is slow")
+    parser.add_argument('--plan', action='store_true', help="Input is one quarter with a competencies list")
+    parser.add_argument('--dual-language', action='store_true',
+                        help="Also write each lesson translated into the other language (English/Filipino)")
+    parser.add_argument('--handouts', action='store_true',
+                        help="Also write quiz sheets, an answer key and group activity cards per lesson")
+    parser.add_argument('--zip', metavar='NAME', help="Write all documents into one ZIP file in --out-dir")
+    parser.add_argument('--verbose', '-v', action='store_true', help="Show progress messages")
+    args = parser.parse_args(argv)
+
+    if not args.api_key:
+        parser.error("no API key: use --api-key or set GEMINI_API_KEY")
+    if args.zip and not args.zip.lower().endswith('.zip'):
+        args.zip += '.zip'
+    if args.school and args.school not in app.load_schools():
+        parser.error(f"unknown school {args.school!r}: choose from {', '.join(app.load_schools())}")
+    args.school = app.get_school_config(args.school)['id']
+
+    if args.plan and args.dual_language:
+        parser.error("--dual-language is not available with --plan")
+    if args.plan:
+        return run_quarter_plan(args)
+
+    lessons = load_lessons(args.input)
+    os.makedirs(args.out_dir, exist_ok=True)
+    for lesson in lessons:
+        lesson['school'] = lesson.get('school') or args.school
+
+    # Name files up front so parallel jobs for the same subject/grade/quarter don't collide
+    used_names = set()
+    for number, lesson in enumerate(lessons, 1):
+        name = lesson.get('output') or default_file_name(lesson)
+        if name in used_names:
+            name = name[:-len('.docx')] + f"_{number}.docx"
+        used_names.add(name)
+        lesson['output'] = name
+
+    failed = 0
+    archive = open_archive(args)
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        futures = [executor.submit(build_one, n, lesson, args, archive) for n, lesson in enumerate(lessons, 1)]
+        for future in as_completed(futures):
+            try:
+                out_path, error_count = future.result()
+            except Exception as e:
+                log(f"ERROR {e}")
+                out_path, error_count = None, 1
+            if out_path is None or error_count:
+                failed += 1
+    close_archive(args, archive)
+
+    log(f"Done: {len(lessons) - failed} of {len(lessons)} lessons generated cleanly")
+    if args.hedge:
+        log(f"Hedging: {app.get_hedge_stats()}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
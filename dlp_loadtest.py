@@ -0,0 +1,455 @@
+"""
+Load test for the Streamlit app.
+
+Starts local stub servers for the Gemini REST API and the image service, then
+drives N simulated teachers through lesson_plan_app.py with Streamlit's AppTest.
+Every teacher runs in its own thread, with its own session and its own API key.
+
+    python dlp_loadtest.py --sessions 40 --concurrency 10 --latency 1.5 --error-rate 0.05
+
+The app is pointed at the stubs with DLP_GEMINI_ENDPOINT and DLP_IMAGE_ENDPOINT.
+Profiles and history go to a temporary DLP_DATA_DIR.
+
+The report shows:
+- throughput and latency percentiles for "Generate DLP";
+- memory per concurrent session (peak traced allocations) and the size of one
+  session's state;
+- correctness problems: script exceptions, a missing download button (two
+  with --dual-language), and
+  lessons generated with another session's API key or for another session's
+  subject (cross-session leakage).
+
+With --hedge every lesson is hedged after --hedge-after seconds, and the stub
+holds back answers from the first model in MODEL_OPTIONS by --primary-delay, so
+the backup model (created seconds after the first one, while other teachers are
+starting their own requests) wins. A model that picks up its API key late would
+show up as key leakage here.
+
+With --same-lesson every teacher generates the same lesson, like a grade-level
+team during a LAC session. Identical requests in flight share one generation
+(request coalescing), so the stub sees far fewer lesson prompts than there are
+teachers, and a lesson made with a teammate's key is expected.
+
+Lessons that fell back to placeholder text because of injected errors are
+counted separately. They are expected degradation, not correctness problems.
+"""
+import argparse
+import io
+import json
+import os
+import pickle
+import random
+import re
+import secrets
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+APP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lesson_plan_app.py")
+GENERATE_BUTTON = "🚀 Generate DLP"
+MARKER_PATTERN = re.compile(r'\[key=([^\]]*)\]\[subject=([^\]]*)\]')
+
+_print_lock = threading.Lock()
+
+
+def log(message):
+    with _print_lock:
+        print(message, file=sys.stderr, flush=True)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+# --- Stub servers ---
+class StubStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.lessons = 0
+        self.keys = set()
+
+    def count(self, key=None, error=False, lesson=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += error
+            self.lessons += lesson
+            if key:
+                self.keys.add(key)
+
+
+def _stub_delay(mean):
+    # Skewed like real model latency: most requests near the mean, some much slower
+    return random.lognormvariate(0, 0.5) * mean if mean > 0 else 0
+
+
+def make_gemini_handler(args, stats, app):
+    """Gemini REST API stub: answers generateContent / streamGenerateContent"""
+
+    def lesson_json(prompt, key):
+        subject = re.search(r'Subject:\s*([^,\n]*)', prompt)
+        subject = subject.group(1).strip() if subject else ''
+        data = app.create_fallback_data(subject, 'Grade 7', 'I', 'x', 'y', 'z')
+        # The marker lets the harness see which key and which subject produced the lesson
+        data['topic'] = f"Stub lesson [key={key}][subject={subject}]"
+        return json.dumps(data)
+
+    class GeminiHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+            key = self.headers.get('x-goog-api-key') or parse_qs(urlparse(self.path).query).get('key', [''])[0]
+
+            if random.random() < args.error_rate:
+                stats.count(key, error=True)
+                time.sleep(_stub_delay(args.latency) / 4)
+                self._send_json(503, {'error': {'code': 503, 'message': 'stub overloaded', 'status': 'UNAVAILABLE'}})
+                return
+            prompt = "\n".join(
+                part.get('text', '')
+                for content in body.get('contents', []) for part in content.get('parts', [])
+            )
+            if prompt.strip() == "Hello":
+                stats.count(key)
+                text = "Hello"
+            elif prompt.startswith("Translate"):
+                stats.count(key)
+                # Translation calls get their JSON back unchanged
+                text = prompt[prompt.index("\n{") + 1:]
+            else:
+                stats.count(key, lesson=True)
+                text = lesson_json(prompt, key)
+
+            def candidate(piece, last=True):
+                response = {'candidates': [{'content': {'parts': [{'text': piece}], 'role': 'model'}, 'finishReason': 'STOP'}]}
+                if last:
+                    response['usageMetadata'] = {
+                        'promptTokenCount': len(prompt) // 4, 'candidatesTokenCount': len(text) // 4,
+                        'totalTokenCount': (len(prompt) + len(text)) // 4,
+                    }
+                return response
+
+            delay = _stub_delay(args.latency)
+            if args.hedge and f"/models/{app.MODEL_OPTIONS[0]}:" in self.path and prompt.strip() != "Hello":
+                delay += args.primary_delay
+            if ':streamGenerateContent' not in self.path:
+                time.sleep(delay)
+                self._send_json(200, candidate(text))
+                return
+
+            # Streamed as server-sent events (?alt=sse), which is what the client reads
+            time.sleep(delay * 0.3)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            size = max(1, len(text) // args.stream_chunks + 1)
+            pieces = [text[i:i + size] for i in range(0, len(text), size)]
+            try:
+                for n, piece in enumerate(pieces):
+                    data = f"data: {json.dumps(candidate(piece, n == len(pieces) - 1))}\r\n\r\n".encode('utf-8')
+                    self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+                    self.wfile.flush()
+                    time.sleep(delay * 0.7 / len(pieces))
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass   # The app closed a losing hedged stream
+
+    return GeminiHandler
+
+
+def make_image_handler(args, stats):
+    """Image service stub: GET /prompt/<keywords> returns a small PNG"""
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (600, 350), (200, 220, 240)).save(buffer, 'PNG')
+    png = buffer.getvalue()
+
+    class ImageHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(_stub_delay(args.image_latency))
+            if random.random() < args.image_error_rate:
+                stats.count(error=True)
+                self.send_error(503)
+                return
+            stats.count()
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(png)))
+            self.end_headers()
+            self.wfile.write(png)
+
+    return ImageHandler
+
+
+def start_server(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# --- Simulated teachers ---
+def share_apptest_globals():
+    """
+    AppTest is built for one run at a time: each run installs a mock Runtime
+    singleton and clears it when done, flips the global.appTest option, and
+    compiles the script with a fresh cache. With many sessions in threads, one
+    run finishing would pull the Runtime out from under the others, and parallel
+    compiles trip a CPython 3.11 parser bug. Keep the last mock Runtime visible,
+    the option set, and compile the script once, like the real server does.
+    """
+    from streamlit import config
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+
+    compile_lock = threading.Lock()
+    bytecode_cache = {}
+    get_bytecode = ScriptCache.get_bytecode
+
+    def shared_bytecode(self, script_path):
+        with compile_lock:
+            if script_path not in bytecode_cache:
+                bytecode_cache[script_path] = get_bytecode(self, script_path)
+            return bytecode_cache[script_path]
+
+    ScriptCache.get_bytecode = shared_bytecode
+
+    config.get_config_options()
+    config._set_option("global.appTest", True, "dlp_loadtest")
+    shared = {}
+    lock = threading.Lock()
+
+    def current(cls):
+        with lock:
+            if cls._instance is not None:
+                shared['runtime'] = cls._instance
+            return shared.get('runtime')
+
+    def instance(cls):
+        runtime = current(cls)
+        if runtime is None:
+            raise RuntimeError("Runtime hasn't been created!")
+        return runtime
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: current(cls) is not None)
+
+
+def _session_state_bytes(at):
+    """Approximate size of one session's state (picklable values only)"""
+    total = 0
+    for value in at.session_state.values():
+        try:
+            total += len(pickle.dumps(value))
+        except Exception:
+            continue
+    return total
+
+
+def _find(elements, label, at):
+    for element in elements:
+        if element.label == label:
+            return element
+    raise LookupError(f"{label!r} not on the page (exceptions: {[e.message for e in at.exception]}, "
+                      f"{len(at.main)} main elements: {[type(e).__name__ for e in at.main][:8]})")
+
+
+def run_session(number, args):
+    """One teacher: open the app, fill the form, generate. Returns a result dict."""
+    from streamlit.testing.v1 import AppTest
+
+    api_key = f"load-{number}-{secrets.token_hex(4)}"
+    subject = "SubjectLAC" if args.same_lesson else f"Subject{number}"
+    result = {'number': number, 'latency': None, 'problems': [], 'fallback': False, 'state_bytes': 0}
+
+    try:
+        at = AppTest.from_file(APP_FILE, default_timeout=args.timeout)
+        at.session_state['api_key'] = api_key
+        at.session_state['saved_api_key'] = api_key
+        at.session_state['hedge_requests'] = args.hedge
+        at.session_state['dual_language'] = args.dual_language
+        at.run()
+
+        _find(at.text_input, "Subject Area", at).set_value(subject)
+        at.text_area(key="content_std").set_value("The learner demonstrates understanding of key concepts.")
+        at.text_area(key="perf_std").set_value("The learner is able to apply the concepts.")
+        at.text_area(key="competency").set_value(f"Competency for {subject}")
+        at.run()
+
+        start = time.perf_counter()
+        _find(at.button, GENERATE_BUTTON, at).click()
+        at.run()
+        result['latency'] = time.perf_counter() - start
+    except Exception as e:
+        result['problems'].append(f"harness error: {e!r}")
+        return result
+
+    if len(at.exception):
+        result['problems'].append(f"script exception: {at.exception[0].message}")
+        return result
+
+    history = at.session_state.get('generation_history') or {}
+    runs = [run for runs in history.values() for run in runs]
+    if not runs:
+        shown = "; ".join(str(e.value) for e in at.error) or "no error shown"
+        result['problems'].append(f"no lesson generated ({shown})")
+        return result
+
+    topic = runs[-1]['plan'].content.topic
+    match = MARKER_PATTERN.search(topic)
+    if not match:
+        # Placeholder content after injected errors: degraded, not wrong
+        result['fallback'] = True
+    else:
+        if args.same_lesson:
+            # Shared with a teammate's in-flight request: any simulated teacher's key is fine
+            if not match.group(1).startswith("load-"):
+                result['problems'].append(f"unknown key: generated with key {match.group(1)!r}")
+        elif match.group(1) != api_key:
+            result['problems'].append(f"key leakage: generated with key {match.group(1)!r}")
+        if match.group(2) != subject:
+            result['problems'].append(f"cross-session content: lesson for {match.group(2)!r}")
+
+    downloads = sum("Download DLP" in str(getattr(element, 'proto', '')) for element in at.get('download_button'))
+    if downloads < (2 if args.dual_language else 1):
+        result['problems'].append(f"{downloads} download buttons")
+
+    result['state_bytes'] = _session_state_bytes(at)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate concurrent teachers against local stub servers")
+    parser.add_argument('--sessions', '-n', type=int, default=20, help="Number of simulated teachers")
+    parser.add_argument('--concurrency', '-c', type=int, default=5, help="Teachers active at the same time")
+    parser.add_argument('--latency', type=float, default=1.0, help="Mean Gemini stub latency in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of Gemini requests that fail")
+    parser.add_argument('--image-latency', type=float, default=0.3, help="Mean image stub latency in seconds")
+    parser.add_argument('--image-error-rate', type=float, default=0.0, help="Fraction of image requests that fail")
+    parser.add_argument('--stream-chunks', type=int, default=4, help="Chunks per streamed Gemini response")
+    parser.add_argument('--dual-language', action='store_true', help="Generate English and Filipino versions")
+    parser.add_argument('--hedge', action='store_true', help="Hedge every lesson to a backup model")
+    parser.add_argument('--hedge-after', type=float, default=0.2, help="Seconds before the backup request (--hedge)")
+    parser.add_argument('--primary-delay', type=float, default=2.0,
+                        help="Extra stub latency for the first model with --hedge, so the backup wins")
+    parser.add_argument('--same-lesson', action='store_true',
+                        help="Every teacher generates the same lesson (exercises request coalescing)")
+    parser.add_argument('--timeout', type=float, default=120, help="Seconds allowed per script run")
+    parser.add_argument('--seed', type=int, help="Random seed for the stubs")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    data_dir = tempfile.mkdtemp(prefix="dlp_loadtest_")
+    os.environ['DLP_DATA_DIR'] = data_dir
+    if args.hedge:
+        os.environ['DLP_HEDGE_AFTER_SECONDS'] = str(args.hedge_after)
+    os.environ['DLP_SECRET_KEY'] = os.environ.get('DLP_SECRET_KEY') or \
+        __import__('cryptography.fernet', fromlist=['Fernet']).Fernet.generate_key().decode()
+
+    import lesson_plan_app as app
+
+    gemini_stats, image_stats = StubStats(), StubStats()
+    gemini = start_server(make_gemini_handler(args, gemini_stats, app))
+    images = start_server(make_image_handler(args, image_stats))
+    os.environ['DLP_GEMINI_ENDPOINT'] = f"http://127.0.0.1:{gemini.server_port}"
+    os.environ['DLP_IMAGE_ENDPOINT'] = f"http://127.0.0.1:{images.server_port}"
+    log(f"Stubs: gemini :{gemini.server_port}, images :{images.server_port}, data {data_dir}")
+
+    share_apptest_globals()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+        for result in executor.map(lambda n: run_session(n, args), range(1, args.sessions + 1)):
+            results.append(result)
+            status = "ok" if not result['problems'] else "; ".join(result['problems'])
+            latency = f"{result['latency']:.2f}s" if result['latency'] is not None else "-"
+            log(f"[{result['number']}] {latency} {status}{' (fallback)' if result['fallback'] else ''}")
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+
+    latencies = [r['latency'] for r in results if r['latency'] is not None]
+    problems = [(r['number'], p) for r in results for p in r['problems']]
+    state_sizes = [r['state_bytes'] for r in results if r['state_bytes']]
+    report = {
+        'sessions': args.sessions,
+        'concurrency': args.concurrency,
+        'elapsed_seconds': round(elapsed, 2),
+        'throughput_per_minute': round(len(latencies) / elapsed * 60, 2) if elapsed else 0,
+        'latency_seconds': {
+            'p50': round(percentile(latencies, 0.50), 3),
+            'p90': round(percentile(latencies, 0.90), 3),
+            'p99': round(percentile(latencies, 0.99), 3),
+            'max': round(max(latencies), 3) if latencies else 0,
+        },
+        'memory': {
+            'peak_traced_mb': round(peak / 1e6, 2),
+            'per_concurrent_session_mb': round(peak / 1e6 / max(1, min(args.concurrency, args.sessions)), 2),
+            'session_state_kb': round(sum(state_sizes) / len(state_sizes) / 1e3, 1) if state_sizes else 0,
+        },
+        'fallback_lessons': sum(1 for r in results if r['fallback']),
+        'stub_requests': {
+            'gemini': gemini_stats.requests, 'gemini_errors': gemini_stats.errors,
+            'gemini_lesson_prompts': gemini_stats.lessons,
+            'gemini_keys': len(gemini_stats.keys),
+            'images': image_stats.requests, 'image_errors': image_stats.errors,
+        },
+        'correctness_problems': [f"session {n}: {p}" for n, p in problems],
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"Sessions: {args.sessions} ({args.concurrency} concurrent) in {report['elapsed_seconds']}s")
+        print(f"Throughput: {report['throughput_per_minute']} lessons/min")
+        lat = report['latency_seconds']
+        print(f"Latency: p50 {lat['p50']}s · p90 {lat['p90']}s · p99 {lat['p99']}s · max {lat['max']}s")
+        mem = report['memory']
+        print(f"Memory: peak {mem['peak_traced_mb']} MB traced · ~{mem['per_concurrent_session_mb']} MB "
+              f"per concurrent session · session state ~{mem['session_state_kb']} KB")
+        stub = report['stub_requests']
+        print(f"Stubs: {stub['gemini']} Gemini requests ({stub['gemini_lesson_prompts']} lesson prompts, "
+              f"{stub['gemini_errors']} injected errors, {stub['gemini_keys']} keys) · "
+              f"{stub['images']} image requests ({stub['image_errors']} errors)")
+        print(f"Placeholder lessons: {report['fallback_lessons']}")
+        print(f"Correctness problems: {len(problems)}")
+        for line in report['correctness_problems']:
+            print(f"  - {line}")
+
+    gemini.shutdown()
+    images.shutdown()
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+"""
+Benchmark for math rendering in the DOCX builders.
+
+Builds the same math-heavy lesson plan repeatedly and compares:
+- plain: equations switched off (DLP_MATH_EQUATIONS=0 behaviour);
+- cold: equations on with an empty conversion cache (first document of the day);
+- warm: equations on with the cache filled (every later document).
+
+    python dlp_mathbench.py --docs 20 --max-overhead 0.25
+
+It also times one conversion of each sample expression cold and warm, and checks
+how split_math divides a few sample sentences. The exit status is 1 when a warm
+build is slower than a plain one by more than --max-overhead or a split check
+fails, so it can run as a regression check.
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+
+import lesson_plan_app as app
+
+SAMPLE_EXPRESSIONS = [
+    "(x+1)^2/(x-3)",
+    "x_1 = (-b ± √(b^2-4ac))/2a",
+    "x^2 + 5x + 6 = 0",
+    "(2x-1)(x+3) = 2x^2 + 5x - 3",
+    "a^2 + b^2 = c^2",
+    "√(x^2 + y^2)",
+    "(3x^2 - 12)/(x - 2)",
+    "y = mx + b",
+    "10^-3",
+    "$\\frac{1}{2}bh$",
+    "sin^2 x + cos^2 x = 1",
+    "\\sqrt[3]{27} = 3",
+]
+
+# (text, expected split_math segments)
+SPLIT_CHECKS = [
+    ("Price is $5 and $10 for two items.", [(False, "Price is $5 and $10 for two items.")]),
+    ("Pay $3 + $4 in total.", [(False, "Pay $3 + $4 in total.")]),
+    ("Area is $x^2$ cm.", [(False, "Area is "), (True, "x^2"), (False, " cm.")]),
+    ("Solve $x + 1 = 3$ now.", [(False, "Solve "), (True, "x + 1 = 3"), (False, " now.")]),
+    ("$\\frac{1}{2}bh$", [(True, "\\frac{1}{2}bh")]),
+]
+
+
+def math_heavy_lesson(expressions):
+    """Fallback lesson with every text field and assessment choice full of expressions"""
+    ai_data = app.create_fallback_data('Mathematics', 'Grade 9', 'I', 'x', 'y', 'z')
+    sentence = lambda i: (f"Simplify {expressions[i % len(expressions)]} and compare it with "
+                          f"{expressions[(i + 3) % len(expressions)]}.")
+    counter = iter(range(10_000))
+
+    def fill(node):
+        if isinstance(node, dict):
+            return {k: fill(v) for k, v in node.items()}
+        if isinstance(node, list):
+            return [fill(v) for v in node]
+        if isinstance(node, str):
+            return sentence(next(counter))
+        return node
+
+    ai_data = fill(ai_data)
+    ai_data['evaluation'] = {
+        f'assess_q{n}': "|".join([sentence(n)] + [
+            f"{letter}. {expressions[(n + k) % len(expressions)]}" for k, letter in enumerate("ABCD")
+        ]) for n in range(1, 6)
+    }
+    return ai_data
+
+
+def time_builds(inputs, ai_data, docs, clear_cache_each_time=False):
+    durations = []
+    for _ in range(docs):
+        if clear_cache_each_time:
+            with app._math_cache_lock:
+                app._math_cache.clear()
+        started = time.perf_counter()
+        app.render_lesson_plan(inputs, ai_data, 'Teacher', 'Principal')
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def time_conversions(expressions, rounds):
+    cold, warm = [], []
+    for _ in range(rounds):
+        with app._math_cache_lock:
+            app._math_cache.clear()
+        for expr in expressions:
+            started = time.perf_counter()
+            app.math_to_omml(expr)
+            cold.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            app.math_to_omml(expr)
+            warm.append(time.perf_counter() - started)
+    return cold, warm
+
+
+def split_failures(checks):
+    """Texts whose split_math segments differ from the expected ones"""
+    enabled = app.MATH_EQUATIONS_ENABLED
+    try:
+        app.MATH_EQUATIONS_ENABLED = True
+        return [(text, app.split_math(text)) for text, expected in checks if app.split_math(text) != expected]
+    finally:
+        app.MATH_EQUATIONS_ENABLED = enabled
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time DOCX builds with and without native equations")
+    parser.add_argument('--docs', '-n', type=int, default=10, help="Documents built per variant")
+    parser.add_argument('--max-overhead', type=float, default=0.25,
+                        help="Allowed slowdown of warm builds over plain builds (0.25 = 25%%)")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    app.fetch_ai_image_hedged = lambda keywords: None   # keep the network out of the timings
+    inputs = app.normalize_lesson_inputs({
+        'subject': 'Mathematics', 'grade': 'Grade 9', 'quarter': 'I',
+        'content_std': 'x', 'perf_std': 'y', 'competency': 'Solves quadratic equations x^2 + bx + c = 0'
+    })
+    ai_data = math_heavy_lesson(SAMPLE_EXPRESSIONS)
+
+    enabled = app.MATH_EQUATIONS_ENABLED
+    try:
+        app.MATH_EQUATIONS_ENABLED = False
+        time_builds(inputs, ai_data, 1)                    # warm up imports and the DOCX skeleton
+        plain = time_builds(inputs, ai_data, args.docs)
+        app.MATH_EQUATIONS_ENABLED = True
+        cold = time_builds(inputs, ai_data, args.docs, clear_cache_each_time=True)
+        warm = time_builds(inputs, ai_data, args.docs)
+    finally:
+        app.MATH_EQUATIONS_ENABLED = enabled
+    convert_cold, convert_warm = time_conversions(SAMPLE_EXPRESSIONS, max(1, args.docs))
+
+    plain_ms, cold_ms, warm_ms = (statistics.median(d) * 1000 for d in (plain, cold, warm))
+    overhead = warm_ms / plain_ms - 1 if plain_ms else 0.0
+    report = {
+        'docs': args.docs,
+        'build_ms': {'plain': round(plain_ms, 2), 'cold': round(cold_ms, 2), 'warm': round(warm_ms, 2)},
+        'warm_overhead': round(overhead, 4),
+        'convert_us': {
+            'cold': round(statistics.median(convert_cold) * 1e6, 1),
+            'warm': round(statistics.median(convert_warm) * 1e6, 1),
+        },
+        'cache': app.get_math_cache_stats(),
+        'split_failures': split_failures(SPLIT_CHECKS),
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"DOCX build (median of {args.docs}): plain {plain_ms:.1f} ms · "
+              f"equations cold {cold_ms:.1f} ms · equations warm {warm_ms:.1f} ms "
+              f"({overhead:+.1%} over plain)")
+        print(f"One conversion (median): cold {report['convert_us']['cold']} µs · "
+              f"cached {report['convert_us']['warm']} µs")
+        stats = report['cache']
+        print(f"Cache: {stats['entries']} entries · {stats['hits']} hits · {stats['misses']} misses")
+        print(f"Split checks: {len(SPLIT_CHECKS) - len(report['split_failures'])} of {len(SPLIT_CHECKS)} pass")
+        for text, segments in report['split_failures']:
+            print(f"  {text!r} -> {segments!r}")
+
+    return 1 if overhead > args.max_overhead or report['split_failures'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+"""
+Replay tool for the generation log (see lesson_plan_app section 4B).
+
+Re-runs parsing, validation and rendering of logged generations offline. The
+model is never called: repair calls are answered with the responses recorded
+at the time, and lesson pictures come from the clipart library or the
+placeholder drawer.
+
+    python dlp_replay.py list --limit 20
+    python dlp_replay.py show 20250114-101502-a1b2c3 --full
+    python dlp_replay.py render 20250114-101502-a1b2c3 --out-dir replays
+    python dlp_replay.py check
+    python dlp_replay.py bench --repeat 5
+
+render writes the DOCX file(s) of one record and says whether the replayed
+content matches what the teacher got. check does that for every lesson and
+weekly record, which catches parser/validation changes that would alter
+recorded results. bench times parsing, validation and rendering over the
+recorded responses, as real-world fixtures.
+
+Quarter plans are re-rendered from the recorded lessons; their lessons are
+not re-parsed because the repair calls of parallel lessons are interleaved.
+"""
+import argparse
+import json
+import math
+import os
+import statistics
+import sys
+import time
+import types
+
+os.environ['DLP_REPLAY_LOG'] = '0'   # replaying must not log new records
+
+import lesson_plan_app as app
+
+LESSON_KINDS = ('lesson', 'lesson_dual')
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+class ReplayModel:
+    """Stands in for a GeminiModel: answers with the recorded responses of one stage, in order"""
+
+    def __init__(self, record, stage):
+        self.model_name = "replay"
+        self._stages = iter([s for s in record.get('stages', []) if s['stage'] == stage])
+
+    def generate_content(self, prompt, stream=False):
+        stage = next(self._stages, None)
+        if stage is None:
+            raise RuntimeError("no recorded response left for this call")
+        if stage.get('error'):
+            raise RuntimeError(f"recorded failure: {stage['error']}")
+        return types.SimpleNamespace(text=stage['response'], usage_metadata=None)
+
+
+def offline():
+    """No ledger rows and no network while replaying"""
+    app.record_model_call = lambda *args, **kwargs: None
+    app.fetch_ai_image_hedged = lambda keywords: None
+
+
+def record_inputs(record):
+    return record['notes'].get('normalized_inputs') or app.normalize_lesson_inputs(record.get('inputs') or {})
+
+
+def primary_result(record):
+    result = record.get('result')
+    if record['kind'] == 'lesson_dual' and isinstance(result, dict):
+        return next(iter(result.values()), None)
+    return result
+
+
+def replay_record(record):
+    """
+    Re-run parsing and validation of a lesson or weekly record.
+    Returns the replayed content, or None when there is nothing to re-parse
+    (quarter plans, jobs that failed before the model answered).
+    """
+    notes = record.get('notes', {})
+    if 'raw_response' not in notes:
+        return None
+    inputs = record_inputs(record)
+
+    if record['kind'] in LESSON_KINDS:
+        ai_data = app.parse_ai_response(notes['raw_response'])
+        return app.validate_and_repair(
+            ReplayModel(record, 'repair'), inputs, notes.get('language', 'english'), ai_data,
+            resources=notes.get('catalog_resources')
+        )
+
+    if record['kind'] == 'weekly':
+        language = notes.get('language', 'english')
+        data = app.normalize_weekly_data(app.parse_ai_response(notes['raw_response']), inputs, language)
+        if notes.get('catalog_resources'):
+            data['resources'] = notes['catalog_resources']
+        return data
+
+    return None
+
+
+def differing_keys(recorded, replayed):
+    if not isinstance(recorded, dict) or not isinstance(replayed, dict):
+        return [] if recorded == replayed else ['(whole result)']
+    return sorted(
+        key for key in set(recorded) | set(replayed)
+        if json.dumps(recorded.get(key), sort_keys=True) != json.dumps(replayed.get(key), sort_keys=True)
+    )
+
+
+def summary_line(record):
+    inputs = record.get('inputs') or {}
+    fallback = any(v.get('fallback') for v in record.get('notes', {}).get('validation', [])) \
+        or record.get('notes', {}).get('fallback') == 'all'
+    when = time.strftime('%Y-%m-%d %H:%M', time.localtime(record.get('ts', 0)))
+    return (f"{record['id']}  {when}  {record['kind']:<11} "
+            f"{inputs.get('subject', '')} / {inputs.get('grade', '')} / Q{inputs.get('quarter', '')}  "
+            f"{len(record.get('stages', []))} calls  {record.get('seconds', 0):.1f}s"
+            + ("  FALLBACK" if fallback else "") + ("  ERROR" if record.get('error') else ""))
+
+
+def find_or_exit(args):
+    record = app.find_replay_record(args.id, args.dir)
+    if record is None:
+        log(f"no record {args.id} in {args.dir or app.REPLAY_DIR}")
+        sys.exit(1)
+    return record
+
+
+def cmd_list(args):
+    records = [r for r in app.iter_replay_records(args.dir) if not args.kind or r['kind'] == args.kind]
+    for record in records[-args.limit:]:
+        print(summary_line(record))
+    return 0
+
+
+def cmd_show(args):
+    record = find_or_exit(args)
+    limit = None if args.full else 600
+    print(summary_line(record))
+    print(f"inputs: {json.dumps(record.get('inputs'), ensure_ascii=False)}")
+    for name, value in record.get('notes', {}).items():
+        if name in ('raw_response', 'normalized_inputs', 'context') and not args.full:
+            continue
+        print(f"{name}: {json.dumps(value, ensure_ascii=False)[:limit]}")
+    for n, stage in enumerate(record.get('stages', []), 1):
+        status = stage['error'] or ("cancelled" if stage.get('cancelled') else "ok")
+        print(f"\n--- call {n}: {stage['stage']} · {stage['model']} · {stage['seconds']}s · {status}")
+        print(f"PROMPT:\n{stage['prompt'][:limit]}")
+        print(f"RESPONSE:\n{stage['response'][:limit]}")
+    return 0
+
+
+def render_record(record, args):
+    """{file name: DOCX bytes} for one record"""
+    inputs = record_inputs(record)
+    school = app.get_school_config(inputs.get('school'))
+    teacher = args.teacher or school['teacher_name']
+    principal = args.principal or school['principal_name']
+    base = f"replay_{record['id']}"
+    replayed = replay_record(record)
+    result = record.get('result')
+
+    if record['kind'] == 'lesson':
+        return {f"{base}.docx": app.render_lesson_plan(inputs, replayed or result, teacher, principal)}
+    if record['kind'] == 'lesson_dual':
+        plans = dict(result)
+        if replayed is not None:
+            plans[next(iter(plans))] = replayed
+        documents = app.render_dual_language_plans(inputs, plans, teacher, principal)
+        return {f"{base}_{app.LANGUAGE_FILE_SUFFIXES[language]}.docx": data for language, data in documents.items()}
+    if record['kind'] == 'weekly':
+        return {f"{base}.docx": app.render_weekly_log(inputs, replayed or result, teacher, principal)}
+    if record['kind'] == 'quarter':
+        return {
+            f"{base}_L{number}.docx": app.render_lesson_plan(lesson_inputs, ai_data, teacher, principal)
+            for number, (lesson_inputs, ai_data) in enumerate(result or [], 1)
+        }
+    raise ValueError(f"unknown record kind {record['kind']!r}")
+
+
+def cmd_render(args):
+    offline()
+    record = find_or_exit(args)
+    replayed = replay_record(record)
+    if replayed is not None:
+        diff = differing_keys(primary_result(record), replayed)
+        log("replay matches the recorded result" if not diff else f"replay differs in: {', '.join(diff)}")
+    os.makedirs(args.out_dir, exist_ok=True)
+    for file_name, data in render_record(record, args).items():
+        path = os.path.join(args.out_dir, file_name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        log(f"wrote {path}")
+    return 0
+
+
+def cmd_check(args):
+    offline()
+    checked = mismatched = 0
+    for record in app.iter_replay_records(args.dir):
+        if args.kind and record['kind'] != args.kind:
+            continue
+        replayed = replay_record(record)
+        if replayed is None:
+            continue
+        checked += 1
+        diff = differing_keys(primary_result(record), replayed)
+        if diff:
+            mismatched += 1
+            print(f"{record['id']}  differs in: {', '.join(diff)}")
+    print(f"{checked} records replayed, {mismatched} differ from what was recorded")
+    return 1 if mismatched else 0
+
+
+def cmd_bench(args):
+    offline()
+    records = [r for r in app.iter_replay_records(args.dir)
+               if r['kind'] in LESSON_KINDS and 'raw_response' in r.get('notes', {})][-args.limit:]
+    if not records:
+        log("no lesson records with a recorded response")
+        return 1
+    timings = {'parse': [], 'validate': [], 'render': []}
+    for _ in range(args.repeat):
+        for record in records:
+            notes, inputs = record['notes'], record_inputs(record)
+            started = time.perf_counter()
+            ai_data = app.parse_ai_response(notes['raw_response'])
+            timings['parse'].append(time.perf_counter() - started)
+            started = time.perf_counter()
+            ai_data = app.validate_and_repair(ReplayModel(record, 'repair'), inputs, notes.get('language', 'english'),
+                                              ai_data, resources=notes.get('catalog_resources'))
+            timings['validate'].append(time.perf_counter() - started)
+            started = time.perf_counter()
+            app.render_lesson_plan(inputs, ai_data, 'Teacher', 'Principal')
+            timings['render'].append(time.perf_counter() - started)
+    report = {
+        stage: {'median_ms': round(statistics.median(values) * 1000, 2),
+                'p90_ms': round(sorted(values)[math.ceil(0.9 * len(values)) - 1] * 1000, 2)}
+        for stage, values in timings.items()
+    }
+    report['records'] = len(records)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{len(records)} recorded lessons × {args.repeat}")
+        for stage in timings:
+            print(f"  {stage:<9} median {report[stage]['median_ms']:.2f} ms · p90 {report[stage]['p90_ms']:.2f} ms")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect and replay logged DLP generations without calling the model")
+    parser.add_argument('--dir', help="Replay log folder (default: DLP_DATA_DIR/replay)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('list', help="List logged generations, newest last")
+    p.add_argument('--kind', choices=('lesson', 'lesson_dual', 'weekly', 'quarter'))
+    p.add_argument('--limit', type=int, default=20)
+    p.set_defaults(func=cmd_list)
+
+    p = commands.add_parser('show', help="Print the inputs, notes and every model call of one record")
+    p.add_argument('id')
+    p.add_argument('--full', action='store_true', help="Do not shorten prompts and responses")
+    p.set_defaults(func=cmd_show)
+
+    p = commands.add_parser('render', help="Replay one record and write its DOCX file(s)")
+    p.add_argument('id')
+    p.add_argument('--out-dir', default='.')
+    p.add_argument('--teacher', help="Teacher name (default: the school's)")
+    p.add_argument('--principal', help="Principal name (default: the school's)")
+    p.set_defaults(func=cmd_render)
+
+    p = commands.add_parser('check', help="Replay every record and report results that changed")
+    p.add_argument('--kind', choices=('lesson', 'lesson_dual', 'weekly'))
+    p.set_defaults(func=cmd_check)
+
+    p = commands.add_parser('bench', help="Time parsing, validation and rendering on recorded responses")
+    p.add_argument('--limit', type=int, default=50, help="Most recent lesson records to use")
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--json', action='store_true', help="Print the report as JSON")
+    p.set_defaults(func=cmd_bench)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,10 @@
 import streamlit as st
-import google.generativeai as genai
+from google import genai
+from google.genai import types as genai_types
 import json
+import html
+import copy
+import difflib
 from datetime import date
 import io
 import requests
@@ -8,78 +12,208 @@ import urllib.parse
 import random
 import re
 import hashlib
+import functools
+import gzip
+import os
+import time
+import colorsys
+import csv
+import bisect
+import secrets
+import sqlite3
+import shutil
+import tempfile
+import zipfile
+import zlib
+import struct
+import threading
+import contextvars
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from operator import itemgetter
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from PIL import Image, ImageOps, ImageDraw, ImageFont
+from cryptography.fernet import Fernet, InvalidToken
 
 # --- NEW LIBRARY FOR WORD DOCS ---
 from docx import Document
 from docx.shared import Inches, Pt, Mm
 from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.enum.section import WD_ORIENT
 from docx.oxml.ns import nsdecls
 from docx.oxml import parse_xml
 
 # --- 1. CONFIGURATION ---
 st.set_page_config(page_title="DLP Generator", layout="centered")
 
+# Local state: profiles, caches and logs
+DATA_DIR = os.environ.get("DLP_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".dlp_data"))
+
+DEFAULT_TEACHER_NAME = "RICHARD P. SAMORANOS"
+DEFAULT_PRINCIPAL_NAME = "ROSALITA A. ESTROPIA"
+
+GRADE_OPTIONS = [
+    "Kinder",
+    "Grade 1", "Grade 2", "Grade 3", "Grade 4", "Grade 5", "Grade 6",
+    "Grade 7", "Grade 8", "Grade 9", "Grade 10",
+    "Grade 11", "Grade 12"
+]
+QUARTER_OPTIONS = ["I", "II", "III", "IV"]
+
+# --- 1A. PROCESS-WIDE STATE ---
+# Streamlit re-runs this script in a fresh namespace on every interaction, so plain
+# module globals would be rebuilt per rerun and never shared between sessions.
+# Thread pools, caches, locks and the lesson types live here instead: created once
+# per process and shared by every session and every school.
+@st.cache_resource(show_spinner=False)
+def _process_state():
+    return {'_lock': threading.RLock()}
+
+def shared(name, factory):
+    """Process-wide object: factory() runs once, later calls (and reruns) get the same object"""
+    state = _process_state()
+    with state['_lock']:
+        if name not in state:
+            state[name] = factory()
+        return state[name]
+
+# --- 1B. SCHOOLS ---
+# One deployment serves every school in the division. Each school's branding,
+# signatory positions and default names come from schools/schools.json and the
+# school is picked by the ?school= URL parameter or the teacher's profile.
+# Without the file the app is the single-school build (DEFAULT_SCHOOL).
+SCHOOLS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schools", "schools.json")
+
+DEFAULT_SCHOOL = {
+    'id': 'manual-nhs',
+    'name': 'MANUAL NATIONAL HIGH SCHOOL',
+    'department': 'DEPARTMENT OF EDUCATION REGION XI',
+    'division': 'DIVISION OF DAVAO DEL SUR',
+    'district': 'Kiblawan North District',
+    'prompt_name': 'Manual National High School',
+    'prompt_location': 'the Division of Davao Del Sur, Region XI, Philippines',
+    'teacher_position': 'Teacher III',
+    'principal_position': 'Principal III',
+    'teacher_name': DEFAULT_TEACHER_NAME,
+    'principal_name': DEFAULT_PRINCIPAL_NAME,
+    'primary_color': '#800000',
+    'accent_color': '#FFD700',
+}
+
+_schools_cache = shared('schools', dict)
+
+def load_schools():
+    """{school id: config}, loaded once per process. Missing keys fall back to DEFAULT_SCHOOL."""
+    if 'schools' not in _schools_cache:
+        schools, default_id = {DEFAULT_SCHOOL['id']: DEFAULT_SCHOOL}, DEFAULT_SCHOOL['id']
+        try:
+            with open(SCHOOLS_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            configured = {
+                school_id: dict(DEFAULT_SCHOOL, **config, id=school_id)
+                for school_id, config in data.get('schools', {}).items()
+            }
+            if configured:
+                schools = configured
+                default_id = data.get('default') if data.get('default') in configured else next(iter(configured))
+        except (OSError, ValueError, AttributeError, TypeError):
+            pass
+        _schools_cache['default'] = default_id
+        _schools_cache['schools'] = schools
+    return _schools_cache['schools']
+
+def get_school_config(school_id=None):
+    schools = load_schools()
+    return schools.get(school_id) or schools[_schools_cache['default']]
+
+def school_intro(inputs):
+    """Opening line of every prompt, naming the teacher's school"""
+    school = get_school_config(inputs.get('school'))
+    return f"You are an expert teacher from {school['prompt_name']} in {school['prompt_location']}."
+
+def current_school_id():
+    """School for this session: ?school= URL parameter, then the profile, then the default"""
+    schools = load_schools()
+    for candidate in (st.query_params.get('school'), st.session_state.get('school_id'),
+                      st.session_state.get('profile_defaults', {}).get('school')):
+        if candidate in schools:
+            st.session_state.school_id = candidate
+            return candidate
+    st.session_state.school_id = _schools_cache['default']
+    return st.session_state.school_id
+
 # --- 2. SIMPLIFIED HEADER WITHOUT LOGOS ---
-def add_custom_header():
-    """Add custom header with maroon background (NO LOGOS)"""
+def add_custom_header(school=None):
+    """Add custom header in the school's colors (NO LOGOS)"""
+    school = school or get_school_config()
+    
+    primary, accent = school['primary_color'], school['accent_color']
+    department, division, name, district = (
+        html.escape(school[key]) for key in ('department', 'division', 'name', 'district')
+    )
     
-    st.markdown("""
+    st.markdown(f"""
     <style>
-    .header-container {
+    .header-container {{
         text-align: center;
         padding: 20px;
         margin-bottom: 25px;
-        background-color: #800000; /* MAROON BACKGROUND */
+        background-color: {primary}; /* School color (maroon by default) */
         border-radius: 10px;
         box-shadow: 0 4px 12px rgba(128, 0, 0, 0.3);
         color: white;
-    }
-    .dept-name {
+    }}
+    .dept-name {{
         font-size: 24px;
         font-weight: bold;
         color: white;
         margin: 0;
         text-shadow: 1px 1px 3px rgba(0,0,0,0.3);
-    }
-    .division-name {
+    }}
+    .division-name {{
         font-size: 20px;
         font-weight: bold;
-        color: #FFD700; /* Gold color for contrast */
+        color: {accent}; /* Accent color for contrast */
         margin: 8px 0;
-    }
-    .school-name {
+    }}
+    .school-name {{
         font-size: 28px;
         font-weight: bold;
         color: white;
         margin: 8px 0;
         text-transform: uppercase;
         letter-spacing: 1.5px;
-    }
-    .header-subtext {
+    }}
+    .header-subtext {{
         font-size: 15px;
-        color: #FFD700; /* Gold color */
+        color: {accent}; /* Accent color */
         margin-top: 8px;
         font-style: italic;
-    }
+    }}
     
     /* App title styling */
-    .app-title {
+    .app-title {{
         font-size: 32px;
         font-weight: bold;
         text-align: center;
-        color: #800000; /* Maroon */
+        color: {primary};
         margin: 15px 0 25px 0;
         padding: 10px;
-        border-bottom: 3px solid #800000;
+        border-bottom: 3px solid {primary};
         text-shadow: 1px 1px 2px rgba(0,0,0,0.1);
-    }
+    }}
     </style>
     
     <div class="header-container">
-        <p class="dept-name">DEPARTMENT OF EDUCATION REGION XI</p>
-        <p class="division-name">DIVISION OF DAVAO DEL SUR</p>
-        <p class="school-name">MANUAL NATIONAL HIGH SCHOOL</p>
-        <p class="header-subtext">Kiblawan North District</p>
+        <p class="dept-name">{department}</p>
+        <p class="division-name">{division}</p>
+        <p class="school-name">{name}</p>
+        <p class="header-subtext">{district}</p>
     </div>
     """, unsafe_allow_html=True)
 
@@ -201,12 +335,261 @@ def get_language_instruction(language):
         - If teacher uses Filipino terms, translate them to English
         """
 
+# --- 3A. CURRICULUM GUIDE INDEX ---
+# Columnar, de-duplicated copy of the curriculum guide competency list with a
+# code prefix index (sorted codes + bisect) and a trigram index for keyword search.
+CURRICULUM_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "curriculum", "competencies.csv")
+COMPETENCY_CODE_PATTERN = re.compile(r'^\s*([A-Z]{1,8}\d{1,2}[A-Z]{0,8}-[A-Za-z0-9.\-]*[A-Za-z0-9])\b', re.IGNORECASE)
+
+_curriculum_cache = shared('curriculum_index', dict)
+_curriculum_lock = shared('curriculum_lock', threading.Lock)
+
+def _trigrams(text):
+    text = f"  {re.sub(r'[^a-z0-9]+', ' ', text.lower()).strip()} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def build_curriculum_index(path=CURRICULUM_FILE):
+    """
+    Load the competency CSV into parallel columns. Repeated strings (subjects,
+    grades, standards) are stored once and referenced by position.
+    """
+    strings, string_ids = [], {}
+    
+    def intern_text(value):
+        value = re.sub(r'\s+', ' ', (value or '')).strip()
+        if value not in string_ids:
+            string_ids[value] = len(strings)
+            strings.append(value)
+        return string_ids[value]
+    
+    columns = {name: array('I') for name in ('subject', 'grade', 'quarter', 'competency', 'content_std', 'perf_std')}
+    codes = []
+    
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            for row in csv.DictReader(f):
+                code = (row.get('code') or '').strip()
+                if not code:
+                    continue
+                codes.append(code)
+                for name, column in columns.items():
+                    column.append(intern_text(row.get(name)))
+    
+    trigrams = {}
+    for row_id, code in enumerate(codes):
+        text = f"{code} {strings[columns['competency'][row_id]]}"
+        for gram in _trigrams(text):
+            trigrams.setdefault(gram, array('I')).append(row_id)
+    
+    return {
+        'strings': strings,
+        'codes': codes,
+        'columns': columns,
+        # (lowercase code, row id) sorted for prefix lookups with bisect
+        'sorted_codes': sorted((code.lower(), row_id) for row_id, code in enumerate(codes)),
+        'trigrams': trigrams,
+    }
+
+def load_curriculum_index():
+    if 'index' not in _curriculum_cache:
+        with _curriculum_lock:
+            if 'index' not in _curriculum_cache:
+                _curriculum_cache['index'] = build_curriculum_index()
+    return _curriculum_cache['index']
+
+def _competency_entry(index, row_id):
+    strings, columns = index['strings'], index['columns']
+    entry = {name: strings[column[row_id]] for name, column in columns.items()}
+    entry['code'] = index['codes'][row_id]
+    return entry
+
+def format_competency(entry):
+    """Canonical competency text: 'CODE: description'"""
+    return f"{entry['code']}: {entry['competency']}"
+
+def lookup_competency(code):
+    """Exact (case-insensitive) competency code lookup. Returns an entry dict or None"""
+    index = load_curriculum_index()
+    key = (code or '').strip().lower()
+    pos = bisect.bisect_left(index['sorted_codes'], (key, -1))
+    if pos < len(index['sorted_codes']) and index['sorted_codes'][pos][0] == key:
+        return _competency_entry(index, index['sorted_codes'][pos][1])
+    return None
+
+def search_competencies(query, subject=None, grade=None, quarter=None, limit=10):
+    """
+    Autocomplete: code prefix matches first, then keyword (trigram) matches,
+    optionally filtered by subject/grade/quarter. Returns entry dicts.
+    """
+    index = load_curriculum_index()
+    query = (query or '').strip()
+    if not query or not index['codes']:
+        return []
+    
+    strings, columns = index['strings'], index['columns']
+    
+    def allowed(row_id):
+        return ((not subject or strings[columns['subject'][row_id]].lower() == subject.strip().lower())
+                and (not grade or strings[columns['grade'][row_id]] == grade)
+                and (not quarter or strings[columns['quarter'][row_id]] == quarter))
+    
+    results, seen = [], set()
+    
+    prefix = query.lower()
+    pos = bisect.bisect_left(index['sorted_codes'], (prefix, -1))
+    while pos < len(index['sorted_codes']) and len(results) < limit:
+        code, row_id = index['sorted_codes'][pos]
+        if not code.startswith(prefix):
+            break
+        if allowed(row_id):
+            results.append(row_id)
+            seen.add(row_id)
+        pos += 1
+    
+    if len(results) < limit:
+        query_grams = _trigrams(query)
+        hits = {}
+        for gram in query_grams:
+            for row_id in index['trigrams'].get(gram, ()):
+                hits[row_id] = hits.get(row_id, 0) + 1
+        # Require most of the query's trigrams so short typos still match
+        needed = max(1, int(len(query_grams) * 0.6))
+        ranked = sorted((row_id for row_id, count in hits.items() if count >= needed and row_id not in seen),
+                        key=lambda row_id: -hits[row_id])
+        for row_id in ranked:
+            if allowed(row_id):
+                results.append(row_id)
+                if len(results) >= limit:
+                    break
+    
+    return [_competency_entry(index, row_id) for row_id in results]
+
+def curriculum_competencies(subject=None, grade=None, quarter=None):
+    """Every guide entry for a subject/grade/quarter (blank = any), in code order"""
+    index = load_curriculum_index()
+    strings, columns = index['strings'], index['columns']
+    subject = (subject or '').strip().lower()
+    return [
+        _competency_entry(index, row_id) for _code, row_id in index['sorted_codes']
+        if (not subject or strings[columns['subject'][row_id]].lower() == subject)
+        and (not grade or strings[columns['grade'][row_id]] == grade)
+        and (not quarter or strings[columns['quarter'][row_id]] == quarter)
+    ]
+
+def canonicalize_competency_inputs(inputs):
+    """
+    If the competency starts with a known code, rewrite it in canonical form and
+    fill blank standards from the curriculum guide, so equal lessons look equal.
+    """
+    competency = (inputs.get('competency') or '').strip()
+    match = COMPETENCY_CODE_PATTERN.match(competency)
+    entry = lookup_competency(match.group(1)) if match and '\n' not in competency else None
+    if not entry:
+        return inputs
+    
+    # Only when the text after the code is empty or the same competency reworded
+    rest = competency[match.end():].strip(" :-–\t")
+    if rest:
+        rest_grams, entry_grams = _trigrams(rest), _trigrams(entry['competency'])
+        if len(rest_grams & entry_grams) < 0.5 * len(rest_grams | entry_grams):
+            return inputs
+    
+    inputs['competency'] = format_competency(entry)
+    if not inputs.get('content_std') and entry['content_std']:
+        inputs['content_std'] = entry['content_std']
+    if not inputs.get('perf_std') and entry['perf_std']:
+        inputs['perf_std'] = entry['perf_std']
+    return inputs
+
+# --- 3B. LEARNING RESOURCE CATALOG ---
+# The school's actual Teacher's Guides, Learner's Materials and textbooks with page
+# ranges. When a lesson matches, the resources section comes from here and the
+# model is not asked for it at all.
+RESOURCES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "curriculum", "resources.csv")
+RESOURCE_KINDS = ('guide', 'materials', 'textbook', 'portal', 'other')
+
+def _catalog_key(subject, grade, quarter):
+    return (re.sub(r'\s+', ' ', subject or '').strip().lower(), (grade or '').strip(), (quarter or '').strip())
+
+def build_resource_catalog(path=RESOURCES_FILE):
+    """
+    {(subject, grade, quarter): [(code prefix, kind, text)]} with the longest prefixes
+    first. A blank quarter means the whole grade, a blank prefix every competency.
+    """
+    groups = {}
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            for row in csv.DictReader(f):
+                kind = (row.get('kind') or '').strip().lower()
+                title = re.sub(r'\s+', ' ', row.get('title') or '').strip()
+                if kind not in RESOURCE_KINDS or not title:
+                    continue
+                pages = (row.get('pages') or '').strip()
+                if pages and pages[0].isdigit():
+                    pages = ("pp. " if re.search(r'[-–,]', pages) else "p. ") + pages
+                text = f"{title}, {pages}" if pages else title
+                key = _catalog_key(row.get('subject'), row.get('grade'), row.get('quarter'))
+                prefix = (row.get('competency') or '').strip().lower()
+                groups.setdefault(key, []).append((prefix, kind, text))
+    for rows in groups.values():
+        rows.sort(key=lambda row: -len(row[0]))
+    return groups
+
+def load_resource_catalog():
+    if 'resources' not in _curriculum_cache:
+        with _curriculum_lock:
+            if 'resources' not in _curriculum_cache:
+                _curriculum_cache['resources'] = build_resource_catalog()
+    return _curriculum_cache['resources']
+
+def lookup_resources(inputs):
+    """
+    {kind: text} for the kinds the catalog has for this lesson, or None when nothing
+    matches. Per kind the most specific rows win, compared across the quarter's and
+    the whole grade's rows: longest code prefix first, then a quarter row over a
+    whole-grade one. Kinds the catalog lacks are left out, for the model to write.
+    """
+    catalog = load_resource_catalog()
+    if not catalog:
+        return None
+    
+    match = COMPETENCY_CODE_PATTERN.match(inputs.get('competency') or '')
+    code = match.group(1).lower() if match else ''
+    # The curriculum guide knows the canonical subject/grade/quarter of a code
+    entry = lookup_competency(code) if code else None
+    source = entry or inputs
+    
+    candidates = {}
+    for quarter_rank, quarter in ((1, source.get('quarter')), (0, '')):
+        for prefix, kind, text in catalog.get(_catalog_key(source.get('subject'), source.get('grade'), quarter), ()):
+            if not prefix or code.startswith(prefix):
+                candidates.setdefault(kind, []).append(((len(prefix), quarter_rank), text))
+    
+    found = {}
+    for kind, rows in candidates.items():
+        best = max(rank for rank, _ in rows)
+        texts = [text for rank, text in rows if rank == best]
+        found[kind] = "; ".join(dict.fromkeys(texts))
+    return {kind: found[kind] for kind in RESOURCE_KINDS if kind in found} or None
+
+def resources_complete(resources):
+    """True when the catalog covers every kind, so the model need not write resources at all"""
+    return bool(resources) and all(resources.get(kind) for kind in RESOURCE_KINDS)
+
+def merge_catalog_resources(model_resources, catalog):
+    """The model's resources with every kind the catalog has replaced by the catalog's entry"""
+    merged = dict(model_resources) if isinstance(model_resources, dict) else {}
+    merged.update({kind: text for kind, text in (catalog or {}).items() if text})
+    return merged
+
 # --- 4. API KEY MANAGER WITH REMEMBER FEATURE ---
-def save_api_key(api_key):
-    """Save API key to session state and optionally to browser storage"""
+def save_api_key(api_key, remember=False):
+    """Save API key to session state and, if remember is set, encrypted in the teacher profile"""
     if api_key:
         st.session_state.api_key = api_key
         st.session_state.saved_api_key = api_key
+        if remember:
+            update_profile(get_profile_id(), api_key=api_key)
         return True
     return False
 
@@ -238,15 +621,15 @@ def show_api_key_settings():
     remember_me = st.sidebar.checkbox(
         "Remember my API key", 
         value=bool(saved_key),
-        help="Your API key will be saved in your browser"
+        help="Your API key will be stored encrypted in your profile on this device"
     )
     
     if st.sidebar.button("💾 Save API Key", use_container_width=True):
         if api_key:
-            if save_api_key(api_key):
+            if save_api_key(api_key, remember=remember_me):
                 st.sidebar.success("✅ API Key Saved!")
                 if remember_me:
-                    st.sidebar.info("🔒 Key saved in your browser")
+                    st.sidebar.info("🔒 Key saved (encrypted) for this browser")
                 else:
                     st.sidebar.warning("⚠️ Key saved for this session only")
             else:
@@ -256,8 +639,10 @@ def show_api_key_settings():
     
     if saved_key:
         if st.sidebar.button("🗑️ Clear Saved Key", use_container_width=True):
+            forget_resolved_model(st.session_state.saved_api_key)
             st.session_state.saved_api_key = ""
             st.session_state.api_key = ""
+            update_profile(get_profile_id(), api_key="")
             st.sidebar.success("✅ API Key Cleared!")
             st.rerun()
     
@@ -270,7 +655,7 @@ def show_api_key_settings():
         st.sidebar.warning("⚠️ API Key Required")
     
     if api_key and remember_me and api_key != saved_key:
-        save_api_key(api_key)
+        save_api_key(api_key, remember=True)
     
     return api_key
 
@@ -332,6 +717,404 @@ def show_api_key_instructions_page():
         st.session_state.show_instructions = False
         st.rerun()
 
+# --- 4A. TEACHER PROFILES ---
+# Profiles live in a local SQLite file, linked to the browser by an unguessable
+# profile ID kept in a cookie (never in the URL).
+# API keys are encrypted at rest with Fernet; the secret comes from DLP_SECRET_KEY
+# or a key file generated on first use.
+PROFILE_DB = os.path.join(DATA_DIR, "profiles.db")
+PROFILE_SECRET_FILE = os.path.join(DATA_DIR, "secret.key")
+PROFILE_COOKIE = "dlp_profile"
+PROFILE_COOKIE_DAYS = 365
+PROFILE_DEFAULT_FIELDS = ('teacher_name', 'principal_name', 'subject', 'grade', 'quarter', 'school')
+ADMIN_PIN = os.environ.get("DLP_ADMIN_PIN", "")   # Unlocks cross-teacher views; none is open without it
+
+_fernet_cache = shared('fernet', dict)
+_profile_db_lock = shared('profile_db_lock', threading.Lock)
+_resolved_models = shared('resolved_models', dict)
+
+def _api_key_digest(api_key):
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+def _read_or_create_secret():
+    """
+    The key file's secret, generated on first use. The key is written to a temp file
+    and hard-linked into place, so two first requests racing agree on one key and a
+    reader never sees a half-written file.
+    """
+    os.makedirs(DATA_DIR, exist_ok=True)
+    if not os.path.exists(PROFILE_SECRET_FILE):
+        fd, temp_path = tempfile.mkstemp(dir=DATA_DIR, prefix=".secret-")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(Fernet.generate_key())
+            os.link(temp_path, PROFILE_SECRET_FILE)
+        except FileExistsError:
+            pass   # Another request won the race; use its key
+        finally:
+            os.unlink(temp_path)
+    for _ in range(50):
+        with open(PROFILE_SECRET_FILE, 'rb') as f:
+            secret = f.read().strip()
+        if secret:
+            return secret
+        time.sleep(0.1)   # Created empty by an older version that is still writing it
+    raise RuntimeError(f"{PROFILE_SECRET_FILE} is empty; delete it or set DLP_SECRET_KEY")
+
+def _get_fernet():
+    """Fernet cipher for API keys at rest"""
+    if 'cipher' not in _fernet_cache:
+        secret = os.environ.get("DLP_SECRET_KEY") or _read_or_create_secret()
+        _fernet_cache['cipher'] = Fernet(secret)
+    return _fernet_cache['cipher']
+
+def _profile_db():
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(PROFILE_DB, timeout=10)
+    conn.execute("""CREATE TABLE IF NOT EXISTS profiles (
+        id TEXT PRIMARY KEY,
+        data TEXT NOT NULL DEFAULT '{}',
+        api_key BLOB,
+        updated REAL
+    )""")
+    return conn
+
+def load_profile(profile_id):
+    """Return {'defaults': {...}, 'models': {...}, 'api_key': str} for a profile ID"""
+    profile = {'defaults': {}, 'models': {}, 'api_key': ''}
+    if not profile_id:
+        return profile
+    
+    with _profile_db_lock:
+        conn = _profile_db()
+        try:
+            row = conn.execute("SELECT data, api_key FROM profiles WHERE id = ?", (profile_id,)).fetchone()
+        finally:
+            conn.close()
+    
+    if row:
+        data = json.loads(row[0] or '{}')
+        profile['defaults'] = data.get('defaults', {})
+        profile['models'] = data.get('models', {})
+        if row[1]:
+            try:
+                profile['api_key'] = _get_fernet().decrypt(row[1]).decode('utf-8')
+            except InvalidToken:
+                profile['api_key'] = ''  # Secret was rotated; teacher re-enters the key
+    return profile
+
+def load_teacher_names(profile_ids):
+    """{profile_id: teacher name or a short ID} for dashboards; reads no API keys"""
+    ids = [pid for pid in set(profile_ids) if pid]
+    names = {}
+    if ids:
+        with _profile_db_lock:
+            conn = _profile_db()
+            try:
+                rows = conn.execute(
+                    f"SELECT id, data FROM profiles WHERE id IN ({','.join('?' * len(ids))})", ids
+                ).fetchall()
+            finally:
+                conn.close()
+        names = {pid: json.loads(data or '{}').get('defaults', {}).get('teacher_name') for pid, data in rows}
+    return {pid: names.get(pid) or (pid[:8] if pid else "(command line)") for pid in profile_ids}
+
+def update_profile(profile_id, defaults=None, model=None, api_key=None):
+    """
+    Merge changes into a stored profile. model is (api_key, model_name).
+    api_key='' removes the stored key, None leaves it unchanged.
+    """
+    if not profile_id:
+        return
+    
+    with _profile_db_lock:
+        conn = _profile_db()
+        try:
+            row = conn.execute("SELECT data FROM profiles WHERE id = ?", (profile_id,)).fetchone()
+            data = json.loads(row[0]) if row else {}
+            
+            if defaults:
+                data.setdefault('defaults', {}).update(
+                    {k: v for k, v in defaults.items() if k in PROFILE_DEFAULT_FIELDS and v}
+                )
+            if model:
+                data.setdefault('models', {})[_api_key_digest(model[0])] = model[1]
+            
+            conn.execute(
+                "INSERT INTO profiles (id, data, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET data = excluded.data, updated = excluded.updated",
+                (profile_id, json.dumps(data), time.time())
+            )
+            if api_key is not None:
+                encrypted = _get_fernet().encrypt(api_key.encode('utf-8')) if api_key else None
+                conn.execute("UPDATE profiles SET api_key = ? WHERE id = ?", (encrypted, profile_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+def remember_resolved_model(api_key, model_name):
+    """Cache the working model for a key so later generations skip the probe call"""
+    if api_key and model_name:
+        _resolved_models[_api_key_digest(api_key)] = model_name
+
+def get_resolved_model(api_key):
+    return _resolved_models.get(_api_key_digest(api_key)) if api_key else None
+
+def forget_resolved_model(api_key):
+    if api_key:
+        _resolved_models.pop(_api_key_digest(api_key), None)
+
+def _set_profile_cookie(profile_id):
+    js = (f"window.parent.document.cookie = '{PROFILE_COOKIE}={profile_id}; "
+          f"max-age={PROFILE_COOKIE_DAYS * 86400}; path=/; SameSite=Lax';")
+    st.components.v1.html(f"<script>{js}</script>", height=0)
+
+def get_profile_id():
+    """
+    Profile ID for this browser: the cookie, else a new one. The ID is the only
+    credential for the stored key and queued documents, so it is never taken from
+    or put into the URL, where it would leak through bookmarks, history and shared links.
+    """
+    if st.session_state.get('profile_id'):
+        return st.session_state.profile_id
+    
+    context = getattr(st, 'context', None)
+    cookies = getattr(context, 'cookies', None) or {}
+    profile_id = cookies.get(PROFILE_COOKIE)
+    
+    if not profile_id or not re.fullmatch(r'[A-Za-z0-9_\-]{16,64}', profile_id):
+        profile_id = secrets.token_urlsafe(18)
+    
+    st.session_state.profile_id = profile_id
+    if 'profile' in st.query_params:
+        del st.query_params['profile']   # Left in bookmarks by older versions
+    _set_profile_cookie(profile_id)
+    return profile_id
+
+def init_profile_session():
+    """Load the teacher's profile once per session: saved key, form defaults, model choice"""
+    if st.session_state.get('profile_loaded'):
+        return
+    
+    profile = load_profile(get_profile_id())
+    st.session_state.profile_defaults = profile['defaults']
+    
+    if profile['api_key']:
+        st.session_state.saved_api_key = profile['api_key']
+        st.session_state.api_key = profile['api_key']
+        model_name = profile['models'].get(_api_key_digest(profile['api_key']))
+        remember_resolved_model(profile['api_key'], model_name)
+    
+    st.session_state.profile_loaded = True
+
+def option_index(options, value, fallback):
+    return options.index(value) if value in options else fallback
+
+def profile_default(field, fallback=""):
+    return st.session_state.get('profile_defaults', {}).get(field) or fallback
+
+def save_profile_defaults(**values):
+    """Remember the teacher's usual form values for the next visit"""
+    st.session_state.setdefault('profile_defaults', {}).update({k: v for k, v in values.items() if v})
+    api_key = st.session_state.get('api_key')
+    model_name = get_resolved_model(api_key)
+    update_profile(
+        get_profile_id(),
+        defaults=values,
+        model=(api_key, model_name) if model_name else None
+    )
+
+# --- 4B. REPLAY LOG ---
+# Append-only record of every generation job: inputs, each model call's prompt
+# and raw response with timings, what parsing/validation did and the final
+# result. Records are JSON lines in gzip segments under DATA_DIR/replay; a
+# segment is rotated at REPLAY_SEGMENT_BYTES and the oldest segments are deleted
+# beyond REPLAY_MAX_BYTES. dlp_replay.py re-runs parsing and rendering from it
+# without calling the model. API keys are never written.
+REPLAY_DIR = os.path.join(DATA_DIR, "replay")
+REPLAY_ENABLED = os.environ.get('DLP_REPLAY_LOG', '1') != '0'
+REPLAY_SEGMENT_BYTES = int(float(os.environ.get('DLP_REPLAY_SEGMENT_MB', '8')) * 1024 * 1024)
+REPLAY_MAX_BYTES = int(float(os.environ.get('DLP_REPLAY_MAX_MB', '256')) * 1024 * 1024)
+REPLAY_FORMAT_VERSION = 1
+
+_replay_context = shared('replay_context', lambda: contextvars.ContextVar('dlp_replay', default=None))
+_last_replay_id = shared('last_replay_id', lambda: contextvars.ContextVar('dlp_last_replay', default=None))
+# A list set here receives every top-level record finished in this context (see coalesced_generation)
+_replay_listener = shared('replay_listener', lambda: contextvars.ContextVar('dlp_replay_listener', default=None))
+_replay_writer = shared('replay_writer', lambda: {'lock': threading.Lock(), 'file': None, 'path': None, 'segments': 0})
+
+def _open_replay_segment():
+    """Close the current segment, drop the oldest ones over budget and start a new one"""
+    writer = _replay_writer
+    if writer['file'] is not None:
+        writer['file'].close()
+    os.makedirs(REPLAY_DIR, exist_ok=True)
+    segments = list_replay_segments()
+    total = sum(os.path.getsize(path) for path in segments)
+    while segments and total > REPLAY_MAX_BYTES:
+        oldest = segments.pop(0)
+        total -= os.path.getsize(oldest)
+        os.remove(oldest)
+    writer['segments'] += 1
+    writer['path'] = os.path.join(
+        REPLAY_DIR, f"replay-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{writer['segments']:05d}.jsonl.gz"
+    )
+    writer['file'] = gzip.open(writer['path'], 'wb')
+
+def write_replay_record(record):
+    line = (json.dumps(record, ensure_ascii=False, default=str) + "\n").encode('utf-8')
+    writer = _replay_writer
+    try:
+        with writer['lock']:
+            if writer['file'] is None or writer['file'].fileobj.tell() >= REPLAY_SEGMENT_BYTES:
+                _open_replay_segment()
+            writer['file'].write(line)
+            # Sync flush: every finished record is readable even if the process dies
+            writer['file'].flush(zlib.Z_SYNC_FLUSH)
+    except OSError:
+        pass  # Logging must never break generation
+
+def list_replay_segments(directory=None):
+    directory = directory or REPLAY_DIR
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.startswith('replay-') and name.endswith('.jsonl.gz'))
+
+def _read_replay_segment(path):
+    """Complete lines of one segment, including the open segment of a running process"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = b""
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 16):
+            try:
+                data += decompressor.decompress(chunk)
+            except zlib.error:
+                break
+    for line in data.split(b"\n")[:-1]:
+        try:
+            yield json.loads(line)
+        except ValueError:
+            continue
+
+def iter_replay_records(directory=None):
+    """Every record, oldest first"""
+    for path in list_replay_segments(directory):
+        yield from _read_replay_segment(path)
+
+def find_replay_record(record_id, directory=None):
+    for path in reversed(list_replay_segments(directory)):
+        for record in _read_replay_segment(path):
+            if record.get('id') == record_id:
+                return record
+    return None
+
+def replay_logged(kind):
+    """
+    Decorator for generation entry points taking inputs first: writes one record per
+    top-level call. Calls nested inside another logged call add to the outer record.
+    The record also feeds the plan analytics (5I), even with the replay log off.
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(inputs, *args, **kwargs):
+            if _replay_context.get() is not None:
+                return fn(inputs, *args, **kwargs)
+            context = _usage_context.get() or {}
+            record = {
+                'v': REPLAY_FORMAT_VERSION,
+                'id': f"{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}",
+                'ts': time.time(),
+                'kind': kind,
+                'profile_id': context.get('profile_id', ''),
+                'inputs': {k: v for k, v in dict(inputs or {}).items() if isinstance(v, (str, int, float, type(None)))},
+                'stages': [],
+                'notes': {},
+            }
+            token = _replay_context.set(record)
+            started = time.monotonic()
+            try:
+                result = fn(inputs, *args, **kwargs)
+                record['result'] = result
+                return result
+            except Exception as e:
+                record['error'] = f"{type(e).__name__}: {e}"
+                raise
+            finally:
+                _replay_context.reset(token)
+                record['seconds'] = round(time.monotonic() - started, 3)
+                if record['stages'] or record.get('result') is not None:
+                    finish_replay_record(record)
+                _notify_replay_listener(record)
+        return wrapper
+    return decorate
+
+def _notify_replay_listener(record):
+    listener = _replay_listener.get()
+    if listener is not None:
+        listener.append(record)
+
+def call_with_replay_records(fn, *args, **kwargs):
+    """Call fn and return (its result, the top-level job records finished during the call)"""
+    records = []
+    token = _replay_listener.set(records)
+    try:
+        return fn(*args, **kwargs), records
+    finally:
+        _replay_listener.reset(token)
+        for record in records:
+            _notify_replay_listener(record)
+
+def finish_replay_record(record):
+    """Feed a finished job record to the plan analytics and, if enabled, the replay log"""
+    record_plan_analytics(record)
+    if REPLAY_ENABLED:
+        write_replay_record(record)
+        _last_replay_id.set(record['id'])
+
+def replay_record_used_placeholders(record):
+    """True when any part of the job's result is placeholder text (failed call or unrepaired sections)"""
+    notes = record.get('notes', {})
+    return 'generation_error' in notes or any(v['fallback'] for v in notes.get('validation', []))
+
+def used_placeholders(result, records):
+    """
+    Whether a generation's result is (partly) placeholder text, from its job records.
+    Error messages are no guide: many are recovered from (text around the JSON, a
+    failed repair call, an untranslated section).
+    """
+    return result is None or not records or any(map(replay_record_used_placeholders, records))
+
+def note_replay(**fields):
+    """Attach facts about the current job (raw response, language, fallbacks, timings)"""
+    record = _replay_context.get()
+    if record is not None:
+        record['notes'].update(fields)
+
+def append_replay_note(name, value):
+    record = _replay_context.get()
+    if record is not None:
+        record['notes'].setdefault(name, []).append(value)
+
+def _replay_model_call(stage, model, prompt, text, seconds, error=None, cancelled=False):
+    record = _replay_context.get()
+    if record is None:
+        return
+    record['stages'].append({
+        'stage': stage,
+        'model': _model_label(model),
+        'thread': threading.current_thread().name,
+        'prompt': str(prompt),
+        'response': text or "",
+        'seconds': round(seconds, 3),
+        'error': f"{type(error).__name__}: {error}" if error is not None else None,
+        'cancelled': cancelled,
+    })
+
+def last_replay_id():
+    """ID of the last record written from this context, for "report a problem" references"""
+    return _last_replay_id.get()
+
 # --- 5. AI GENERATOR WITH STRICT LANGUAGE MATCHING ---
 def clean_json_string(json_string):
     """Clean the JSON string by removing invalid characters and fixing common issues"""
@@ -373,152 +1156,90 @@ def clean_json_string(json_string):
     
     return json_string
 
-def generate_lesson_content(subject, grade, quarter, content_std, perf_std, competency, 
-                           obj_cognitive=None, obj_psychomotor=None, obj_affective=None,
-                           lesson_topic=None):
-    try:
-        current_api_key = st.session_state.get('api_key') or st.session_state.get('saved_api_key')
-        
-        if not current_api_key:
-            st.error("❌ Please enter your Google Gemini API Key in the sidebar")
-            st.info("Click on '📋 How to Get Free API Key' button in sidebar for instructions")
-            return None
-        
-        genai.configure(api_key=current_api_key)
-        
-        model_options = ['gemini-2.5-flash', 'gemini-1.5-flash', 'gemini-pro']
-        model = None
-        
-        for model_name in model_options:
-            try:
-                model = genai.GenerativeModel(model_name)
-                test_response = model.generate_content("Hello")
-                if test_response:
-                    st.sidebar.success(f"✓ Using model: {model_name}")
-                    break
-            except Exception as e:
-                continue
-        
-        if not model:
-            model = genai.GenerativeModel('gemini-1.5-flash')
-        
-        user_provided_objectives = obj_cognitive and obj_psychomotor and obj_affective
-        user_provided_topic = lesson_topic and lesson_topic.strip()
-        
-        # --- DETECT LANGUAGE WITH IMPROVED LOGIC ---
-        detected_language = analyze_language_from_inputs(
-            content_std, perf_std, competency,
-            obj_cognitive, obj_psychomotor, obj_affective,
-            lesson_topic
-        )
-        
-        # Show language detection info
-        if detected_language == "filipino":
-            st.sidebar.info("🌍 Language Detected: FILIPINO")
-            st.sidebar.info("📝 AI will respond in PURE FILIPINO")
-        else:
-            st.sidebar.info("🌍 Language Detected: ENGLISH")
-            st.sidebar.info("📝 AI will respond in PURE ENGLISH")
-        
-        # Get strict language instruction
-        language_instruction = get_language_instruction(detected_language)
-        
-        # Create base prompt with language instruction
-        if user_provided_objectives or user_provided_topic:
-            prompt_parts = [
-                f"""You are an expert teacher from Manual National High School in the Division of Davao Del Sur, Region XI, Philippines.
-                Create a JSON object for a Daily Lesson Plan (DLP).
-                Subject: {subject}, Grade: {grade}, Quarter: {quarter}
-                Content Standard: {content_std}
-                Performance Standard: {perf_std}
-                Learning Competency: {competency}"""]
-            
-            # Add STRICT language instruction
-            prompt_parts.append(language_instruction)
-            
-            if user_provided_objectives:
-                prompt_parts.append(f"""
-                USER-PROVIDED OBJECTIVES:
-                - Cognitive: {obj_cognitive}
-                - Psychomotor: {obj_psychomotor}
-                - Affective: {obj_affective}
-                IMPORTANT: Use these exact objectives provided by the user. Do NOT modify them.""")
-            
-            if user_provided_topic:
-                prompt_parts.append(f"""
-                USER-PROVIDED LESSON TOPIC/CONTENT:
-                {lesson_topic}
-                IMPORTANT: Use this exact topic/content provided by the user. Do NOT modify it.""")
-            
-            prompt_parts.append(f"""
-            CRITICAL INSTRUCTIONS:
-            1. You MUST generate exactly 5 distinct MULTIPLE CHOICE assessment questions with A, B, C, D choices.
-            2. Each assessment question MUST follow this format: "question|A. choice1|B. choice2|C. choice3|D. choice4"
-            3. The correct answer should be included in the choices.
-            4. Return ONLY valid JSON format.
-            5. Do NOT use bullet points (•) or any markdown in the JSON values.
-            6. All string values must be properly quoted.
-            7. Do NOT include any explanations outside the JSON.
-            8. MATCH THE TEACHER'S LANGUAGE EXACTLY. If teacher used Filipino, use pure Filipino. If teacher used English, use pure English.
+LESSON_INPUT_FIELDS = (
+    'subject', 'grade', 'quarter', 'content_std', 'perf_std', 'competency',
+    'obj_cognitive', 'obj_psychomotor', 'obj_affective', 'lesson_topic', 'school'
+)
 
-            Return ONLY raw JSON. No markdown formatting.
-            Structure:
-            {{
-                "obj_1": "Cognitive objective",
-                "obj_2": "Psychomotor objective",
-                "obj_3": "Affective objective",
-                "topic": "The main topic (include math equations like 3x^2 if needed)",
-                "integration_within": "Topic within same subject",
-                "integration_across": "Topic across other subject",
-                "resources": {{
-                    "guide": "Teacher Guide reference",
-                    "materials": "Learner Materials reference",
-                    "textbook": "Textbook reference",
-                    "portal": "Learning Resource Portal reference",
-                    "other": "Other Learning Resources"
-                }},
-                "procedure": {{
-                    "review": "Review activity",
-                    "purpose_situation": "Real-life situation motivation description",
-                    "visual_prompt": "A simple 3-word visual description. Example: 'Red Apple Fruit'. NO sentences.",
-                    "vocabulary": "5 terms with definitions",
-                    "activity_main": "Main activity description",
-                    "explicitation": "Detailed explanation of the concept with clear explanations and TWO specific examples with detailed explanations",
-                    "group_1": "Group 1 task",
-                    "group_2": "Group 2 task",
-                    "group_3": "Group 3 task",
-                    "generalization": "Reflection questions"
-                }},
-                "evaluation": {{
-                    "assess_q1": "Question 1 with choices in format: question|A. choice1|B. choice2|C. choice3|D. choice4",
-                    "assess_q2": "Question 2 with choices in format: question|A. choice1|B. choice2|C. choice3|D. choice4",
-                    "assess_q3": "Question 3 with choices in format: question|A. choice1|B. choice2|C. choice3|D. choice4",
-                    "assess_q4": "Question 4 with choices in format: question|A. choice1|B. choice2|C. choice3|D. choice4",
-                    "assess_q5": "Question 5 with choices in format: question|A. choice1|B. choice2|C. choice3|D. choice4",
-                    "assignment": "Assignment task",
-                    "remarks": "Remarks",
-                    "reflection": "Reflection"
-                }}
-            }}
-            """)
-            
-            prompt = "\n".join(prompt_parts)
-        else:
-            # Generate everything automatically with strict language matching
-            prompt = f"""
-            You are an expert teacher from Manual National High School in the Division of Davao Del Sur, Region XI, Philippines.
-            Create a JSON object for a Daily Lesson Plan (DLP).
-            Subject: {subject}, Grade: {grade}, Quarter: {quarter}
-            Content Standard: {content_std}
-            Performance Standard: {perf_std}
-            Learning Competency: {competency}
+MODEL_OPTIONS = ['gemini-2.5-flash', 'gemini-1.5-flash', 'gemini-pro']
+
+# Alternative Gemini endpoint (e.g. a local stub for load tests)
+GEMINI_API_ENDPOINT = os.environ.get("DLP_GEMINI_ENDPOINT")
+GEMINI_CLIENT_CACHE_SIZE = 256
+
+# Every model is built from a client bound to one API key. A process-wide key
+# (genai.configure in the old SDK) could be swapped by another teacher's request
+# between creating a model and its first call.
+_gemini_clients = shared('gemini_clients', OrderedDict)
+_gemini_clients_lock = shared('gemini_clients_lock', threading.Lock)
+# HTTP responses opened while a stream is being read on this thread (see GeminiModel)
+_stream_responses = shared('stream_responses', threading.local)
+
+def _remember_stream_response(response):
+    """httpx response hook: the SDK does not expose a stream's response, so it can't close it"""
+    opened = getattr(_stream_responses, 'opened', None)
+    if opened is not None:
+        opened.append(response)
+
+def gemini_client(api_key):
+    """The google.genai client for one API key (reused, so its connections are too)"""
+    digest = hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+    with _gemini_clients_lock:
+        client = _gemini_clients.get(digest)
+        if client is not None:
+            _gemini_clients.move_to_end(digest)
+            return client
+    http_options = genai_types.HttpOptions(client_args={'event_hooks': {'response': [_remember_stream_response]}})
+    if GEMINI_API_ENDPOINT:
+        http_options.base_url = (GEMINI_API_ENDPOINT if re.match(r'https?://', GEMINI_API_ENDPOINT)
+                                 else f"https://{GEMINI_API_ENDPOINT}")
+    client = genai.Client(api_key=api_key, http_options=http_options)
+    with _gemini_clients_lock:
+        client = _gemini_clients.setdefault(digest, client)
+        while len(_gemini_clients) > GEMINI_CLIENT_CACHE_SIZE:
+            _gemini_clients.popitem(last=False)
+    return client
 
-            {language_instruction}
+class GeminiModel:
+    """One model on one key's client, with the generate_content(prompt, stream) call the generators use"""
+    
+    def __init__(self, client, model_name, system_instruction=None, cached_content=None):
+        self.client = client
+        self.model_name = model_name
+        self.config = genai_types.GenerateContentConfig(
+            system_instruction=system_instruction, cached_content=cached_content
+        ) if system_instruction or cached_content else None
+    
+    def generate_content(self, prompt, stream=False):
+        """A response, or with stream=True an iterator of partial responses (close() ends the request)"""
+        if stream:
+            return self._stream(prompt)
+        return self.client.models.generate_content(model=self.model_name, contents=prompt, config=self.config)
+    
+    def _stream(self, prompt):
+        opened = []
+        chunks = self.client.models.generate_content_stream(model=self.model_name, contents=prompt, config=self.config)
+        try:
+            while True:
+                _stream_responses.opened = opened
+                try:
+                    chunk = next(chunks, None)
+                finally:
+                    _stream_responses.opened = None
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            # Dropping a stream early must end the HTTP response, not just stop reading it
+            chunks.close()
+            for response in opened:
+                response.close()
 
+PROMPT_JSON_INSTRUCTIONS = """
             CRITICAL INSTRUCTIONS:
             1. You MUST generate exactly 5 distinct MULTIPLE CHOICE assessment questions with A, B, C, D choices.
-            2. Each assessment question MUST follow this format: "question|A. choice1|B. choice2|C. choice3|D. choice4"
-            3. The correct answer should be included in the choices.
+            2. Each assessment question MUST follow this format: "question|A. choice1|B. choice2|C. choice3|D. choice4|answer"
+            3. The correct answer should be included in the choices; "answer" is its letter (A, B, C or D).
             4. Return ONLY valid JSON format.
             5. Do NOT use bullet points (•) or any markdown in the JSON values.
             6. All string values must be properly quoted.
@@ -527,21 +1248,21 @@ def generate_lesson_content(subject, grade, quarter, content_std, perf_std, comp
 
             Return ONLY raw JSON. No markdown formatting.
             Structure:
-            {{
+            {
                 "obj_1": "Cognitive objective",
                 "obj_2": "Psychomotor objective",
                 "obj_3": "Affective objective",
                 "topic": "The main topic (include math equations like 3x^2 if needed)",
                 "integration_within": "Topic within same subject",
                 "integration_across": "Topic across other subject",
-                "resources": {{
+                "resources": {
                     "guide": "Teacher Guide reference",
                     "materials": "Learner Materials reference",
                     "textbook": "Textbook reference",
                     "portal": "Learning Resource Portal reference",
                     "other": "Other Learning Resources"
-                }},
-                "procedure": {{
+                },
+                "procedure": {
                     "review": "Review activity",
                     "purpose_situation": "Real-life situation motivation description",
                     "visual_prompt": "A simple 3-word visual description. Example: 'Red Apple Fruit'. NO sentences.",
@@ -552,62 +1273,486 @@ def generate_lesson_content(subject, grade, quarter, content_std, perf_std, comp
                     "group_2": "Group 2 task",
                     "group_3": "Group 3 task",
                     "generalization": "Reflection questions"
-                }},
-                "evaluation": {{
-                    "assess_q1": "Question 1 with choices in format: question|A. choice1|B. choice2|C. choice3|D. choice4",
-                    "assess_q2": "Question 2 with choices in format: question|A. choice1|B. choice2|C. choice3|D. choice4",
-                    "assess_q3": "Question 3 with choices in format: question|A. choice1|B. choice2|C. choice3|D. choice4",
-                    "assess_q4": "Question 4 with choices in format: question|A. choice1|B. choice2|C. choice3|D. choice4",
-                    "assess_q5": "Question 5 with choices in format: question|A. choice1|B. choice2|C. choice3|D. choice4",
+                },
+                "evaluation": {
+                    "assess_q1": "Question 1 with choices in format: question|A. choice1|B. choice2|C. choice3|D. choice4|answer",
+                    "assess_q2": "Question 2 with choices in format: question|A. choice1|B. choice2|C. choice3|D. choice4|answer",
+                    "assess_q3": "Question 3 with choices in format: question|A. choice1|B. choice2|C. choice3|D. choice4|answer",
+                    "assess_q4": "Question 4 with choices in format: question|A. choice1|B. choice2|C. choice3|D. choice4|answer",
+                    "assess_q5": "Question 5 with choices in format: question|A. choice1|B. choice2|C. choice3|D. choice4|answer",
                     "assignment": "Assignment task",
                     "remarks": "Remarks",
                     "reflection": "Reflection"
-                }}
-            }}
+                }
+            }
             """
-        
-        response = model.generate_content(prompt)
-        text = response.text
-        
-        cleaned_text = clean_json_string(text)
-        
-        st.sidebar.text_area("Raw AI Response", cleaned_text[:1000], height=200)
-        
-        try:
-            ai_data = json.loads(cleaned_text)
-            
-            if user_provided_topic and 'topic' in ai_data:
-                ai_data['topic'] = lesson_topic
-                
-            return ai_data
-        except json.JSONDecodeError as je:
-            st.error(f"JSON Parsing Error: {je}")
-            st.sidebar.error("Failed to parse JSON. Attempting manual fix...")
-            
-            try:
-                json_pattern = r'\{.*\}'
-                match = re.search(json_pattern, cleaned_text, re.DOTALL)
-                if match:
-                    json_str = match.group(0)
-                    json_str = re.sub(r',\s*}', '}', json_str)
-                    json_str = re.sub(r',\s*]', ']', json_str)
-                    ai_data = json.loads(json_str)
-                    
-                    if user_provided_topic and 'topic' in ai_data:
-                        ai_data['topic'] = lesson_topic
-                        
-                    return ai_data
-            except Exception as e2:
-                st.error(f"Manual JSON extraction also failed: {e2}")
-                return create_fallback_data(subject, grade, quarter, content_std, perf_std, competency, lesson_topic, detected_language)
-        
-    except Exception as e:
-        st.error(f"AI Generation Error: {str(e)}")
-        return create_fallback_data(subject, grade, quarter, content_std, perf_std, competency, lesson_topic, "english")
 
-def create_fallback_data(subject, grade, quarter, content_std, perf_std, competency, lesson_topic=None, language="english"):
-    """Create fallback data in case AI generation fails"""
-    topic = lesson_topic if lesson_topic else f"Introduction to {subject}"
+# Same structure without "resources", for lessons whose resources come from the catalog
+PROMPT_JSON_INSTRUCTIONS_NO_RESOURCES = re.sub(r'\n\s*"resources": \{[^}]*\},', '', PROMPT_JSON_INSTRUCTIONS)
+
+# Pasted inputs (often whole curriculum guide pages) are compacted before they
+# reach the prompt: formatting noise and bullets go, hard-wrapped lines are
+# rejoined, repeated sentences are dropped and each field is held to a size
+# limit. An oversized lesson topic is summarized locally (extractive: the
+# sentences with the most frequent content words). The result is one line per
+# field, so compacting again changes nothing. Only markup that wraps text
+# (**bold**, __bold__) is unwrapped, so answer blanks (____) survive, and a bare
+# number line only counts as a page number next to a page break or blank line.
+# The plan's topic is the lesson topic as the teacher typed it; the compacted
+# one only goes to the prompt.
+INPUT_LIMITS = {
+    'content_std': 800, 'perf_std': 800, 'competency': 600,
+    'obj_cognitive': 400, 'obj_psychomotor': 400, 'obj_affective': 400,
+    'lesson_topic': 1200,
+}
+INPUT_LABELS = {
+    'content_std': "Content standard", 'perf_std': "Performance standard", 'competency': "Competency",
+    'obj_cognitive': "Cognitive objective", 'obj_psychomotor': "Psychomotor objective",
+    'obj_affective': "Affective objective", 'lesson_topic': "Lesson topic",
+}
+INPUT_NOISE_PATTERN = re.compile(r'[\u200b-\u200f\u2060\ufeff\x00-\x08\x0b-\x1f\x7f]|`+|^#+\s*', re.MULTILINE)
+INPUT_EMPHASIS_PATTERN = re.compile(r'(?<![\w*])(\*\*|__)(?![\s*_])([^*_\n]+?)(?<!\s)\1(?![\w*])')
+INPUT_HEADING_PATTERN = re.compile(r'^\s*(?:#+\s|(\*\*|__)(?![\s*_])[^*_\n]+(?<!\s)\1\s*$)')
+INPUT_BULLET_PATTERN = re.compile(r'^(?:[•●○◦▪▫■□➢➤►▶✓✔\-–—*>]+|\(?\d{1,2}[.)]|\(?[a-z][.)])\s+')
+INPUT_PAGE_LINE_PATTERN = re.compile(r'^(?:page\s*\d+(?:\s*of\s*\d+)?|\d{1,4}\s*of\s*\d{1,4}|[-–—]\s*\d{1,4}\s*[-–—])$', re.IGNORECASE)
+INPUT_NUMBER_LINE_PATTERN = re.compile(r'^\d{1,4}$')
+SUMMARY_STOPWORDS = frozenset((
+    'that', 'this', 'with', 'from', 'their', 'they', 'will', 'have', 'into', 'about', 'which', 'when', 'were',
+    'learners', 'learner', 'students', 'pupils', 'para', 'kanilang', 'nito', 'upang', 'bilang', 'ating', 'mag-aaral',
+))
+
+def _sentence_key(sentence):
+    return re.sub(r'\W+', '', sentence.lower())
+
+def _split_sentences(text):
+    return [s for s in re.split(r'(?<=[.!?])\s+', text) if s]
+
+def compact_input_text(text):
+    """One clean line: noise and bullets removed, wrapped lines rejoined, repeated sentences dropped"""
+    items, continues = [], False
+    # A form feed is a page break: it separates lines like a blank line does
+    lines = str(text).replace('\u00a0', ' ').replace('\t', ' ').replace('\f', '\n\n').splitlines()
+    for n, line in enumerate(lines):
+        heading = INPUT_HEADING_PATTERN.match(line)
+        line = INPUT_EMPHASIS_PATTERN.sub(r'\2', INPUT_NOISE_PATTERN.sub('', line))
+        line = re.sub(r'\s+', ' ', line).strip()
+        beside_break = any(0 <= i < len(lines) and not lines[i].strip() for i in (n - 1, n + 1))
+        if not line or INPUT_PAGE_LINE_PATTERN.match(line) or (beside_break and INPUT_NUMBER_LINE_PATTERN.match(line)):
+            continues = False
+            continue
+        bullet = INPUT_BULLET_PATTERN.match(line)
+        if bullet:
+            line = line[bullet.end():]
+        if items and continues and not bullet:
+            items[-1] += " " + line   # A line wrapped by the PDF or word processor
+        else:
+            items.append(line)
+        continues = not heading and not re.search(r'[.!?:;]$', line)
+
+    seen, kept = set(), []
+    for item in items:
+        sentences = []
+        for sentence in _split_sentences(item):
+            key = _sentence_key(sentence)
+            if key and key not in seen:
+                seen.add(key)
+                sentences.append(sentence)
+        if sentences:
+            kept.append(" ".join(sentences))
+    return "".join(
+        item if n == 0 else (" " if re.search(r'[.!?]$', kept[n - 1]) else "; ") + item
+        for n, item in enumerate(kept)
+    )
+
+def _truncate_text(text, limit):
+    """Cut at the last sentence (or word) boundary within limit"""
+    if len(text) <= limit:
+        return text
+    cut = text[:limit - 1]
+    end = max(cut.rfind('. '), cut.rfind('! '), cut.rfind('? '))
+    if end >= limit // 2:
+        return cut[:end + 1]
+    return cut.rsplit(' ', 1)[0].rstrip(' ,;:') + "…"
+
+def summarize_text(text, limit):
+    """Extractive summary within limit: highest-scoring sentences, kept in their original order"""
+    sentences = _split_sentences(text)
+    words_of = [[w for w in re.findall(r'[^\W\d_]{4,}', s.lower()) if w not in SUMMARY_STOPWORDS] for s in sentences]
+    frequency = {}
+    for words in words_of:
+        for word in set(words):
+            frequency[word] = frequency.get(word, 0) + 1
+    ranked = sorted(range(len(sentences)),
+                    key=lambda i: -sum(frequency[w] for w in words_of[i]) / (len(words_of[i]) + 1) ** 0.5)
+    chosen, size = set(), 0
+    for i in ranked:
+        if size + len(sentences[i]) + 1 <= limit:
+            chosen.add(i)
+            size += len(sentences[i]) + 1
+    if not chosen:
+        return _truncate_text(text, limit)
+    return " ".join(sentences[i] for i in sorted(chosen))
+
+def compact_lesson_input(field, value, warnings=None):
+    """Compacted text of one input field, held to INPUT_LIMITS; size warnings go to warnings"""
+    text = compact_input_text(value)
+    limit = INPUT_LIMITS.get(field)
+    if limit and len(text) > limit:
+        label = INPUT_LABELS[field]
+        if field == 'lesson_topic':
+            compacted = summarize_text(text, limit)
+            message = f"📝 {label} was {len(text):,} characters; a {len(compacted):,}-character summary is used"
+        else:
+            compacted = _truncate_text(text, limit)
+            message = f"✂️ {label} was {len(text):,} characters; only the first {len(compacted):,} are used"
+        text = compacted
+        if warnings is not None:
+            warnings.append(message)
+    return text
+
+def normalize_lesson_inputs(inputs, warnings=None):
+    """
+    Return a dict with every lesson input key; text fields are compacted (see
+    compact_lesson_input, size warnings go to warnings), blank optional fields
+    become None and a known competency code is expanded to its curriculum guide form.
+    A lesson topic is also kept as typed, under lesson_topic_as_entered.
+    """
+    normalized = {}
+    for field in LESSON_INPUT_FIELDS:
+        value = inputs.get(field)
+        if isinstance(value, str) and field in INPUT_LIMITS:
+            value = compact_lesson_input(field, value, warnings)
+        if isinstance(value, str) and not value.strip():
+            value = None
+        normalized[field] = value
+    if normalized['lesson_topic']:
+        normalized['lesson_topic_as_entered'] = (
+            inputs.get('lesson_topic_as_entered') or str(inputs['lesson_topic']).strip()
+        )
+    return canonicalize_competency_inputs(normalized)
+
+def normalize_job_inputs(inputs, on_progress=None):
+    """normalize_lesson_inputs for a generation job: size warnings go to on_progress and the replay log"""
+    warnings = []
+    inputs = normalize_lesson_inputs(inputs, warnings)
+    for message in warnings:
+        if on_progress:
+            on_progress(message, "warning")
+    if warnings:
+        note_replay(input_warnings=warnings)
+    return inputs
+
+def detect_inputs_language(inputs):
+    return analyze_language_from_inputs(
+        inputs['content_std'], inputs['perf_std'], inputs['competency'],
+        inputs['obj_cognitive'], inputs['obj_psychomotor'], inputs['obj_affective'],
+        inputs['lesson_topic']
+    )
+
+def build_lesson_prompt(inputs, language, with_resources=True):
+    """Build the DLP prompt from normalized inputs. with_resources=False leaves out the resources section."""
+    user_provided_objectives = inputs['obj_cognitive'] and inputs['obj_psychomotor'] and inputs['obj_affective']
+    user_provided_topic = inputs['lesson_topic'] and inputs['lesson_topic'].strip()
+    
+    prompt_parts = [
+        f"""{school_intro(inputs)}
+            Create a JSON object for a Daily Lesson Plan (DLP).
+            Subject: {inputs['subject']}, Grade: {inputs['grade']}, Quarter: {inputs['quarter']}
+            Content Standard: {inputs['content_std']}
+            Performance Standard: {inputs['perf_std']}
+            Learning Competency: {inputs['competency']}"""]
+    
+    # Add STRICT language instruction
+    prompt_parts.append(get_language_instruction(language))
+    
+    if user_provided_objectives:
+        prompt_parts.append(f"""
+            USER-PROVIDED OBJECTIVES:
+            - Cognitive: {inputs['obj_cognitive']}
+            - Psychomotor: {inputs['obj_psychomotor']}
+            - Affective: {inputs['obj_affective']}
+            IMPORTANT: Use these exact objectives provided by the user. Do NOT modify them.""")
+    
+    if user_provided_topic:
+        prompt_parts.append(f"""
+            USER-PROVIDED LESSON TOPIC/CONTENT:
+            {inputs['lesson_topic']}
+            IMPORTANT: Use this exact topic/content provided by the user. Do NOT modify it.""")
+    
+    prompt_parts.append(PROMPT_JSON_INSTRUCTIONS if with_resources else PROMPT_JSON_INSTRUCTIONS_NO_RESOURCES)
+    
+    return "\n".join(prompt_parts)
+
+def parse_ai_response(text, on_error=None):
+    """
+    Parse the model response into ai_data. Tries the cleaned text first, then the
+    outermost {...} block. Returns None if nothing parseable is found.
+    """
+    cleaned_text = clean_json_string(text)
+    
+    try:
+        return json.loads(cleaned_text)
+    except json.JSONDecodeError as je:
+        if on_error:
+            on_error(f"JSON Parsing Error: {je}")
+    
+    try:
+        match = re.search(r'\{.*\}', cleaned_text, re.DOTALL)
+        if match:
+            json_str = match.group(0)
+            json_str = re.sub(r',\s*}', '}', json_str)
+            json_str = re.sub(r',\s*]', ']', json_str)
+            return json.loads(json_str)
+    except Exception as e2:
+        if on_error:
+            on_error(f"Manual JSON extraction also failed: {e2}")
+    
+    return None
+
+def _parse_json_member(fragment):
+    for candidate in (fragment, clean_json_string(fragment)):
+        try:
+            return json.loads("{" + candidate + "}")
+        except ValueError:
+            continue
+    return None
+
+def iter_json_sections(chunks):
+    """
+    Yield (key, value) for each top-level member of a streamed JSON object as soon
+    as it is complete. Text before the first "{" (e.g. a ```json fence) is skipped.
+    Members that don't parse are skipped; the caller parses the full text at the end.
+    The whole chunk iterable is always consumed.
+    """
+    buffer = ""
+    pos = 0
+    depth = 0
+    in_string = escape = done = False
+    member_start = None
+    
+    for chunk in chunks:
+        if done:
+            continue
+        buffer += chunk
+        
+        while pos < len(buffer) and not done:
+            ch = buffer[pos]
+            member_end = None
+            
+            if member_start is None:
+                if ch == '{':
+                    depth = 1
+                    member_start = pos + 1
+            elif in_string:
+                if escape:
+                    escape = False
+                elif ch == '\\':
+                    escape = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch in '{[':
+                depth += 1
+            elif ch in '}]':
+                depth -= 1
+                if depth == 0:
+                    member_end = pos
+                    done = True
+            elif ch == ',' and depth == 1:
+                member_end = pos
+            
+            if member_end is not None:
+                fragment = buffer[member_start:member_end].strip()
+                member_start = member_end + 1
+                parsed = _parse_json_member(fragment) if fragment else None
+                if parsed:
+                    yield from parsed.items()
+            pos += 1
+
+def _stream_response_text(model, prompt, on_section):
+    """Stream the model response, reporting each completed top-level JSON member"""
+    parts = []
+    
+    def text_chunks():
+        for chunk in tracked_stream(model, prompt, 'lesson'):
+            text = _response_text(chunk)
+            parts.append(text)
+            yield text
+    
+    for key, value in iter_json_sections(text_chunks()):
+        on_section(key, value)
+    
+    return "".join(parts)
+
+def resolve_model(on_progress=None, api_key=None):
+    """
+    Probe the model list and return the first GeminiModel (on api_key's client) that
+    answers. The answer is cached per API key, so the probe runs once per key.
+    """
+    client = gemini_client(api_key)
+    cached_name = get_resolved_model(api_key)
+    if cached_name:
+        if on_progress:
+            on_progress(f"✓ Using model: {cached_name}", "success")
+        return GeminiModel(client, cached_name)
+    
+    for model_name in MODEL_OPTIONS:
+        try:
+            model = GeminiModel(client, model_name)
+            test_response = tracked_generate(model, "Hello", 'probe')
+            if test_response:
+                if on_progress:
+                    on_progress(f"✓ Using model: {model_name}", "success")
+                remember_resolved_model(api_key, model_name)
+                return model
+        except Exception:
+            continue
+    
+    return GeminiModel(client, 'gemini-1.5-flash')
+
+@replay_logged('lesson')
+def generate_lesson_plan(inputs, api_key, on_progress=None, on_error=None, on_raw_response=None,
+                         hedge=False, on_section=None):
+    """
+    UI-independent generator: inputs dict -> ai_data dict.
+    
+    on_progress(message, level) receives status updates (level: info/success/warning),
+    on_error(message) receives error messages and on_raw_response(text) the cleaned
+    model output. Invalid sections get a targeted repair call; create_fallback_data
+    is used only for what is still invalid, or when the model fails entirely.
+    With hedge=True a slow primary model is raced against a secondary one.
+    on_section(key, value) streams the response and fires as each top-level JSON
+    member arrives (ignored when hedging).
+    Returns None only when no API key is given.
+    """
+    inputs = normalize_job_inputs(inputs, on_progress)
+    
+    if not api_key:
+        if on_error:
+            on_error("❌ Please enter your Google Gemini API Key in the sidebar")
+        return None
+    
+    detected_language = "english"
+    
+    try:
+        set_usage_context(api_key=api_key)
+        
+        model = resolve_model(on_progress, api_key)
+        
+        # --- DETECT LANGUAGE WITH IMPROVED LOGIC ---
+        detected_language = detect_inputs_language(inputs)
+        
+        if on_progress:
+            if detected_language == "filipino":
+                on_progress("🌍 Language Detected: FILIPINO", "info")
+                on_progress("📝 AI will respond in PURE FILIPINO", "info")
+            else:
+                on_progress("🌍 Language Detected: ENGLISH", "info")
+                on_progress("📝 AI will respond in PURE ENGLISH", "info")
+        
+        catalog_resources = lookup_resources(inputs)
+        catalog_complete = resources_complete(catalog_resources)
+        if catalog_resources:
+            if on_progress:
+                on_progress("📚 Learning resources taken from the school catalog" if catalog_complete else
+                            "📚 Some learning resources taken from the school catalog", "info")
+            if on_section and catalog_complete:
+                on_section('resources', catalog_resources)
+            elif on_section:
+                streamed_section = on_section
+                
+                def on_section(key, value):
+                    if key == 'resources':
+                        value = merge_catalog_resources(value, catalog_resources)
+                    streamed_section(key, value)
+        prompt = build_lesson_prompt(inputs, detected_language, with_resources=not catalog_complete)
+        note_replay(normalized_inputs=inputs, language=detected_language, catalog_resources=catalog_resources, hedge=hedge,
+                    streamed=bool(on_section) and not hedge)
+        
+        if hedge:
+            text = generate_text_hedged(model, prompt, is_valid=lambda t: parse_ai_response(t) is not None,
+                                        stage='lesson')
+        elif on_section:
+            text = _stream_response_text(model, prompt, on_section)
+        else:
+            text = _response_text(tracked_generate(model, prompt, 'lesson'))
+        
+        if on_raw_response:
+            on_raw_response(clean_json_string(text))
+        
+        started = time.monotonic()
+        ai_data = parse_ai_response(text, on_error)
+        note_replay(raw_response=text, parsed=ai_data is not None, parse_seconds=round(time.monotonic() - started, 4))
+        
+        # Only the missing or invalid sections are requested again
+        return validate_and_repair(model, inputs, detected_language, ai_data, on_progress, on_error,
+                                   resources=catalog_resources)
+        
+    except Exception as e:
+        # The cached model may be the problem (retired, quota); probe again next time
+        forget_resolved_model(api_key)
+        if on_error:
+            on_error(f"AI Generation Error: {str(e)}")
+        note_replay(generation_error=f"{type(e).__name__}: {e}", fallback='all')
+        fallback = create_fallback_data(
+            inputs['subject'], inputs['grade'], inputs['quarter'],
+            inputs['content_std'], inputs['perf_std'], inputs['competency'],
+            inputs['lesson_topic'], "english"
+        )
+        fallback['resources'] = merge_catalog_resources(fallback['resources'], lookup_resources(inputs))
+        return fallback
+
+def _streamlit_progress(message, level="info"):
+    getattr(st.sidebar, level, st.sidebar.info)(message)
+
+def _streamlit_raw_response(text):
+    st.sidebar.text_area("Raw AI Response", text[:1000], height=200)
+
+def generate_lesson_content(subject, grade, quarter, content_std, perf_std, competency, 
+                           obj_cognitive=None, obj_psychomotor=None, obj_affective=None,
+                           lesson_topic=None, on_section=None, dual_language=False, coalesce=True):
+    """
+    Streamlit wrapper around generate_lesson_plan. With dual_language=True it returns
+    {language: ai_data} from generate_dual_language_plans instead. With coalesce=True
+    an identical request already running for another teacher is shared (see 5J).
+    """
+    current_api_key = st.session_state.get('api_key') or st.session_state.get('saved_api_key')
+    
+    if not current_api_key:
+        st.error("❌ Please enter your Google Gemini API Key in the sidebar")
+        st.info("Click on '📋 How to Get Free API Key' button in sidebar for instructions")
+        return None
+    
+    inputs = {
+        'subject': subject, 'grade': grade, 'quarter': quarter,
+        'content_std': content_std, 'perf_std': perf_std, 'competency': competency,
+        'obj_cognitive': obj_cognitive, 'obj_psychomotor': obj_psychomotor,
+        'obj_affective': obj_affective, 'lesson_topic': lesson_topic,
+        'school': st.session_state.get('school_id')
+    }
+    
+    generator = generate_dual_language_plans if dual_language else generate_lesson_plan
+    hedge = st.session_state.get('hedge_requests', False)
+    
+    def generate(on_error, on_section):
+        return generator(
+            inputs, current_api_key,
+            on_progress=_streamlit_progress,
+            on_error=on_error,
+            on_raw_response=_streamlit_raw_response,
+            hedge=hedge,
+            on_section=on_section
+        )
+    
+    if not (coalesce and COALESCE_ENABLED):
+        return generate(st.error, on_section)
+    return coalesced_generation(generation_coalesce_key(inputs, dual_language), generate,
+                                on_progress=_streamlit_progress, on_error=st.error, on_section=on_section)
+
+def create_fallback_data(subject, grade, quarter, content_std, perf_std, competency, lesson_topic=None, language="english"):
+    """Create fallback data in case AI generation fails"""
+    topic = lesson_topic if lesson_topic else f"Introduction to {subject}"
     
     if language == "filipino":
         return {
@@ -686,364 +1831,4013 @@ def create_fallback_data(subject, grade, quarter, content_std, perf_std, compete
             }
         }
 
-# --- 6. IMAGE FETCHER ---
-def fetch_ai_image(keywords):
-    if not keywords: keywords = "school_classroom"
-    clean_prompt = re.sub(r'[\n\r\t]', ' ', str(keywords))
-    clean_prompt = re.sub(r'[^a-zA-Z0-9 ]', '', clean_prompt).strip()
-    
-    encoded_prompt = urllib.parse.quote(clean_prompt)
-    seed = random.randint(1, 9999)
-    url = f"https://image.pollinations.ai/prompt/{encoded_prompt}?width=600&height=350&nologo=true&seed={seed}"
-    url = url.strip()
+# --- 5A. QUARTER PLANNER ---
+QUARTER_PLAN_MAX_WORKERS = 4
+QUARTER_CACHE_TTL_SECONDS = 900
+
+def build_quarter_outline_prompt(plan_inputs, competencies, language):
+    """One call that outlines the whole quarter so lessons build on each other"""
+    numbered = "\n".join(f"{n}. {comp}" for n, comp in enumerate(competencies, 1))
+    return f"""{school_intro(plan_inputs)}
+            Plan a coherent sequence of Daily Lesson Plans for one quarter.
+            Subject: {plan_inputs['subject']}, Grade: {plan_inputs['grade']}, Quarter: {plan_inputs['quarter']}
+            Content Standard: {plan_inputs['content_std']}
+            Performance Standard: {plan_inputs['perf_std']}
+            
+            Learning Competencies, in teaching order:
+            {numbered}
+            
+            {get_language_instruction(language)}
+            
+            For EACH competency, in the same order, give the lesson topic and a 1-2 sentence
+            summary of what learners will know or be able to do after that lesson.
+            Later lessons must build on earlier ones.
+            
+            Return ONLY raw JSON. No markdown formatting.
+            Structure:
+            {{"lessons": [{{"competency": "...", "topic": "...", "summary": "..."}}]}}
+            """
+
+def parse_quarter_outline(text, competencies):
+    """Parse the outline response; always returns one entry per competency"""
+    data = parse_ai_response(text) or {}
+    lessons = data.get('lessons', []) if isinstance(data, dict) else data
+    if not isinstance(lessons, list):
+        lessons = []
     
-    try:
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        response = requests.get(url, headers=headers, timeout=10)
-        if response.status_code == 200:
-            return io.BytesIO(response.content)
-    except Exception:
-        return None
-    return None
+    outline = []
+    for i, comp in enumerate(competencies):
+        entry = lessons[i] if i < len(lessons) and isinstance(lessons[i], dict) else {}
+        outline.append({
+            'competency': comp,
+            'topic': entry.get('topic') or comp,
+            'summary': entry.get('summary') or entry.get('topic') or comp
+        })
+    return outline
 
-# --- 7. DOCX HELPERS ---
-def set_cell_background(cell, color_hex):
-    """Sets the background color of a table cell."""
-    shading_elm = parse_xml(r'<w:shd {} w:fill="{}"/>'.format(nsdecls('w'), color_hex))
-    cell._tc.get_or_add_tcPr().append(shading_elm)
+def build_quarter_context(plan_inputs, outline, language):
+    """Shared prefix for every lesson expansion (sent once and cached)"""
+    outline_text = "\n".join(
+        f"Lesson {n}: {lesson['topic']} (Competency: {lesson['competency']}) - {lesson['summary']}"
+        for n, lesson in enumerate(outline, 1)
+    )
+    return "\n".join([
+        f"""{school_intro(plan_inputs)}
+            You are writing a sequence of Daily Lesson Plans (DLP) for one quarter.
+            Subject: {plan_inputs['subject']}, Grade: {plan_inputs['grade']}, Quarter: {plan_inputs['quarter']}
+            Content Standard: {plan_inputs['content_std']}
+            Performance Standard: {plan_inputs['perf_std']}
+            
+            QUARTER OUTLINE:
+            {outline_text}""",
+        get_language_instruction(language),
+        "Each request names one lesson of the outline. Create the JSON object for that lesson only.",
+        PROMPT_JSON_INSTRUCTIONS
+    ])
 
-def format_text(paragraph, text):
+def build_lesson_expansion_prompt(number, outline, with_resources=True):
+    """Per-lesson suffix; the shared quarter context is the cached prefix"""
+    lesson = outline[number - 1]
+    parts = [
+        f"Write the DLP for Lesson {number} of {len(outline)}.",
+        f"Learning Competency: {lesson['competency']}",
+        f"Topic: {lesson['topic']}"
+    ]
+    if not with_resources:
+        parts.append('Leave out "resources"; they are filled in from the school\'s catalog.')
+    if number > 1:
+        previous = outline[number - 2]
+        parts.append(f"Previous lesson ({previous['topic']}): {previous['summary']}")
+        parts.append("IMPORTANT: procedure.review (Activating Prior Knowledge) MUST recall the previous lesson above.")
+    else:
+        parts.append("This is the first lesson of the quarter; procedure.review should activate knowledge from the previous grade level.")
+    if number < len(outline):
+        parts.append(f"Next lesson: {outline[number]['topic']}. The assignment may prepare learners for it.")
+    return "\n".join(parts)
+
+def _create_quarter_model(model, context):
     """
-    Parses text for ^ (superscript) and _ (subscript).
+    Model whose system instruction is the shared quarter context. Uses an explicit
+    context cache when the API accepts it (large enough prefix, supported model);
+    otherwise Gemini's implicit prefix caching still applies. Returns (model, cache).
     """
-    if not text:
-        return
+    try:
+        cache = model.client.caches.create(model=model.model_name, config=genai_types.CreateCachedContentConfig(
+            display_name="dlp-quarter-plan",
+            system_instruction=context,
+            ttl=f"{QUARTER_CACHE_TTL_SECONDS}s"
+        ))
+        if not cache.name:
+            raise ValueError("the API returned no cache name")
+        return GeminiModel(model.client, model.model_name, cached_content=cache.name), cache
+    except Exception:
+        return GeminiModel(model.client, model.model_name, system_instruction=context), None
 
-    pattern = r"([^\^_]*)(([\^_])([0-9a-zA-Z\-]+))(.*)"
-    current_text = str(text)
+@replay_logged('quarter')
+def plan_quarter(plan_inputs, competencies, api_key, on_progress=None, on_error=None,
+                 on_lesson=None, max_workers=QUARTER_PLAN_MAX_WORKERS):
+    """
+    Generate a coherent DLP sequence for a quarter: one outline call, then one
+    expansion call per lesson sharing a cached prefix, run concurrently.
     
-    if "^" not in current_text and "_" not in current_text:
-        paragraph.add_run(current_text)
-        return
-
-    while True:
-        match = re.match(pattern, current_text)
-        if match:
-            pre_text = match.group(1)
-            marker = match.group(3)
-            script_text = match.group(4)
-            rest = match.group(5)
-            
-            if pre_text:
-                paragraph.add_run(pre_text)
-            
-            run = paragraph.add_run(script_text)
-            if marker == '^':
-                run.font.superscript = True
-            elif marker == '_':
-                run.font.subscript = True
-                
-            current_text = rest
-            if not current_text:
-                break
-        else:
-            paragraph.add_run(current_text)
-            break
-
-def add_row(table, label, content, bold_label=True):
-    """Adds a row and applies formatting to the content."""
-    row_cells = table.add_row().cells
+    Callbacks run on the calling thread. on_lesson(index, lesson_inputs, ai_data)
+    fires as each lesson finishes. Returns a list of (lesson_inputs, ai_data) in
+    competency order, or None when no API key is given.
+    """
+    plan_inputs = normalize_job_inputs(plan_inputs, on_progress)
+    competencies = [
+        canonicalize_competency_inputs({'competency': compact_lesson_input('competency', c)})['competency']
+        for c in competencies if c and c.strip()
+    ]
     
-    p_lbl = row_cells[0].paragraphs[0]
-    run_lbl = p_lbl.add_run(label)
-    if bold_label:
-        run_lbl.bold = True
+    if not api_key:
+        if on_error:
+            on_error("❌ Please enter your Google Gemini API Key in the sidebar")
+        return None
+    if not competencies:
+        if on_error:
+            on_error("Please enter at least one learning competency")
+        return []
     
-    text_content = ""
-    if isinstance(content, list):
-        text_content = "\n".join([str(item) for item in content])
-    else:
-        text_content = str(content) if content else ""
+    language = analyze_language_from_inputs(
+        plan_inputs['content_std'], plan_inputs['perf_std'], " ".join(competencies)
+    )
     
-    format_text(row_cells[1].paragraphs[0], text_content)
-
-def add_section_header(table, text):
-    """Adds a full-width section header with Blue background."""
-    row = table.add_row()
-    row.cells[0].merge(row.cells[1])
-    cell = row.cells[0]
-    cell.text = text
-    cell.paragraphs[0].runs[0].bold = True
-    set_cell_background(cell, "BDD7EE")
-
-def parse_multiple_choice_question(q_text):
-    """Parse a multiple choice question in format: question|A. choice1|B. choice2|C. choice3|D. choice4"""
-    if not q_text:
-        return "No question provided", []
+    def lesson_inputs_for(comp):
+        return dict(plan_inputs, competency=comp)
     
-    parts = q_text.split('|')
+    def fallback_for(index, topic=None):
+        fallback = create_fallback_data(
+            plan_inputs['subject'], plan_inputs['grade'], plan_inputs['quarter'],
+            plan_inputs['content_std'], plan_inputs['perf_std'], competencies[index],
+            topic, language
+        )
+        fallback['resources'] = merge_catalog_resources(fallback['resources'],
+                                                        lookup_resources(lesson_inputs_for(competencies[index])))
+        return fallback
     
-    if len(parts) < 5:
-        return q_text, []
+    set_usage_context(api_key=api_key)
+    model = resolve_model(on_progress, api_key)
     
-    question = parts[0].strip()
-    choices = []
+    if on_progress:
+        on_progress(f"🗂️ Outlining {len(competencies)} lessons...", "info")
+    try:
+        outline_response = tracked_generate(model, build_quarter_outline_prompt(plan_inputs, competencies, language),
+                                            'quarter_outline')
+        outline = parse_quarter_outline(_response_text(outline_response), competencies)
+    except Exception as e:
+        if on_error:
+            on_error(f"Quarter outline failed, planning lessons from the competency list: {e}")
+        outline = parse_quarter_outline("", competencies)
     
-    for i in range(1, min(5, len(parts))):
-        choice = parts[i].strip()
-        if not re.match(r'^[A-D]\.', choice):
-            choice_prefix = ['A.', 'B.', 'C.', 'D.'][i-1]
-            choice = f"{choice_prefix} {choice}"
-        choices.append(choice)
+    context = build_quarter_context(plan_inputs, outline, language)
+    lesson_model, cache = _create_quarter_model(model, context)
+    note_replay(competencies=competencies, language=language, outline=outline, context=context)
     
-    while len(choices) < 4:
-        choices.append(f"{['A.', 'B.', 'C.', 'D.'][len(choices)]} Choice placeholder")
+    def expand(index):
+        resources = lookup_resources(lesson_inputs_for(competencies[index]))
+        prompt = build_lesson_expansion_prompt(index + 1, outline, with_resources=not resources_complete(resources))
+        response = tracked_generate(lesson_model, prompt, 'quarter_lesson')
+        ai_data = parse_ai_response(_response_text(response))
+        if ai_data is None:
+            raise ValueError("could not parse lesson JSON")
+        return validate_and_repair(lesson_model, lesson_inputs_for(competencies[index]), language, ai_data,
+                                   resources=resources)
     
-    return question, choices
+    results = [None] * len(competencies)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="quarter-plan") as executor:
+            futures = {submit_with_context(executor, expand, i): i for i in range(len(competencies))}
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    ai_data = future.result()
+                except Exception as e:
+                    if on_error:
+                        on_error(f"Lesson {index + 1} failed, using fallback content: {e}")
+                    ai_data = fallback_for(index, outline[index]['topic'])
+                
+                results[index] = (lesson_inputs_for(competencies[index]), ai_data)
+                if on_lesson:
+                    on_lesson(index, *results[index])
+    finally:
+        if cache is not None:
+            try:
+                lesson_model.client.caches.delete(name=cache.name)
+            except Exception:
+                pass
+    
+    return results
 
-def add_assessment_row(table, label, eval_sec):
-    """Special function to add assessment row with multiple choice questions."""
-    row_cells = table.add_row().cells
+# --- 5B. WEEKLY DAILY LESSON LOG (DLL) GENERATOR ---
+DLL_DAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday")
+
+DLL_DAY_FIELDS = (
+    'objectives', 'topic', 'review', 'purpose', 'examples', 'discussion',
+    'mastery', 'application', 'generalization', 'evaluation', 'assignment'
+)
+
+WEEKLY_RESOURCES_STRUCTURE = """
+                "resources": {
+                    "guide": "Teacher Guide pages",
+                    "materials": "Learner's Materials pages",
+                    "textbook": "Textbook pages",
+                    "portal": "Learning Resource Portal reference",
+                    "other": "Other Learning Resources"
+                },"""
+
+def build_weekly_prompt(inputs, language, with_resources=True):
+    """One batched prompt for all five days of a DLL. with_resources=False leaves out the resources section."""
+    return "\n".join([
+        f"""{school_intro(inputs)}
+            Create a JSON object for a one-week Daily Lesson Log (DLL), Monday to Friday.
+            Subject: {inputs['subject']}, Grade: {inputs['grade']}, Quarter: {inputs['quarter']}
+            Content Standard: {inputs['content_std']}
+            Performance Standard: {inputs['perf_std']}
+            Learning Competencies for the week: {inputs['competency']}""",
+        get_language_instruction(language),
+        (f"Week topic/content provided by the teacher (use it, do NOT modify it): {inputs['lesson_topic']}"
+         if inputs['lesson_topic'] else ""),
+        """
+            CRITICAL INSTRUCTIONS:
+            1. Return exactly 5 entries in "days", one per school day, in order. Each day builds on the day before.
+            2. Every value is SHORT: at most 40 words, because it goes into a narrow table cell.
+            3. "evaluation" is a short 3-item quiz written on one line per item.
+            4. Return ONLY valid JSON. No markdown, no bullet points (•), no explanations outside the JSON.
+            5. MATCH THE TEACHER'S LANGUAGE EXACTLY.
+
+            Structure:
+            {""" + (WEEKLY_RESOURCES_STRUCTURE if with_resources else "") + """
+                "days": [
+                    {
+                        "objectives": "Objectives for the day",
+                        "topic": "Content of the day",
+                        "review": "Reviewing previous lesson or presenting the new lesson",
+                        "purpose": "Establishing a purpose for the lesson",
+                        "examples": "Presenting examples/instances of the new lesson",
+                        "discussion": "Discussing new concepts and practicing new skills",
+                        "mastery": "Developing mastery",
+                        "application": "Finding practical applications in daily living",
+                        "generalization": "Making generalizations and abstractions",
+                        "evaluation": "Evaluating learning",
+                        "assignment": "Additional activities for application or remediation"
+                    }
+                ]
+            }
+            """
+    ])
+
+def _weekly_day_from_ai_data(ai_data):
+    """Map a single-day DLP ai_data dict onto the compact DLL day fields"""
+    proc = ai_data.get('procedure', {})
+    eval_sec = ai_data.get('evaluation', {})
+    return {
+        'objectives': f"1. {ai_data.get('obj_1', '')}\n2. {ai_data.get('obj_2', '')}\n3. {ai_data.get('obj_3', '')}",
+        'topic': ai_data.get('topic', ''),
+        'review': proc.get('review', ''),
+        'purpose': proc.get('purpose_situation', ''),
+        'examples': proc.get('activity_main', ''),
+        'discussion': proc.get('explicitation', ''),
+        'mastery': "\n".join(proc.get(f'group_{i}', '') for i in range(1, 4)),
+        'application': proc.get('purpose_situation', ''),
+        'generalization': proc.get('generalization', ''),
+        'evaluation': "\n".join(parse_multiple_choice_question(eval_sec.get(f'assess_q{i}', ''))[0] for i in range(1, 4)),
+        'assignment': eval_sec.get('assignment', '')
+    }
+
+def create_weekly_fallback_data(inputs, language="english"):
+    """Fallback DLL content built from the single-day fallback"""
+    ai_data = create_fallback_data(
+        inputs['subject'], inputs['grade'], inputs['quarter'],
+        inputs['content_std'], inputs['perf_std'], inputs['competency'],
+        inputs['lesson_topic'], language
+    )
+    return {
+        'resources': ai_data['resources'],
+        'days': [_weekly_day_from_ai_data(ai_data) for _ in DLL_DAYS]
+    }
+
+def normalize_weekly_data(data, inputs, language="english"):
+    """Make sure the DLL has resources and exactly five days with every field"""
+    if not isinstance(data, dict):
+        return create_weekly_fallback_data(inputs, language)
     
-    p_lbl = row_cells[0].paragraphs[0]
-    run_lbl = p_lbl.add_run(label)
-    run_lbl.bold = True
+    fallback_day = create_weekly_fallback_data(inputs, language)['days'][0]
+    days = data.get('days') if isinstance(data.get('days'), list) else []
     
-    content_cell = row_cells[1]
+    normalized_days = []
+    for i in range(len(DLL_DAYS)):
+        day = days[i] if i < len(days) and isinstance(days[i], dict) else {}
+        normalized_days.append({field: str(day.get(field) or fallback_day[field]) for field in DLL_DAY_FIELDS})
     
-    for paragraph in content_cell.paragraphs:
-        p = paragraph._element
-        p.getparent().remove(p)
+    resources = data.get('resources') if isinstance(data.get('resources'), dict) else {}
+    return {'resources': resources, 'days': normalized_days}
+
+@replay_logged('weekly')
+def generate_weekly_log(inputs, api_key, on_progress=None, on_error=None, on_raw_response=None):
+    """
+    Generate Monday-Friday DLL content in a single model call.
+    Returns {'resources': {...}, 'days': [5 dicts]} or None when no API key is given.
+    """
+    inputs = normalize_job_inputs(inputs, on_progress)
     
-    p_header = content_cell.add_paragraph()
-    header_run = p_header.add_run("ASSESSMENT (5-item Multiple Choice Quiz)")
-    header_run.bold = True
+    if not api_key:
+        if on_error:
+            on_error("❌ Please enter your Google Gemini API Key in the sidebar")
+        return None
+    
+    language = detect_inputs_language(inputs)
+    
+    try:
+        set_usage_context(api_key=api_key)
+        model = resolve_model(on_progress, api_key)
+        
+        resources = lookup_resources(inputs)
+        response = tracked_generate(model, build_weekly_prompt(inputs, language,
+                                                               with_resources=not resources_complete(resources)),
+                                    'weekly')
+        text = _response_text(response)
+        
+        if on_raw_response:
+            on_raw_response(clean_json_string(text))
+        
+        data = parse_ai_response(text, on_error)
+        note_replay(normalized_inputs=inputs, language=language, catalog_resources=resources,
+                    raw_response=text, parsed=data is not None)
+        data = normalize_weekly_data(data, inputs, language)
+    
+    except Exception as e:
+        if on_error:
+            on_error(f"AI Generation Error: {str(e)}")
+        resources = lookup_resources(inputs)
+        note_replay(language=language, catalog_resources=resources,
+                    generation_error=f"{type(e).__name__}: {e}", fallback='all')
+        data = create_weekly_fallback_data(inputs, language)
+    
+    if resources:
+        data['resources'] = merge_catalog_resources(data['resources'], resources)
+    return data
+
+# --- 5C. RESPONSE QUALITY VALIDATION ---
+# section -> (parent key in ai_data or None for top level, required fields)
+LESSON_SECTIONS = {
+    'objectives': (None, ('obj_1', 'obj_2', 'obj_3')),
+    'content': (None, ('topic', 'integration_within', 'integration_across')),
+    'resources': ('resources', ('guide', 'materials', 'textbook', 'portal', 'other')),
+    'procedure': ('procedure', (
+        'review', 'purpose_situation', 'visual_prompt', 'vocabulary', 'activity_main',
+        'explicitation', 'group_1', 'group_2', 'group_3', 'generalization'
+    )),
+    'evaluation': ('evaluation', (
+        'assess_q1', 'assess_q2', 'assess_q3', 'assess_q4', 'assess_q5',
+        'assignment', 'remarks', 'reflection'
+    )),
+}
+
+VALIDATION_MAX_REPAIR_CALLS = 2
+
+LANGUAGE_FUNCTION_WORDS = {
+    'filipino': ('ang', 'ng', 'mga', 'sa', 'ay', 'na', 'at', 'ito', 'para'),
+    'english': ('the', 'and', 'of', 'to', 'is', 'are', 'with', 'this', 'for'),
+}
+
+def _section_fields(ai_data, section):
+    parent, fields = LESSON_SECTIONS[section]
+    container = ai_data.get(parent) if parent else ai_data
+    return container if isinstance(container, dict) else {}, fields
+
+def _language_mismatch(text, language):
+    """True when the text is clearly in the other language (function-word count)"""
+    words = re.findall(r"[a-z\-]+", text.lower())
+    if len(words) < 12:
+        return False
+    other = "english" if language == "filipino" else "filipino"
+    expected_count = sum(1 for w in words if w in LANGUAGE_FUNCTION_WORDS[language])
+    other_count = sum(1 for w in words if w in LANGUAGE_FUNCTION_WORDS[other])
+    return other_count >= 3 and other_count > 2 * expected_count
+
+def _assessment_problem(value):
+    question, choices = parse_multiple_choice_question(value)
+    if not choices or len(value.split('|')) < 5:
+        return 'must be "question|A. choice1|B. choice2|C. choice3|D. choice4"'
+    if not question.strip():
+        return "question text is empty"
+    texts = [re.sub(r'^[A-D]\.\s*', '', c).strip().lower() for c in choices]
+    if any(not t for t in texts) or len(set(texts)) < 4:
+        return "needs four different, non-empty choices A-D"
+    return None
+
+def _field_text(value):
+    """Text of a field value. The model sometimes answers a list (e.g. vocabulary terms) or an object"""
+    if isinstance(value, (list, tuple)):
+        return "\n".join(text for text in map(_field_text, value) if text.strip())
+    if isinstance(value, dict):
+        return "\n".join(f"{key}: {_field_text(item)}" for key, item in value.items())
+    return "" if value is None else str(value)
+
+def coerce_lesson_fields(ai_data):
+    """Turn list and object field values into text in place, laid out the way add_row renders lists"""
+    for section in LESSON_SECTIONS:
+        container, fields = _section_fields(ai_data, section)
+        for field in fields:
+            if isinstance(container.get(field), (list, dict)):
+                container[field] = _field_text(container[field])
+    return ai_data
+
+def validate_lesson_data(ai_data, language="english"):
+    """
+    Score each section of ai_data. Returns (scores, problems) where scores maps
+    section -> fraction of valid fields and problems maps section -> {field: reason}.
+    Field "*" means the whole section (e.g. wrong language).
+    """
+    scores, problems = {}, {}
+    ai_data = ai_data if isinstance(ai_data, dict) else {}
+    
+    for section in LESSON_SECTIONS:
+        container, fields = _section_fields(ai_data, section)
+        section_problems = {}
+        
+        for field in fields:
+            value = _field_text(container.get(field))
+            if not value.strip():
+                section_problems[field] = "missing or empty"
+            elif field.startswith('assess_q'):
+                reason = _assessment_problem(value)
+                if reason:
+                    section_problems[field] = reason
+        
+        text = " ".join(str(container.get(f, '')) for f in fields if f != 'visual_prompt')
+        if _language_mismatch(text, language):
+            section_problems = {'*': f"not written in {language.upper()}"}
+        
+        valid = 0 if '*' in section_problems else len(fields) - len(section_problems)
+        scores[section] = valid / len(fields)
+        if section_problems:
+            problems[section] = section_problems
+    
+    return scores, problems
+
+def build_repair_prompt(inputs, language, ai_data, problems):
+    """Ask only for the sections/fields that failed validation"""
+    skeleton, problem_lines = {}, []
+    for section, section_problems in problems.items():
+        parent, fields = LESSON_SECTIONS[section]
+        wanted = fields if '*' in section_problems else tuple(section_problems)
+        target = skeleton.setdefault(parent, {}) if parent else skeleton
+        for field in wanted:
+            target[field] = "..."
+            label = f"{parent}.{field}" if parent else field
+            problem_lines.append(f"- {label}: {section_problems.get(field, section_problems.get('*'))}")
+    
+    return "\n".join([
+        f"""{school_intro(inputs)}
+            Some fields of a Daily Lesson Plan (DLP) JSON are missing or invalid. Write ONLY those fields.
+            Subject: {inputs['subject']}, Grade: {inputs['grade']}, Quarter: {inputs['quarter']}
+            Learning Competency: {inputs['competency']}
+            Topic: {ai_data.get('topic') or inputs['lesson_topic'] or ''}""",
+        get_language_instruction(language),
+        "FIELDS TO FIX:",
+        "\n".join(problem_lines),
+        """
+            Assessment questions MUST follow this format: "question|A. choice1|B. choice2|C. choice3|D. choice4|answer"
+            where answer is the letter of the correct choice.
+            Return ONLY raw JSON with exactly this structure (no other keys, no markdown):""",
+        json.dumps(skeleton, indent=2)
+    ])
+
+def merge_lesson_data(ai_data, patch, problems):
+    """Copy repaired fields from patch into ai_data, only where validation failed"""
+    if not isinstance(patch, dict):
+        return ai_data
+    for section, section_problems in problems.items():
+        parent, fields = LESSON_SECTIONS[section]
+        source = patch.get(parent) if parent else patch
+        if not isinstance(source, dict):
+            continue
+        target = ai_data.setdefault(parent, {}) if parent else ai_data
+        if not isinstance(target, dict):
+            target = ai_data[parent] = {}
+        wanted = fields if '*' in section_problems else section_problems
+        for field in wanted:
+            value = _field_text(source.get(field))
+            if value.strip():
+                target[field] = value
+    return ai_data
+
+def validate_and_repair(model, inputs, language, ai_data, on_progress=None, on_error=None,
+                        max_repairs=VALIDATION_MAX_REPAIR_CALLS, resources=None):
+    """
+    Validate ai_data, make up to max_repairs small follow-up calls for the failed
+    fields, then fill whatever is still invalid from create_fallback_data.
+    resources (from the catalog) replace the model's for the kinds they cover and
+    are taken as valid; the other kinds are validated and repaired as usual.
+    """
+    ai_data = coerce_lesson_fields(ai_data if isinstance(ai_data, dict) else {})
+    if inputs['lesson_topic']:
+        ai_data['topic'] = inputs.get('lesson_topic_as_entered') or inputs['lesson_topic']
+    
+    def validate():
+        scores, problems = validate_lesson_data(ai_data, language)
+        if resources and 'resources' in problems:
+            _, fields = LESSON_SECTIONS['resources']
+            section_problems = problems.pop('resources')
+            if '*' in section_problems:
+                # Catalog titles may be in the other language; only the model's kinds count
+                section_problems = {field: section_problems['*'] for field in fields}
+            section_problems = {field: reason for field, reason in section_problems.items()
+                                if not resources.get(field)}
+            scores['resources'] = 1 - len(section_problems) / len(fields)
+            if section_problems:
+                problems['resources'] = section_problems
+        return scores, problems
+    
+    if resources:
+        ai_data['resources'] = merge_catalog_resources(ai_data.get('resources'), resources)
+    started = time.monotonic()
+    scores, problems = validate()
+    found = {section: sorted(fields) for section, fields in problems.items()}
+    
+    for attempt in range(max_repairs):
+        if not problems:
+            break
+        if on_progress:
+            summary = ", ".join(f"{name} {score:.0%}" for name, score in scores.items() if score < 1)
+            on_progress(f"🧪 Fixing incomplete sections ({summary})...", "warning")
+        try:
+            response = tracked_generate(model, build_repair_prompt(inputs, language, ai_data, problems), 'repair')
+            merge_lesson_data(ai_data, parse_ai_response(_response_text(response)), problems)
+        except Exception as e:
+            if on_error:
+                on_error(f"Repair call {attempt + 1} failed: {e}")
+        scores, problems = validate()
+    
+    if problems:
+        fallback = create_fallback_data(
+            inputs['subject'], inputs['grade'], inputs['quarter'],
+            inputs['content_std'], inputs['perf_std'], inputs['competency'],
+            inputs['lesson_topic'], language
+        )
+        merge_lesson_data(ai_data, fallback, problems)
+        if on_progress:
+            on_progress(f"⚠️ Placeholder text used for: {', '.join(problems)}", "warning")
+    elif on_progress:
+        on_progress("✓ Quality check passed", "success")
+    
+    append_replay_note('validation', {
+        'competency': inputs['competency'], 'problems': found,
+        'fallback': {section: sorted(fields) for section, fields in problems.items()},
+        'seconds': round(time.monotonic() - started, 3),
+    })
+    return ai_data
+
+# --- 5D. HEDGED MODEL REQUESTS ---
+# If the primary model is slower than the hedge threshold, the same prompt goes to the
+# next model in MODEL_OPTIONS and the first valid answer wins. Streaming lets the
+# losing request be abandoned mid-generation instead of running to completion.
+HEDGE_AFTER_SECONDS = float(os.environ.get("DLP_HEDGE_AFTER_SECONDS", "12"))
+HEDGE_MIN_SAMPLES = 20        # Use the measured p90 once this many primary latencies are known
+
+_hedge_lock = shared('hedge_lock', threading.Lock)
+_hedge_stats = shared('hedge_stats', lambda: {
+    'requests': 0, 'hedged': 0, 'primary_wins': 0, 'secondary_wins': 0, 'extra_tokens': 0
+})
+_primary_latencies = shared('primary_latencies', lambda: deque(maxlen=200))
+
+def hedge_threshold():
+    """p90 of recent primary latencies once enough samples exist, otherwise HEDGE_AFTER_SECONDS"""
+    with _hedge_lock:
+        samples = sorted(_primary_latencies)
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_AFTER_SECONDS
+    return samples[int(0.9 * (len(samples) - 1))]
+
+def get_hedge_stats():
+    """Snapshot of hedging counters, including hedge rate and the current threshold"""
+    with _hedge_lock:
+        stats = dict(_hedge_stats)
+    stats['hedge_rate'] = stats['hedged'] / stats['requests'] if stats['requests'] else 0.0
+    stats['threshold_seconds'] = hedge_threshold()
+    return stats
+
+def secondary_model_for(model):
+    """
+    The next model after the primary in MODEL_OPTIONS, or None. resolve_model probes
+    MODEL_OPTIONS in order, so the models before the primary are the ones that failed.
+    """
+    primary_name = getattr(model, 'model_name', '').replace('models/', '')
+    if primary_name in MODEL_OPTIONS:
+        candidates = MODEL_OPTIONS[MODEL_OPTIONS.index(primary_name) + 1:]
+    else:
+        candidates = MODEL_OPTIONS
+    for model_name in candidates:
+        if model_name != primary_name:
+            return GeminiModel(model.client, model_name)
+    return None
+
+def _stream_text(model, prompt, cancel_event, stage='hedged'):
+    """Stream a response; closes it early when cancel_event is set. Returns (text, tokens, seconds)"""
+    start = time.monotonic()
+    parts, tokens = [], None
+    stream = tracked_stream(model, prompt, stage)
+    try:
+        for chunk in stream:
+            if cancel_event.is_set():
+                break
+            parts.append(_response_text(chunk))
+            usage = getattr(chunk, 'usage_metadata', None)
+            if usage is not None and getattr(usage, 'total_token_count', 0):
+                tokens = usage.total_token_count
+    finally:
+        stream.close()
+    text = "".join(parts)
+    if tokens is None:
+        tokens = (len(prompt) + len(text)) // 4
+    return text, tokens, time.monotonic() - start
+
+def _count_extra_tokens(future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    with _hedge_lock:
+        _hedge_stats['extra_tokens'] += future.result()[1]
+
+def generate_text_hedged(model, prompt, is_valid=None, hedge_after=None, stage='hedged'):
+    """
+    Return the response text for prompt, hedging to a secondary model when the
+    primary is slower than hedge_after seconds (default: hedge_threshold()).
+    The secondary's calls are logged in the usage ledger as "<stage>:hedge".
+    Each call gets its own two threads: with a shared pool, a busy process queued
+    primaries behind other teachers' hedges, and the wait got them hedged too.
+    """
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="model-hedge")
+    try:
+        return _race_models(executor, model, prompt, is_valid, hedge_after, stage)
+    finally:
+        executor.shutdown(wait=False)   # A losing stream closes itself at its next chunk
+
+def _race_models(executor, model, prompt, is_valid, hedge_after, stage):
+    is_valid = is_valid or (lambda text: bool(text and text.strip()))
+    threshold = hedge_after if hedge_after is not None else hedge_threshold()
+    
+    with _hedge_lock:
+        _hedge_stats['requests'] += 1
+    
+    cancel_events = {}
+    
+    def launch(target_model, role):
+        event = threading.Event()
+        call_stage = stage if role == 'primary' else f"{stage}:hedge"
+        future = submit_with_context(executor, _stream_text, target_model, prompt, event, call_stage)
+        cancel_events[future] = (event, role)
+        return future
+    
+    def outcome(future):
+        if future.exception() is not None:
+            return None
+        text = future.result()[0]
+        return text if is_valid(text) else None
+    
+    started = time.monotonic()
+    primary = launch(model, 'primary')
+    done, _ = wait([primary], timeout=threshold)
+    
+    if primary in done:
+        if primary.exception() is None:
+            with _hedge_lock:
+                _primary_latencies.append(primary.result()[2])
+        text = outcome(primary)
+        if text is not None:
+            with _hedge_lock:
+                _hedge_stats['primary_wins'] += 1
+            return text
+    
+    secondary_model = secondary_model_for(model)
+    if secondary_model is None:
+        return primary.result()[0]
+    
+    secondary = launch(secondary_model, 'secondary')
+    with _hedge_lock:
+        _hedge_stats['hedged'] += 1
+    
+    pending = {secondary} if primary in done else {primary, secondary}
+    last_error, last_text = None, None
+    
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            event, role = cancel_events[future]
+            if future.exception() is not None:
+                last_error = future.exception()
+                continue
+            if role == 'primary':
+                with _hedge_lock:
+                    _primary_latencies.append(future.result()[2])
+            text = outcome(future)
+            if text is None:
+                last_text = future.result()[0]
+                continue
+            
+            # Winner found: stop the other stream and bill what it used as hedge overhead
+            for other in pending:
+                cancel_events[other][0].set()
+                other.add_done_callback(_count_extra_tokens)
+            with _hedge_lock:
+                _hedge_stats[f'{role}_wins'] += 1
+                if primary in pending:
+                    # A cancelled primary was at least this slow; leaving it out would
+                    # bias the p90 toward fast calls and lower the threshold over time
+                    _primary_latencies.append(max(time.monotonic() - started, threshold))
+            return text
+    
+    if last_text is not None:
+        return last_text
+    raise last_error
+
+# --- 5E. GENERATION HISTORY ---
+# Every generated lesson is kept per lesson (session state + the profile database),
+# so a teacher can compare runs field by field and combine the parts they like
+# into one DLP without another model call. Runs are stored as LessonPlan (see 5G).
+HISTORY_MAX_RUNS = 10
+HISTORY_DIFF_SECTIONS = ('objectives', 'procedure', 'evaluation')
+
+def lesson_history_key(inputs):
+    """Stable key for 'the same lesson': subject, grade, quarter and competency"""
+    parts = [re.sub(r'\s+', ' ', str(inputs.get(f) or '')).strip().lower()
+             for f in ('subject', 'grade', 'quarter', 'competency')]
+    return hashlib.sha256("\x1f".join(parts).encode('utf-8')).hexdigest()[:24]
+
+def _history_db():
+    conn = _profile_db()
+    conn.execute("""CREATE TABLE IF NOT EXISTS generations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        profile_id TEXT NOT NULL,
+        lesson_key TEXT NOT NULL,
+        created REAL NOT NULL,
+        ai_data BLOB NOT NULL
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS generations_lesson ON generations (profile_id, lesson_key, created)")
+    return conn
+
+def _insert_generation(conn, profile_id, lesson_key, plan, created):
+    conn.execute(
+        "INSERT INTO generations (profile_id, lesson_key, created, ai_data) VALUES (?, ?, ?, ?)",
+        (profile_id, lesson_key, created, sqlite3.Binary(pack_lesson(plan)))
+    )
+    conn.execute(
+        "DELETE FROM generations WHERE profile_id = ? AND lesson_key = ? AND id NOT IN ("
+        "SELECT id FROM generations WHERE profile_id = ? AND lesson_key = ? "
+        "ORDER BY created DESC, id DESC LIMIT ?)",
+        (profile_id, lesson_key, profile_id, lesson_key, HISTORY_MAX_RUNS)
+    )
+
+def save_generation(profile_id, lesson_key, plan, created=None):
+    """Store one run (packed LessonPlan) and keep only the newest HISTORY_MAX_RUNS for the lesson"""
+    if not profile_id:
+        return
+    with _profile_db_lock:
+        conn = _history_db()
+        try:
+            _insert_generation(conn, profile_id, lesson_key, plan, created or time.time())
+            conn.commit()
+        finally:
+            conn.close()
+
+def load_generations(profile_id, lesson_key):
+    """Stored runs for a lesson, oldest first: [{'created': float, 'plan': LessonPlan}]"""
+    if not profile_id:
+        return []
+    with _profile_db_lock:
+        conn = _history_db()
+        try:
+            rows = conn.execute(
+                "SELECT created, ai_data FROM generations WHERE profile_id = ? AND lesson_key = ? "
+                "ORDER BY created, id", (profile_id, lesson_key)
+            ).fetchall()
+        finally:
+            conn.close()
+    return [{'created': created, 'plan': load_lesson(data)} for created, data in rows]
+
+def get_generation_history(inputs):
+    """This lesson's runs for the current session, loaded from the profile on first use"""
+    key = lesson_history_key(inputs)
+    history = st.session_state.setdefault('generation_history', {})
+    if key not in history:
+        history[key] = load_generations(st.session_state.get('profile_id'), key)
+    return history[key]
+
+def add_generation_history(inputs, lesson):
+    """Append a run (ai_data dict or LessonPlan) to this lesson's history"""
+    runs = get_generation_history(inputs)
+    run = {'created': time.time(), 'plan': lesson_from_json(lesson)}
+    runs.append(run)
+    del runs[:-HISTORY_MAX_RUNS]
+    save_generation(st.session_state.get('profile_id'), lesson_history_key(inputs), run['plan'], run['created'])
+
+def diff_lesson_data(old, new, sections=HISTORY_DIFF_SECTIONS):
+    """Fields whose text differs between two runs: [(section, field, old_value, new_value)]"""
+    changes = []
+    for section in sections:
+        old_container, fields = _section_fields(old, section)
+        new_container, _ = _section_fields(new, section)
+        for field in fields:
+            old_value = str(old_container.get(field) or '')
+            new_value = str(new_container.get(field) or '')
+            if old_value.strip() != new_value.strip():
+                changes.append((section, field, old_value, new_value))
+    return changes
+
+def word_diff_markdown(old, new):
+    """Markdown for new text with removed words struck through and added words in bold"""
+    old_words, new_words = old.split(), new.split()
+    parts = []
+    matcher = difflib.SequenceMatcher(None, old_words, new_words, autojunk=False)
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op == 'equal':
+            parts.append(" ".join(new_words[j1:j2]))
+            continue
+        if i2 > i1:
+            parts.append("~~" + " ".join(old_words[i1:i2]) + "~~")
+        if j2 > j1:
+            parts.append("**" + " ".join(new_words[j1:j2]) + "**")
+    return " ".join(parts)
+
+def merge_lesson_runs(runs, picks, base=-1):
+    """
+    Build one ai_data from several runs. picks maps (section, field) -> run index;
+    everything not picked comes from runs[base].
+    """
+    merged = copy.deepcopy(runs[base])
+    for (section, field), index in picks.items():
+        parent, _ = LESSON_SECTIONS[section]
+        source, _ = _section_fields(runs[index], section)
+        if field not in source:
+            continue
+        target = merged.setdefault(parent, {}) if parent else merged
+        target[field] = source[field]
+    return merged
+
+# --- 5F. USAGE LEDGER ---
+# Every model call (probe, lesson, repair, hedge, quarter, weekly) is logged with its
+# token counts, latency and outcome. The teacher and API key come from a context
+# variable set by the caller, so worker threads must be started with a copied context.
+# Quota limits are per key and model per day; set them to match the key's tier.
+QUOTA_REQUESTS_PER_DAY = int(os.environ.get("DLP_QUOTA_REQUESTS_PER_DAY", "250"))
+QUOTA_TOKENS_PER_DAY = int(os.environ.get("DLP_QUOTA_TOKENS_PER_DAY", "0"))   # 0 = not tracked
+USAGE_DASHBOARD_DAYS = 14
+
+_usage_context = shared('usage_context', lambda: contextvars.ContextVar('dlp_usage_context', default=None))
+
+def set_usage_context(profile_id=None, api_key=None):
+    """Attribute the following model calls in this context to a teacher and/or key"""
+    context = dict(_usage_context.get() or {})
+    if profile_id:
+        context['profile_id'] = profile_id
+    if api_key:
+        context['key_digest'] = _api_key_digest(api_key)
+    _usage_context.set(context)
+
+def submit_with_context(executor, fn, *args):
+    """executor.submit that keeps the usage context (one context copy per task)"""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+def _usage_db():
+    conn = _profile_db()
+    conn.execute("""CREATE TABLE IF NOT EXISTS model_calls (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts REAL NOT NULL,
+        day TEXT NOT NULL,
+        profile_id TEXT NOT NULL DEFAULT '',
+        key_digest TEXT NOT NULL DEFAULT '',
+        model TEXT NOT NULL,
+        stage TEXT NOT NULL,
+        prompt_tokens INTEGER NOT NULL,
+        completion_tokens INTEGER NOT NULL,
+        estimated INTEGER NOT NULL DEFAULT 0,
+        latency REAL NOT NULL,
+        outcome TEXT NOT NULL,
+        error TEXT
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS model_calls_day ON model_calls (day, key_digest, model)")
+    return conn
+
+def _model_label(model):
+    return str(getattr(model, 'model_name', '') or 'unknown').replace('models/', '')
+
+def _call_outcome(error, cancelled):
+    if cancelled:
+        return 'cancelled'
+    if error is None:
+        return 'ok'
+    text = f"{type(error).__name__} {error}"
+    return 'quota' if ('ResourceExhausted' in text or '429' in text) else 'error'
+
+def record_model_call(stage, model, prompt, started, usage=None, text="", error=None, cancelled=False):
+    """Write one ledger row; token counts are estimated (chars / 4) when the API sends none"""
+    context = _usage_context.get() or {}
+    if usage is not None and getattr(usage, 'prompt_token_count', 0):
+        prompt_tokens = usage.prompt_token_count
+        completion_tokens = getattr(usage, 'candidates_token_count', 0) or 0
+        estimated = 0
+    else:
+        prompt_tokens = len(str(prompt)) // 4
+        completion_tokens = len(text or '') // 4
+        estimated = 1
+    _replay_model_call(stage, model, prompt, text, time.monotonic() - started, error, cancelled)
+    now = time.time()
+    row = (
+        now, time.strftime('%Y-%m-%d', time.localtime(now)),
+        context.get('profile_id', ''), context.get('key_digest', ''),
+        _model_label(model), stage, prompt_tokens, completion_tokens, estimated,
+        time.monotonic() - started, _call_outcome(error, cancelled),
+        f"{type(error).__name__}: {error}"[:300] if error is not None else None
+    )
+    try:
+        with _profile_db_lock:
+            conn = _usage_db()
+            try:
+                conn.execute(
+                    "INSERT INTO model_calls (ts, day, profile_id, key_digest, model, stage, prompt_tokens, "
+                    "completion_tokens, estimated, latency, outcome, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    row
+                )
+                conn.commit()
+            finally:
+                conn.close()
+    except sqlite3.Error:
+        pass  # Accounting must never break generation
+
+def _response_text(response):
+    try:
+        return response.text or ""
+    except Exception:
+        return ""
+
+def tracked_generate(model, prompt, stage):
+    """model.generate_content(prompt) with a ledger entry"""
+    started = time.monotonic()
+    try:
+        response = model.generate_content(prompt)
+    except Exception as e:
+        record_model_call(stage, model, prompt, started, error=e)
+        raise
+    record_model_call(stage, model, prompt, started, getattr(response, 'usage_metadata', None),
+                      _response_text(response))
+    return response
+
+def tracked_stream(model, prompt, stage):
+    """Streaming model.generate_content; the ledger entry is written when the stream ends or is dropped"""
+    started = time.monotonic()
+    parts, usage, error, cancelled = [], None, None, False
+    stream = None
+    try:
+        stream = model.generate_content(prompt, stream=True)
+        for chunk in stream:
+            chunk_usage = getattr(chunk, 'usage_metadata', None)
+            if chunk_usage is not None and getattr(chunk_usage, 'prompt_token_count', 0):
+                usage = chunk_usage
+            parts.append(_response_text(chunk))
+            yield chunk
+    except GeneratorExit:
+        cancelled = True
+        raise
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        close = getattr(stream, 'close', None)
+        if close:
+            close()
+        record_model_call(stage, model, prompt, started, usage, "".join(parts), error, cancelled)
+
+def usage_summary(days=USAGE_DASHBOARD_DAYS, group_by=('day', 'profile_id', 'key_digest', 'model'), profile_id=None):
+    """Aggregated ledger rows for the last `days` days, grouped by the given columns"""
+    allowed = ('day', 'profile_id', 'key_digest', 'model', 'stage', 'outcome')
+    columns = [c for c in group_by if c in allowed]
+    since = time.strftime('%Y-%m-%d', time.localtime(time.time() - (days - 1) * 86400))
+    where, params = "day >= ?", [since]
+    if profile_id:
+        where += " AND profile_id = ?"
+        params.append(profile_id)
+    select = ", ".join(columns)
+    with _profile_db_lock:
+        conn = _usage_db()
+        try:
+            rows = conn.execute(
+                f"SELECT {select + ', ' if select else ''}COUNT(*), "
+                "SUM(outcome IN ('error', 'quota')), SUM(outcome = 'quota'), "
+                "SUM(prompt_tokens), SUM(completion_tokens), AVG(latency) "
+                f"FROM model_calls WHERE {where}"
+                + (f" GROUP BY {select} ORDER BY {select}" if select else ""),
+                params
+            ).fetchall()
+        finally:
+            conn.close()
+    
+    summary = []
+    for row in rows:
+        entry = dict(zip(columns, row[:len(columns)]))
+        calls, errors, quota, prompt_tokens, completion_tokens, latency = row[len(columns):]
+        if not calls:
+            continue
+        entry.update({
+            'calls': calls, 'errors': errors or 0, 'quota_errors': quota or 0,
+            'prompt_tokens': prompt_tokens or 0, 'completion_tokens': completion_tokens or 0,
+            'avg_latency_s': round(latency or 0, 2),
+        })
+        summary.append(entry)
+    return summary
+
+def project_quota(now=None):
+    """
+    Today's use per key and model, with the time the daily request/token limit
+    would be reached at today's average rate (None if not before midnight).
+    """
+    now = now or time.time()
+    local = time.localtime(now)
+    midnight = time.mktime(local[:3] + (0, 0, 0) + local[6:8] + (-1,))
+    elapsed = max(now - midnight, 60)
+    remaining = midnight + 86400 - now
+    
+    projections = []
+    for row in usage_summary(days=1, group_by=('key_digest', 'model')):
+        tokens = row['prompt_tokens'] + row['completion_tokens']
+        limits = [('requests', row['calls'], QUOTA_REQUESTS_PER_DAY)]
+        if QUOTA_TOKENS_PER_DAY:
+            limits.append(('tokens', tokens, QUOTA_TOKENS_PER_DAY))
+        
+        exhausted_at, limit_name, used_fraction = None, None, 0.0
+        for name, used, limit in limits:
+            used_fraction = max(used_fraction, used / limit)
+            rate = used / elapsed
+            seconds_left = (limit - used) / rate if rate else float('inf')
+            if seconds_left <= remaining and (exhausted_at is None or now + seconds_left < exhausted_at):
+                exhausted_at, limit_name = now + max(seconds_left, 0), name
+        
+        projections.append(dict(row, tokens=tokens, used_fraction=round(used_fraction, 3),
+                                exhausted_at=exhausted_at, limit=limit_name))
+    return projections
+
+# --- 5G. LESSON DATA MODEL ---
+# Compact, typed form of ai_data for plans that are kept around (quarter plans,
+# generation history, archives). Each section is a namedtuple built from
+# LESSON_SECTIONS, so a plan is a few tuples of strings instead of nested dicts.
+# ai_data dicts are still used while generating; convert at the boundary with
+# lesson_from_json() / lesson_to_dict(). pack_lesson() gives a versioned binary form.
+# The types are shared (1A) so plans kept in session state stay instances of the
+# current LessonPlan after a rerun.
+LESSON_SECTION_TYPES = shared('lesson_section_types', lambda: {
+    section: namedtuple(section.title() + 'Section', fields)
+    for section, (parent, fields) in LESSON_SECTIONS.items()
+})
+LessonPlan = shared('LessonPlan', lambda: namedtuple('LessonPlan', tuple(LESSON_SECTIONS)))
+AssessmentItem = shared('AssessmentItem', lambda: namedtuple('AssessmentItem', ('question', 'choices')))
+
+# (section type, parent key, fields, getter) in LessonPlan order; the order is the binary layout
+_LESSON_SCHEMA = tuple(
+    (LESSON_SECTION_TYPES[section], parent, fields, itemgetter(*fields))
+    for section, (parent, fields) in LESSON_SECTIONS.items()
+)
+LESSON_FIELD_COUNT = sum(len(fields) for _, _, fields, _ in _LESSON_SCHEMA)
+_LESSON_PACK_LENGTHS = f"<{LESSON_FIELD_COUNT}I"
+LESSON_PACK_MAGIC = b'DLPB'
+LESSON_PACK_VERSION = 1
+
+_lesson_json_decoder = json.JSONDecoder()
+_STR_ONLY = {str}
+
+def lesson_from_json(data):
+    """ai_data dict or JSON text -> LessonPlan. Missing fields become ''."""
+    if isinstance(data, (str, bytes)):
+        data = _lesson_json_decoder.decode(data.decode('utf-8') if isinstance(data, bytes) else data)
+    if isinstance(data, LessonPlan):
+        return data
+    if not isinstance(data, dict):
+        raise ValueError("lesson data must be a JSON object")
+    sections = []
+    for section_type, parent, fields, getter in _LESSON_SCHEMA:
+        container = data.get(parent) if parent else data
+        if not isinstance(container, dict):
+            container = {}
+        try:
+            values = getter(container)
+        except KeyError:
+            values = tuple(container.get(f) for f in fields)
+        # Fast path: the model almost always returns every field as a plain string
+        if set(map(type, values)) != _STR_ONLY:
+            values = [_field_text(v) for v in values]
+        sections.append(tuple.__new__(section_type, values))
+    return tuple.__new__(LessonPlan, sections)
+
+def lesson_to_dict(plan):
+    """LessonPlan -> ai_data dict in the shape the prompts and DOCX builder use"""
+    data = {}
+    for (_, parent, fields, _), values in zip(_LESSON_SCHEMA, plan):
+        target = data.setdefault(parent, {}) if parent else data
+        target.update(zip(fields, values))
+    return data
+
+def lesson_to_json(plan):
+    return json.dumps(lesson_to_dict(plan), ensure_ascii=False)
+
+def assessment_items(plan):
+    """The five assessment questions as AssessmentItem(question, choices); empty ones are ('', ())"""
+    items = []
+    for field in ('assess_q1', 'assess_q2', 'assess_q3', 'assess_q4', 'assess_q5'):
+        raw = getattr(plan.evaluation, field)
+        if not raw:
+            items.append(AssessmentItem('', ()))
+            continue
+        question, choices = parse_multiple_choice_question(raw)
+        items.append(AssessmentItem(question, tuple(choices)))
+    return items
+
+def pack_lesson(plan, compress=True):
+    """
+    Versioned binary form: magic, version, flags, then (optionally zlib'd) body of
+    LESSON_FIELD_COUNT little-endian uint32 character lengths followed by the UTF-8 text
+    of all fields. The layout does not depend on the machine that wrote it.
+    """
+    values = [value for section in plan for value in section]
+    body = struct.pack(_LESSON_PACK_LENGTHS, *map(len, values)) + "".join(values).encode('utf-8')
+    flags = 1 if compress else 0
+    if compress:
+        body = zlib.compress(body, 6)
+    return LESSON_PACK_MAGIC + bytes((LESSON_PACK_VERSION, flags)) + body
+
+def unpack_lesson(data):
+    """pack_lesson() bytes -> LessonPlan"""
+    if data[:4] != LESSON_PACK_MAGIC:
+        raise ValueError("not a packed lesson")
+    version, flags = data[4], data[5]
+    if version != LESSON_PACK_VERSION:
+        raise ValueError(f"unsupported packed lesson version {version}")
+    body = zlib.decompress(data[6:]) if flags & 1 else bytes(data[6:])
+    header_size = struct.calcsize(_LESSON_PACK_LENGTHS)
+    lengths = struct.unpack(_LESSON_PACK_LENGTHS, body[:header_size])
+    text = body[header_size:].decode('utf-8')
+    
+    sections, pos = [], 0
+    length_iter = iter(lengths)
+    for section_type, _, fields, _ in _LESSON_SCHEMA:
+        values = []
+        for _ in fields:
+            end = pos + next(length_iter)
+            values.append(text[pos:end])
+            pos = end
+        sections.append(tuple.__new__(section_type, values))
+    return tuple.__new__(LessonPlan, sections)
+
+def load_lesson(stored):
+    """Packed bytes or JSON text (older rows) -> LessonPlan"""
+    if isinstance(stored, (bytes, bytearray, memoryview)) and bytes(stored[:4]) == LESSON_PACK_MAGIC:
+        return unpack_lesson(bytes(stored))
+    return lesson_from_json(stored)
+
+# --- 5H. DUAL-LANGUAGE PLANS ---
+# Araling Panlipunan, ESP and similar subjects need the plan in both English and
+# Filipino. The plan is generated once in the detected language; each group of
+# sections is translated by a short JSON-in/JSON-out call as soon as it has
+# streamed in, so translation runs alongside the rest of the generation.
+LANGUAGE_LABELS = {'english': 'English', 'filipino': 'Filipino'}
+LANGUAGE_FILE_SUFFIXES = {'english': 'EN', 'filipino': 'FIL'}
+
+# Sections translated together in one call
+TRANSLATION_GROUPS = (
+    ('obj_1', 'obj_2', 'obj_3', 'topic', 'integration_within', 'integration_across'),
+    ('resources',),
+    ('procedure',),
+    ('evaluation',),
+)
+# Kept in the source language: the image prompt, so both versions share one picture
+TRANSLATION_KEEP = {('procedure', 'visual_prompt')}
+
+_translation_executor = shared('translation_executor',
+                               lambda: ThreadPoolExecutor(max_workers=8, thread_name_prefix="translate"))
+
+def other_language(language):
+    return 'filipino' if language == 'english' else 'english'
+
+def build_translation_prompt(sections, source_language, target_language):
+    return f"""Translate the string values of this JSON from {LANGUAGE_LABELS[source_language]} to {LANGUAGE_LABELS[target_language]} for a Daily Lesson Plan.
+{get_language_instruction(target_language)}
+- Keep every key, the nesting and the order exactly as given; translate values only
+- In assessment questions keep the "|" separators, the A. B. C. D. labels and the answer letter at the end
+- Keep math expressions, numbers, competency codes and page references unchanged
+Return ONLY the JSON object. No markdown formatting.
+
+{json.dumps(sections, ensure_ascii=False)}"""
+
+def _merge_translation(original, translated):
+    """Translated values where they fit the original's shape, the original everywhere else"""
+    if isinstance(original, dict):
+        translated = translated if isinstance(translated, dict) else {}
+        return {key: _merge_translation(value, translated.get(key)) for key, value in original.items()}
+    if isinstance(original, list):
+        translated = translated if isinstance(translated, list) and len(translated) == len(original) else original
+        return [_merge_translation(a, b) for a, b in zip(original, translated)]
+    if isinstance(original, str) and isinstance(translated, str) and translated.strip():
+        return translated
+    return original
+
+def _translate_sections(model, sections, source_language, target_language):
+    """One translation call for a group of top-level sections. Raises on failure."""
+    outgoing = copy.deepcopy(sections)
+    for section, key in TRANSLATION_KEEP:
+        if isinstance(outgoing.get(section), dict):
+            outgoing[section].pop(key, None)
+    prompt = build_translation_prompt(outgoing, source_language, target_language)
+    translated = parse_ai_response(_response_text(tracked_generate(model, prompt, 'translate')))
+    if not isinstance(translated, dict):
+        raise ValueError("translation response is not a JSON object")
+    return _merge_translation(sections, translated)
+
+def start_lesson_translation(inputs, api_key, target_language=None):
+    """Translator state for one lesson. target_language defaults to the other language."""
+    inputs = normalize_lesson_inputs(inputs)
+    source = detect_inputs_language(inputs)
+    set_usage_context(api_key=api_key)
+    return {
+        'model': resolve_model(None, api_key),
+        'source': source,
+        'target': target_language or other_language(source),
+        'sections': {},
+        'futures': {},
+        # Catalog titles and page references are not translated
+        'catalog': lookup_resources(inputs),
+        'keep': {'resources'} if resources_complete(lookup_resources(inputs)) else set(),
+    }
+
+def translate_lesson_section(state, key, value):
+    """Feed one streamed section; a group's translation starts once all its sections are in"""
+    state['sections'][key] = value
+    for group in TRANSLATION_GROUPS:
+        if set(group) <= state['keep']:
+            continue
+        if key in group and all(k in state['sections'] for k in group):
+            _submit_translation(state, group, {k: state['sections'][k] for k in group})
+
+def _submit_translation(state, group, sections):
+    signature = json.dumps(sections, sort_keys=True, default=str)
+    current = state['futures'].get(group)
+    if current is None or current[0] != signature:
+        future = submit_with_context(_translation_executor, _translate_sections,
+                                     state['model'], sections, state['source'], state['target'])
+        state['futures'][group] = (signature, future)
+    return state['futures'][group][1]
+
+def finish_lesson_translation(state, ai_data, on_error=None):
+    """
+    Translated copy of the final ai_data. Groups that changed after streaming
+    (repairs) are translated again; a group whose translation fails stays in the
+    source language.
+    """
+    futures = [
+        (group, _submit_translation(state, group, {k: ai_data[k] for k in group if k in ai_data}))
+        for group in TRANSLATION_GROUPS if not set(group) <= state['keep']
+    ]
+    translated = dict(ai_data)
+    for group, future in futures:
+        try:
+            translated.update(future.result())
+        except Exception as e:
+            if on_error:
+                on_error(f"Translation of {', '.join(group)} failed, kept in "
+                         f"{LANGUAGE_LABELS[state['source']]}: {e}")
+    if state.get('catalog') and 'resources' in translated:
+        translated['resources'] = merge_catalog_resources(translated['resources'], state['catalog'])
+    return translated
+
+@replay_logged('lesson_dual')
+def generate_dual_language_plans(inputs, api_key, on_progress=None, on_error=None, on_raw_response=None,
+                                 hedge=False, on_section=None):
+    """
+    generate_lesson_plan plus a translation into the other language.
+    Returns {language: ai_data} with the detected language first, or None without an API key.
+    """
+    if not api_key:
+        return generate_lesson_plan(inputs, api_key, on_error=on_error)
+    
+    state = start_lesson_translation(inputs, api_key)
+    
+    def on_streamed_section(key, value):
+        translate_lesson_section(state, key, value)
+        if on_section:
+            on_section(key, value)
+    
+    ai_data = generate_lesson_plan(inputs, api_key, on_progress, on_error, on_raw_response,
+                                   hedge=hedge, on_section=on_streamed_section)
+    note_replay(translated_to=state['target'], translation_kept=sorted(state['keep']))
+    if on_progress:
+        on_progress(f"🌐 Translating to {LANGUAGE_LABELS[state['target']]}", "info")
+    return {
+        state['source']: ai_data,
+        state['target']: finish_lesson_translation(state, ai_data, on_error),
+    }
+
+def lesson_file_name(inputs, language=None):
+    name = f"DLP_{inputs['subject']}_{inputs['grade']}_Q{inputs['quarter']}_{date.today()}"
+    if language:
+        name += f"_{LANGUAGE_FILE_SUFFIXES[language]}"
+    return name + ".docx"
+
+# --- 5I. PLAN ANALYTICS ---
+# One row per delivered plan (generation metadata only, never lesson text) for the
+# coverage dashboard. Rows are appended to a JSON-lines staging file and moved in
+# batches into Parquet files partitioned by month; a month's small files are merged
+# once there are more than ANALYTICS_MAX_PARTS, so a school year reads as a few
+# column-wise scans.
+ANALYTICS_DIR = os.path.join(DATA_DIR, "analytics")
+ANALYTICS_PENDING_FILE = os.path.join(ANALYTICS_DIR, "pending.jsonl")
+ANALYTICS_PARQUET_DIR = os.path.join(ANALYTICS_DIR, "plans")
+ANALYTICS_FLUSH_ROWS = int(os.environ.get("DLP_ANALYTICS_FLUSH_ROWS", "200"))
+ANALYTICS_MAX_PARTS = 8
+SCHOOL_YEAR_START_MONTH = int(os.environ.get("DLP_SCHOOL_YEAR_START_MONTH", "6"))
+
+ANALYTICS_SCHEMA = pa.schema([
+    ('ts', pa.float64()), ('day', pa.string()), ('record_id', pa.string()), ('kind', pa.string()),
+    ('school', pa.string()), ('profile_id', pa.string()),
+    ('subject', pa.string()), ('grade', pa.string()), ('quarter', pa.string()),
+    ('competency_code', pa.string()), ('competency', pa.string()), ('language', pa.string()),
+    ('seconds', pa.float64()), ('model_calls', pa.int32()), ('model_errors', pa.int32()),
+    ('repairs', pa.int32()), ('fallback_sections', pa.int32()), ('fallback_all', pa.bool_()),
+    ('failed', pa.bool_()),
+])
+_ANALYTICS_PARTITIONING = ds.partitioning(pa.schema([('month', pa.string())]), flavor='hive')
+
+_analytics_state = shared('plan_analytics', lambda: {'lock': threading.Lock(), 'pending': None})
+
+def competency_code(competency):
+    match = COMPETENCY_CODE_PATTERN.match(competency or '')
+    return match.group(1) if match else ''
+
+def plan_analytics_rows(record):
+    """Rows for one generation job record (see replay_logged): one per plan delivered"""
+    notes, stages, result = record.get('notes', {}), record.get('stages', []), record.get('result')
+    if notes.get('coalesced_from'):
+        stages = []  # the leader's calls, already counted in its own row
+    validations = notes.get('validation', [])
+    base = {
+        'ts': record['ts'], 'day': time.strftime('%Y-%m-%d', time.localtime(record['ts'])),
+        'record_id': record['id'], 'kind': record['kind'], 'profile_id': record.get('profile_id', ''),
+        'language': notes.get('language', ''), 'seconds': record.get('seconds', 0.0),
+        'model_calls': len(stages), 'model_errors': sum(1 for s in stages if s['error']),
+        'repairs': sum(1 for s in stages if s['stage'] == 'repair'),
+        'fallback_all': 'generation_error' in notes,
+        'failed': result is None or 'error' in record,
+    }
+    
+    def row(inputs, **extra):
+        competency = str(inputs.get('competency') or '')
+        return dict(
+            base,
+            school=str(inputs.get('school') or ''), subject=str(inputs.get('subject') or ''),
+            grade=str(inputs.get('grade') or ''), quarter=str(inputs.get('quarter') or ''),
+            competency_code=competency_code(competency), competency=competency[:300],
+            fallback_sections=sum(len(v['fallback']) for v in validations if v['competency'] == competency),
+            **extra
+        )
+    
+    inputs = notes.get('normalized_inputs') or record.get('inputs') or {}
+    if record['kind'] == 'quarter' and result:
+        return [row(lesson_inputs) for lesson_inputs, _ in result]
+    if record['kind'] == 'lesson_dual' and isinstance(result, dict):
+        return [row(inputs, language=language) for language in result]
+    return [row(inputs)]
+
+def record_plan_analytics(record):
+    """Stage the rows of a finished job; every ANALYTICS_FLUSH_ROWS rows they go to Parquet"""
+    try:
+        rows = plan_analytics_rows(record)
+        state = _analytics_state
+        with state['lock']:
+            os.makedirs(ANALYTICS_DIR, exist_ok=True)
+            with open(ANALYTICS_PENDING_FILE, 'a', encoding='utf-8') as f:
+                f.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+            if state['pending'] is None:
+                state['pending'] = len(_read_pending_rows(ANALYTICS_PENDING_FILE))
+            else:
+                state['pending'] += len(rows)
+            due = state['pending'] >= ANALYTICS_FLUSH_ROWS
+        if due:
+            flush_plan_analytics()
+    except (OSError, ValueError, KeyError, pa.ArrowException):
+        pass  # Analytics must never break generation
+
+def _read_pending_rows(path):
+    rows = []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    continue  # Half-written line of a crashed process
+    except FileNotFoundError:
+        pass
+    return rows
+
+def _write_parquet(table, directory, suffix=""):
+    """Write under a dot name (ignored by readers) and rename into place"""
+    name = f"part-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{secrets.token_hex(3)}{suffix}.parquet"
+    temp_path = os.path.join(directory, "." + name)
+    pq.write_table(table, temp_path, compression='zstd')
+    os.replace(temp_path, os.path.join(directory, name))
+
+def _compact_month(directory):
+    """Merge a month's part files into one; skipped while another process is merging"""
+    parts = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                   if name.startswith('part-') and name.endswith('.parquet'))
+    if len(parts) <= ANALYTICS_MAX_PARTS:
+        return
+    lock_path = os.path.join(directory, ".compacting")
+    try:
+        fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+    except FileExistsError:
+        if time.time() - os.path.getmtime(lock_path) > 600:
+            os.remove(lock_path)  # Left by a crashed process; merge next time
+        return
+    try:
+        _write_parquet(ds.dataset(parts, format='parquet', schema=ANALYTICS_SCHEMA).to_table(), directory, "-merged")
+        for path in parts:
+            os.remove(path)
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+def flush_plan_analytics():
+    """Move staged rows into one Parquet file per month. Returns the number of rows moved"""
+    state = _analytics_state
+    with state['lock']:
+        claimed = os.path.join(ANALYTICS_DIR, f"pending-{os.getpid()}-{secrets.token_hex(3)}.claimed")
+        try:
+            os.replace(ANALYTICS_PENDING_FILE, claimed)
+        except FileNotFoundError:
+            return 0
+        state['pending'] = 0
+        rows = _read_pending_rows(claimed)
+        months = {}
+        for row in rows:
+            months.setdefault(row['day'][:7], []).append(row)
+        for month, month_rows in months.items():
+            directory = os.path.join(ANALYTICS_PARQUET_DIR, f"month={month}")
+            os.makedirs(directory, exist_ok=True)
+            _write_parquet(pa.Table.from_pylist(month_rows, schema=ANALYTICS_SCHEMA), directory)
+            _compact_month(directory)
+        os.remove(claimed)
+    return len(rows)
+
+def load_plan_analytics(since=None):
+    """Rows with ts >= since (all rows if None) as a DataFrame, staged rows included"""
+    since = since or 0
+    tables = []
+    if os.path.isdir(ANALYTICS_PARQUET_DIR):
+        dataset = ds.dataset(ANALYTICS_PARQUET_DIR, format='parquet', partitioning=_ANALYTICS_PARTITIONING,
+                             schema=ANALYTICS_SCHEMA.append(pa.field('month', pa.string())))
+        since_month = time.strftime('%Y-%m', time.localtime(since))
+        # The month filter prunes whole directories before any file is opened
+        tables.append(dataset.to_table(
+            columns=ANALYTICS_SCHEMA.names,
+            filter=(ds.field('month') >= since_month) & (ds.field('ts') >= since)
+        ))
+    pending = [row for row in _read_pending_rows(ANALYTICS_PENDING_FILE) if row['ts'] >= since]
+    if pending:
+        tables.append(pa.Table.from_pylist(pending, schema=ANALYTICS_SCHEMA))
+    if not tables:
+        return ANALYTICS_SCHEMA.empty_table().to_pandas()
+    return pa.concat_tables(tables).to_pandas()
+
+def school_year_start(now=None):
+    local = time.localtime(now or time.time())
+    year = local.tm_year if local.tm_mon >= SCHOOL_YEAR_START_MONTH else local.tm_year - 1
+    return date(year, SCHOOL_YEAR_START_MONTH, 1)
+
+def curriculum_frame():
+    """The curriculum guide index as a DataFrame (subject, grade, quarter, code, competency)"""
+    if 'frame' not in _curriculum_cache:
+        index = load_curriculum_index()
+        strings = pd.Series(index['strings'], dtype=object)
+        frame = pd.DataFrame({
+            name: strings.take(index['columns'][name]).to_numpy()
+            for name in ('subject', 'grade', 'quarter', 'competency')
+        })
+        frame['code'] = index['codes']
+        _curriculum_cache['frame'] = frame
+    return _curriculum_cache['frame']
+
+def plan_analytics_summary(df):
+    """
+    Aggregations for the coverage dashboard, all vectorized over the rows of
+    load_plan_analytics: coverage per subject/grade/quarter (against the
+    curriculum guide when it lists the subject), use per teacher, and daily
+    plan counts, latency and fallback/failure rates.
+    """
+    df = df.assign(
+        fallback=df['fallback_all'] | (df['fallback_sections'] > 0),
+        code_key=df['competency_code'].str.lower(),
+    )
+    keys = ['subject', 'grade', 'quarter']
+    
+    coverage = df.groupby(keys, as_index=False).agg(
+        plans=('record_id', 'size'), competencies=('competency', 'nunique'), fallback_rate=('fallback', 'mean')
+    )
+    guide = curriculum_frame()
+    if len(guide):
+        guide = guide.assign(covered=guide['code'].str.lower().isin(df['code_key'].unique()))
+        guide_coverage = guide.groupby(keys, as_index=False).agg(
+            in_guide=('code', 'size'), guide_covered=('covered', 'sum')
+        )
+        coverage = coverage.merge(guide_coverage, on=keys, how='outer')
+        coverage[['plans', 'competencies', 'guide_covered']] = (
+            coverage[['plans', 'competencies', 'guide_covered']].fillna(0).astype(int)
+        )
+        coverage['coverage'] = (coverage['guide_covered'] / coverage['in_guide']).round(3)
+    coverage['fallback_rate'] = coverage['fallback_rate'].round(3)
+    
+    teachers = df.groupby('profile_id', as_index=False).agg(
+        plans=('record_id', 'size'), competencies=('competency', 'nunique'),
+        fallback_rate=('fallback', 'mean'), failed=('failed', 'sum'), last_ts=('ts', 'max')
+    ).sort_values('plans', ascending=False)
+    teachers['fallback_rate'] = teachers['fallback_rate'].round(3)
+    
+    # Latency is per job: a quarter plan is one job however many lessons it delivers
+    jobs = df.drop_duplicates('record_id')
+    daily = df.groupby('day').agg(plans=('record_id', 'size'), fallback_rate=('fallback', 'mean'),
+                                  failure_rate=('failed', 'mean'))
+    latency = jobs.groupby('day')['seconds'].quantile([0.5, 0.9]).unstack()
+    latency.columns = ['median_s', 'p90_s']
+    daily = daily.join(latency)
+    by_kind = jobs.groupby('kind').agg(
+        jobs=('record_id', 'size'), median_s=('seconds', 'median'), model_calls=('model_calls', 'mean'),
+        repairs=('repairs', 'mean'), model_errors=('model_errors', 'sum'), failure_rate=('failed', 'mean')
+    ).round(3)
+    
+    return {
+        'totals': {
+            'plans': len(df), 'teachers': df['profile_id'].nunique(),
+            'competencies': df['competency'].nunique(),
+            'fallback_rate': float(df['fallback'].mean()) if len(df) else 0.0,
+            'failure_rate': float(df['failed'].mean()) if len(df) else 0.0,
+            'median_s': float(jobs['seconds'].median()) if len(jobs) else 0.0,
+        },
+        'coverage': coverage,
+        'teachers': teachers,
+        'daily': daily,
+        'by_kind': by_kind,
+    }
+
+def uncovered_competencies(df, subject, grade, quarter):
+    """Curriculum guide competencies of one subject/grade/quarter with no plan yet"""
+    guide = curriculum_frame()
+    selected = guide[(guide['subject'] == subject) & (guide['grade'] == grade) & (guide['quarter'] == quarter)]
+    return selected[~selected['code'].str.lower().isin(df['competency_code'].str.lower().unique())][['code', 'competency']]
+
+# --- 5J. REQUEST COALESCING ---
+# Teachers of one grade-level team often submit the same competency within seconds
+# (LAC sessions). Single flight: the first request for a lesson runs the model and
+# identical requests arriving while it runs wait for its result instead of making
+# their own calls. Nothing is cached after the flight lands, and "different version"
+# requests never join one.
+COALESCE_ENABLED = os.environ.get("DLP_COALESCE", "1") != "0"
+COALESCE_POLL_SECONDS = 0.2    # How often waiters pick up newly streamed sections
+
+_inflight_lock = shared('inflight_lock', threading.Lock)
+_inflight_generations = shared('inflight_generations', dict)
+_coalesce_stats = shared('coalesce_stats', lambda: {'leaders': 0, 'followers': 0, 'unshared': 0})
+
+def generation_coalesce_key(inputs, dual_language=False):
+    """Requests with equal keys get interchangeable lessons: normalized inputs, case and spacing ignored"""
+    normalized = normalize_lesson_inputs(inputs)
+    parts = {field: re.sub(r'\s+', ' ', value).strip().lower() if isinstance(value, str) else value
+             for field, value in normalized.items()}
+    parts['dual_language'] = bool(dual_language)
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:24]
+
+def coalesced_generation(key, generate, on_progress=None, on_error=None, on_section=None):
+    """
+    Run generate(on_error, on_section) once per key at a time. The first caller runs
+    it; callers arriving meanwhile wait, get its streamed sections on their own
+    thread, and a copy of its result. A result with placeholder sections (according
+    to its job record) is not shared: waiters then generate their own. Each waiter that gets the shared result writes its own job record, so
+    the replay log and plan analytics count every teacher.
+    """
+    with _inflight_lock:
+        flight = _inflight_generations.get(key)
+        leading = flight is None
+        if leading:
+            flight = _inflight_generations[key] = {'future': Future(), 'sections': []}
+            _coalesce_stats['leaders'] += 1
+        else:
+            _coalesce_stats['followers'] += 1
+    
+    if leading:
+        def lead_section(section_key, value):
+            flight['sections'].append((section_key, value))
+            on_section(section_key, value)
+        
+        try:
+            result, records = call_with_replay_records(generate, on_error, lead_section if on_section else None)
+        except BaseException as e:
+            flight['future'].set_exception(e)
+            raise
+        finally:
+            with _inflight_lock:
+                _inflight_generations.pop(key, None)
+        shareable = not used_placeholders(result, records)
+        flight['future'].set_result((result, records[-1]) if shareable else None)
+        return result
+    
+    if on_progress:
+        on_progress("🤝 The same lesson is being generated for another teacher; sharing that result", "info")
+    started = time.monotonic()
+    delivered = 0
+    while True:
+        done, _ = wait([flight['future']], timeout=COALESCE_POLL_SECONDS)
+        sections = flight['sections']
+        if on_section:
+            for section_key, value in sections[delivered:]:
+                on_section(section_key, copy.deepcopy(value))
+        delivered = len(sections)
+        if done:
+            break
+    
+    shared_result = None if flight['future'].exception() else flight['future'].result()
+    if shared_result is None:
+        with _inflight_lock:
+            _coalesce_stats['unshared'] += 1
+        if on_progress:
+            on_progress("↻ The shared generation did not succeed; generating this lesson separately", "warning")
+        return generate(on_error, on_section)
+    result, leader_record = shared_result
+    record = _follower_record(leader_record, time.monotonic() - started)
+    finish_replay_record(record)
+    _notify_replay_listener(record)
+    return copy.deepcopy(result)
+
+def _follower_record(leader_record, seconds):
+    """
+    Job record of a waiter that got the leader's result. It keeps the leader's stages
+    so dlp_replay can re-run it; coalesced_from tells the analytics it made no calls.
+    """
+    context = _usage_context.get() or {}
+    return dict(
+        leader_record,
+        id=f"{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}",
+        ts=time.time(),
+        profile_id=context.get('profile_id', ''),
+        notes=dict(leader_record['notes'], coalesced_from=leader_record['id']),
+        seconds=round(seconds, 3),
+    )
+
+def get_coalesce_stats():
+    with _inflight_lock:
+        stats = dict(_coalesce_stats)
+        stats['in_flight'] = len(_inflight_generations)
+    return stats
+
+# --- 5K. OFFLINE QUEUE ---
+# For teachers on unreliable mobile data: a lesson can be queued instead of waiting
+# on a live model call. Jobs live in the profile database, so they survive a dropped
+# connection, a closed tab and a server restart. One background worker runs them
+# whenever the Gemini API is reachable and delivers the DOCX file(s) and the history
+# run (5E) in the same transaction that marks the job done. Job IDs come from the
+# teacher and the lesson, so submitting twice queues one job, and a retried job is
+# delivered at most once. A lesson generated while the teacher waits is a job too,
+# leased by the page: its documents are delivered here as well, and if the page
+# stops first (closed tab, dropped connection) the worker finishes it.
+QUEUE_POLL_SECONDS = int(os.environ.get("DLP_QUEUE_POLL_SECONDS", "15"))
+QUEUE_MAX_ATTEMPTS = int(os.environ.get("DLP_QUEUE_MAX_ATTEMPTS", "6"))
+QUEUE_RETRY_SECONDS = 60          # First retry delay; doubles per attempt
+QUEUE_RETRY_MAX_SECONDS = 3600
+QUEUE_LEASE_SECONDS = 900         # A running job not finished by then is picked up again
+QUEUE_KEEP_DAYS = 14              # Finished jobs and their documents are kept this long
+QUEUE_UPSTREAM_URL = (GEMINI_API_ENDPOINT if re.match(r'https?://', GEMINI_API_ENDPOINT or '')
+                      else f"https://{GEMINI_API_ENDPOINT or 'generativelanguage.googleapis.com'}/")
+QUEUE_STATUS_LABELS = {
+    'queued': "⏳ Waiting for a connection", 'running': "⚙️ Generating",
+    'done': "✅ Ready", 'failed': "❌ Failed",
+}
+
+_queue_wakeup = shared('queue_wakeup', threading.Event)
+
+def _queue_db():
+    conn = _history_db()
+    conn.execute("""CREATE TABLE IF NOT EXISTS queued_jobs (
+        id TEXT PRIMARY KEY,
+        profile_id TEXT NOT NULL,
+        created REAL NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_try REAL NOT NULL,
+        lease TEXT,
+        leased_until REAL,
+        inputs TEXT NOT NULL,
+        options TEXT NOT NULL,
+        api_key BLOB,
+        error TEXT,
+        finished REAL
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS queued_documents (
+        job_id TEXT NOT NULL,
+        file_name TEXT NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (job_id, file_name)
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS queued_jobs_due ON queued_jobs (status, next_try)")
+    conn.execute("CREATE INDEX IF NOT EXISTS queued_jobs_profile ON queued_jobs (profile_id, created)")
+    return conn
+
+def queue_job_id(profile_id, inputs, dual_language=False, nonce=None):
+    """Idempotency key: the same teacher queueing the same lesson gets the same job"""
+    parts = [profile_id, generation_coalesce_key(inputs, dual_language), nonce or '']
+    return hashlib.sha256("\x1f".join(parts).encode('utf-8')).hexdigest()[:24]
+
+def enqueue_lesson(profile_id, inputs, api_key, teacher_name, principal_name, dual_language=False,
+                   different_version=False):
+    """
+    Queue one lesson for the background worker. Returns (job_id, created): created
+    is False when the job was already queued (or already delivered).
+    different_version=True always queues a new job.
+    """
+    if not profile_id or not api_key:
+        raise ValueError("a profile and an API key are needed to queue a lesson")
+    job_id = queue_job_id(profile_id, inputs, dual_language, secrets.token_hex(8) if different_version else None)
+    options = {'dual_language': bool(dual_language), 'teacher_name': teacher_name, 'principal_name': principal_name}
+    now = time.time()
+    with _profile_db_lock:
+        conn = _queue_db()
+        try:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO queued_jobs (id, profile_id, created, next_try, inputs, options, api_key) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, profile_id, now, now, json.dumps(inputs, ensure_ascii=False), json.dumps(options),
+                 sqlite3.Binary(_get_fernet().encrypt(api_key.encode('utf-8'))))
+            )
+            created = cursor.rowcount == 1
+            if not created:
+                # A failed job is tried again from the start; anything else is left alone
+                conn.execute(
+                    "UPDATE queued_jobs SET status = 'queued', attempts = 0, next_try = ?, error = NULL, api_key = ? "
+                    "WHERE id = ? AND status = 'failed'",
+                    (now, sqlite3.Binary(_get_fernet().encrypt(api_key.encode('utf-8'))), job_id)
+                )
+            conn.commit()
+        finally:
+            conn.close()
+    _queue_wakeup.set()
+    return job_id, created
+
+def start_interactive_job(profile_id, inputs, api_key, teacher_name, principal_name, dual_language=False):
+    """
+    Record a lesson about to be generated on the page as a running job leased by the
+    page. Returns (job, lease) like _claim_queued_job, or None without a profile or key.
+    """
+    if not profile_id or not api_key:
+        return None
+    job_id = queue_job_id(profile_id, inputs, dual_language, secrets.token_hex(8))
+    options = {'dual_language': bool(dual_language), 'teacher_name': teacher_name, 'principal_name': principal_name}
+    now = time.time()
+    lease = secrets.token_hex(8)
+    with _profile_db_lock:
+        conn = _queue_db()
+        try:
+            conn.execute(
+                "INSERT INTO queued_jobs (id, profile_id, created, status, attempts, next_try, lease, leased_until, "
+                "inputs, options, api_key) VALUES (?, ?, ?, 'running', 1, ?, ?, ?, ?, ?, ?)",
+                (job_id, profile_id, now, now, lease, now + QUEUE_LEASE_SECONDS,
+                 json.dumps(inputs, ensure_ascii=False), json.dumps(options),
+                 sqlite3.Binary(_get_fernet().encrypt(api_key.encode('utf-8'))))
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    return {'id': job_id, 'profile_id': profile_id, 'inputs': inputs, 'options': options,
+            'api_key': api_key, 'attempt': 1}, lease
+
+def release_queued_job(job, lease):
+    """Hand a leased job back to the worker, due now (the page stopped before finishing it)"""
+    with _profile_db_lock:
+        conn = _queue_db()
+        try:
+            conn.execute("UPDATE queued_jobs SET status = 'queued', next_try = ?, lease = NULL "
+                         "WHERE id = ? AND lease = ?", (time.time(), job['id'], lease))
+            conn.commit()
+        finally:
+            conn.close()
+    _queue_wakeup.set()
+
+def load_queued_jobs(profile_id, limit=20):
+    """A teacher's most recent jobs, newest first, with the names of their documents"""
+    if not profile_id:
+        return []
+    with _profile_db_lock:
+        conn = _queue_db()
+        try:
+            rows = conn.execute(
+                "SELECT id, created, status, attempts, next_try, inputs, options, error, finished "
+                "FROM queued_jobs WHERE profile_id = ? ORDER BY created DESC LIMIT ?", (profile_id, limit)
+            ).fetchall()
+            documents = {}
+            for job_id, file_name in conn.execute(
+                "SELECT job_id, file_name FROM queued_documents WHERE job_id IN "
+                "(SELECT id FROM queued_jobs WHERE profile_id = ?) ORDER BY file_name", (profile_id,)
+            ):
+                documents.setdefault(job_id, []).append(file_name)
+        finally:
+            conn.close()
+    return [
+        {'id': job_id, 'created': created, 'status': status, 'attempts': attempts, 'next_try': next_try,
+         'inputs': json.loads(inputs), 'options': json.loads(options), 'error': error, 'finished': finished,
+         'documents': documents.get(job_id, [])}
+        for job_id, created, status, attempts, next_try, inputs, options, error, finished in rows
+    ]
+
+def load_queued_document(profile_id, job_id, file_name):
+    with _profile_db_lock:
+        conn = _queue_db()
+        try:
+            row = conn.execute(
+                "SELECT d.data FROM queued_documents d JOIN queued_jobs j ON j.id = d.job_id "
+                "WHERE j.profile_id = ? AND d.job_id = ? AND d.file_name = ?", (profile_id, job_id, file_name)
+            ).fetchone()
+        finally:
+            conn.close()
+    return bytes(row[0]) if row else None
+
+def remove_queued_job(profile_id, job_id):
+    """Cancel a waiting job or clear a finished one (a job being generated is left to finish)"""
+    with _profile_db_lock:
+        conn = _queue_db()
+        try:
+            removed = conn.execute("DELETE FROM queued_jobs WHERE profile_id = ? AND id = ? AND status != 'running'",
+                                   (profile_id, job_id)).rowcount == 1
+            if removed:
+                conn.execute("DELETE FROM queued_documents WHERE job_id = ?", (job_id,))
+            conn.commit()
+        finally:
+            conn.close()
+    return removed
+
+def upstream_reachable(timeout=3):
+    """True when the Gemini API answers at all (any HTTP status counts)"""
+    try:
+        requests.head(QUEUE_UPSTREAM_URL, timeout=timeout)
+        return True
+    except requests.RequestException:
+        return False
+
+def _claim_queued_job():
+    """Lease the oldest due job. Returns (job row dict, lease) or None"""
+    now = time.time()
+    lease = secrets.token_hex(8)
+    with _profile_db_lock:
+        conn = _queue_db()
+        try:
+            # Jobs whose worker died (restart, crash) go back into the queue
+            conn.execute("UPDATE queued_jobs SET status = 'queued', lease = NULL "
+                         "WHERE status = 'running' AND leased_until < ?", (now,))
+            row = conn.execute(
+                "SELECT id, profile_id, inputs, options, api_key, attempts FROM queued_jobs "
+                "WHERE status = 'queued' AND next_try <= ? ORDER BY next_try, created LIMIT 1", (now,)
+            ).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE queued_jobs SET status = 'running', lease = ?, leased_until = ?, attempts = attempts + 1 "
+                    "WHERE id = ?", (lease, now + QUEUE_LEASE_SECONDS, row[0])
+                )
+            conn.commit()
+        finally:
+            conn.close()
+    if not row:
+        return None
+    job_id, profile_id, inputs, options, api_key, attempts = row
+    return {'id': job_id, 'profile_id': profile_id, 'inputs': json.loads(inputs), 'options': json.loads(options),
+            'api_key': _get_fernet().decrypt(api_key).decode('utf-8') if api_key else '',
+            'attempt': attempts + 1}, lease
+
+def _retry_queued_job(job, lease, error):
+    """Schedule another attempt with exponential backoff, or fail the job after QUEUE_MAX_ATTEMPTS"""
+    failed = job['attempt'] >= QUEUE_MAX_ATTEMPTS
+    delay = min(QUEUE_RETRY_MAX_SECONDS, QUEUE_RETRY_SECONDS * 2 ** (job['attempt'] - 1))
+    with _profile_db_lock:
+        conn = _queue_db()
+        try:
+            conn.execute(
+                "UPDATE queued_jobs SET status = ?, next_try = ?, lease = NULL, error = ?, "
+                "finished = ?, api_key = CASE WHEN ? THEN NULL ELSE api_key END WHERE id = ? AND lease = ?",
+                ('failed' if failed else 'queued', time.time() + delay, error,
+                 time.time() if failed else None, failed, job['id'], lease)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+def _deliver_queued_job(job, lease, documents, plan=None):
+    """Store the documents and the history run (if given) and mark the job done, all or nothing"""
+    with _profile_db_lock:
+        conn = _queue_db()
+        try:
+            cursor = conn.execute(
+                "UPDATE queued_jobs SET status = 'done', lease = NULL, error = NULL, finished = ?, api_key = NULL "
+                "WHERE id = ? AND status = 'running' AND lease = ?", (time.time(), job['id'], lease)
+            )
+            if cursor.rowcount != 1:
+                conn.rollback()
+                return False   # Cancelled meanwhile, or the lease expired and another attempt owns it
+            conn.executemany(
+                "INSERT OR REPLACE INTO queued_documents (job_id, file_name, data) VALUES (?, ?, ?)",
+                [(job['id'], file_name, sqlite3.Binary(data)) for file_name, data in documents.items()]
+            )
+            if plan is not None:
+                _insert_generation(conn, job['profile_id'], lesson_history_key(job['inputs']), plan, time.time())
+            conn.commit()
+        finally:
+            conn.close()
+    return True
+
+def retry_placeholders(job, placeholders):
+    """Placeholder content is not worth delivering while the job has attempts left"""
+    return placeholders and job['attempt'] < QUEUE_MAX_ATTEMPTS
+
+def run_queued_job(job, lease):
+    """Generate and render one leased job. Returns True when it was delivered"""
+    errors = []
+    options = job['options']
+    set_usage_context(profile_id=job['profile_id'])
+    generate = generate_dual_language_plans if options['dual_language'] else generate_lesson_plan
+    try:
+        ai_data, records = call_with_replay_records(generate, job['inputs'], job['api_key'], on_error=errors.append)
+        if ai_data is None:
+            raise RuntimeError(errors[0] if errors else "no API key")
+        if retry_placeholders(job, used_placeholders(ai_data, records)):
+            raise RuntimeError("some sections are placeholder text")
+        inputs = normalize_lesson_inputs(job['inputs'])
+        teacher, principal = options['teacher_name'], options['principal_name']
+        if options['dual_language']:
+            documents = {lesson_file_name(inputs, language): data for language, data in
+                         render_dual_language_plans(inputs, ai_data, teacher, principal).items()}
+            ai_data = next(iter(ai_data.values()))
+        else:
+            documents = {lesson_file_name(inputs): render_lesson_plan(inputs, ai_data, teacher, principal)}
+    except Exception as e:
+        _retry_queued_job(job, lease, str(e)[:500])
+        return False
+    return _deliver_queued_job(job, lease, documents, lesson_from_json(ai_data))
+
+def cleanup_queued_jobs(max_age=QUEUE_KEEP_DAYS * 86400):
+    cutoff = time.time() - max_age
+    with _profile_db_lock:
+        conn = _queue_db()
+        try:
+            conn.execute("DELETE FROM queued_documents WHERE job_id IN "
+                         "(SELECT id FROM queued_jobs WHERE status IN ('done', 'failed') AND finished < ?)", (cutoff,))
+            conn.execute("DELETE FROM queued_jobs WHERE status IN ('done', 'failed') AND finished < ?", (cutoff,))
+            conn.commit()
+        finally:
+            conn.close()
+
+def process_queued_jobs():
+    """Run due jobs until none is left or the API stops answering. Returns the number delivered"""
+    delivered = 0
+    while upstream_reachable():
+        claimed = _claim_queued_job()
+        if claimed is None:
+            break
+        delivered += run_queued_job(*claimed)
+    return delivered
+
+def _queue_worker_loop():
+    cleaned = 0
+    while True:
+        try:
+            process_queued_jobs()
+            if time.time() - cleaned > 3600:
+                cleanup_queued_jobs()
+                cleaned = time.time()
+        except Exception:
+            pass   # A broken database or a bad row must not stop the worker; try again next poll
+        _queue_wakeup.wait(QUEUE_POLL_SECONDS)
+        _queue_wakeup.clear()
+
+def _start_queue_thread():
+    thread = threading.Thread(target=_queue_worker_loop, name="dlp-queue", daemon=True)
+    thread.start()
+    return thread
+
+def start_queue_worker():
+    """Start the process-wide queue worker once (later calls and reruns find it running)"""
+    return shared('queue_worker', _start_queue_thread)
+
+# --- 6. IMAGE FETCHER ---
+# Provider chain: local clipart -> pollinations.ai (hedged) -> drawn placeholder
+# No pictures ship with the app: the clipart folder is empty until a school adds
+# its own, and until then every lookup goes on to the remote service. The keyword
+# index is runtime data, so it lives in DATA_DIR rather than the source tree.
+CLIPART_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clipart")
+CLIPART_INDEX_FILE = os.path.join(DATA_DIR, "clipart_index.json")
+CLIPART_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+REMOTE_IMAGE_ENDPOINT = os.environ.get("DLP_IMAGE_ENDPOINT", "https://image.pollinations.ai").rstrip('/')
+REMOTE_IMAGE_TIMEOUT = (3.05, 10)     # (connect, read) seconds per request; rendering takes seconds
+REMOTE_IMAGE_HEDGE_DELAY = 5.0        # Send a second request (same seed) if the first is slower than this
+REMOTE_IMAGE_DEADLINE = 10.0          # Give up on the remote service after this many seconds
+REMOTE_IMAGE_COOLDOWN = 120           # Skip the remote service for a while after it cannot be reached
+
+IMAGE_KEYWORD_STOPWORDS = {
+    'the', 'and', 'for', 'with', 'from', 'into', 'image', 'picture', 'photo',
+    'simple', 'visual', 'illustration', 'showing', 'of', 'a', 'an', 'in', 'on'
+}
+
+_clipart_cache = shared('clipart_index', dict)
+_clipart_index_lock = shared('clipart_index_lock', threading.Lock)
+_remote_image_state = shared('remote_image_state', lambda: {'down_until': 0.0})
+_remote_image_executor = shared('remote_image_executor',
+                                lambda: ThreadPoolExecutor(max_workers=4, thread_name_prefix="image-fetch"))
+
+def _image_keyword_tokens(text):
+    """Split a visual prompt or file name into normalized keyword tokens"""
+    tokens = []
+    for word in re.split(r'[^a-z0-9]+', str(text).lower()):
+        if len(word) < 3 or word in IMAGE_KEYWORD_STOPWORDS:
+            continue
+        # Cheap singularization so "apples" matches "apple"
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+def build_clipart_index(clipart_dir=CLIPART_DIR, index_file=CLIPART_INDEX_FILE):
+    """
+    Scan the clipart folder and write a keyword -> files index.
+    File names are the keywords, e.g. "red_apple_fruit.png" or "plant-cell.jpg".
+    """
+    files = []
+    keywords = {}
+    
+    if os.path.isdir(clipart_dir):
+        for root, _dirs, names in os.walk(clipart_dir):
+            for name in sorted(names):
+                if not name.lower().endswith(CLIPART_EXTENSIONS):
+                    continue
+                rel_path = os.path.relpath(os.path.join(root, name), clipart_dir)
+                stem = os.path.splitext(rel_path)[0]
+                tokens = sorted(set(_image_keyword_tokens(stem)))
+                if not tokens:
+                    continue
+                file_id = len(files)
+                files.append({'path': rel_path, 'tokens': len(tokens)})
+                for token in tokens:
+                    keywords.setdefault(token, []).append(file_id)
+    
+    index = {'files': files, 'keywords': keywords}
+    
+    if index_file and os.path.isdir(clipart_dir):
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        with open(index_file, 'w', encoding='utf-8') as f:
+            json.dump(index, f, separators=(',', ':'))
+    
+    return index
+
+def load_clipart_index():
+    """Load the precomputed clipart index once per process (built on first use if missing)"""
+    if 'index' in _clipart_cache:
+        return _clipart_cache['index']
+    
+    with _clipart_index_lock:
+        if 'index' not in _clipart_cache:
+            try:
+                with open(CLIPART_INDEX_FILE, 'r', encoding='utf-8') as f:
+                    _clipart_cache['index'] = json.load(f)
+            except (OSError, ValueError):
+                try:
+                    _clipart_cache['index'] = build_clipart_index()
+                except OSError:
+                    _clipart_cache['index'] = {'files': [], 'keywords': {}}
+    
+    return _clipart_cache['index']
+
+def find_clipart(keywords):
+    """Return the local clipart that best matches the visual prompt keywords, or None"""
+    index = load_clipart_index()
+    if not index['files']:
+        return None
+    
+    scores = {}
+    for token in set(_image_keyword_tokens(keywords)):
+        for file_id in index['keywords'].get(token, ()):
+            scores[file_id] = scores.get(file_id, 0) + 1
+    
+    if not scores:
+        return None
+    
+    # Most matched keywords first, then the most specific (fewest keywords) file
+    best_id = max(scores, key=lambda fid: (scores[fid], -index['files'][fid]['tokens']))
+    
+    try:
+        with open(os.path.join(CLIPART_DIR, index['files'][best_id]['path']), 'rb') as f:
+            return io.BytesIO(f.read())
+    except OSError:
+        return None
+
+def _request_remote_image(keywords, seed, timeout=REMOTE_IMAGE_TIMEOUT):
+    """One request to the remote image service; raises requests.ConnectionError if it cannot be reached"""
+    if not keywords: keywords = "school_classroom"
+    clean_prompt = re.sub(r'[\n\r\t]', ' ', str(keywords))
+    clean_prompt = re.sub(r'[^a-zA-Z0-9 ]', '', clean_prompt).strip()
+    
+    encoded_prompt = urllib.parse.quote(clean_prompt)
+    url = f"{REMOTE_IMAGE_ENDPOINT}/prompt/{encoded_prompt}?width=600&height=350&nologo=true&seed={seed}"
+    url = url.strip()
+    
+    try:
+        headers = {'User-Agent': 'Mozilla/5.0'}
+        response = requests.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 200 and response.content:
+            return io.BytesIO(response.content)
+    except requests.ConnectionError:
+        raise
+    except Exception:
+        return None
+    return None
+
+def fetch_ai_image(keywords, timeout=REMOTE_IMAGE_TIMEOUT):
+    try:
+        return _request_remote_image(keywords, random.randint(1, 9999), timeout)
+    except requests.ConnectionError:
+        return None
+
+def fetch_ai_image_hedged(keywords):
+    """
+    Fetch from the remote image service with a hedged second request and a hard deadline.
+    The backup asks for the same seed, so the service can serve the first render instead
+    of drawing a second one. When no request could connect, the service is skipped for
+    REMOTE_IMAGE_COOLDOWN seconds so offline generations don't pay the timeout again;
+    a slow answer does not count.
+    """
+    if time.monotonic() < _remote_image_state['down_until']:
+        return None
+    
+    seed = random.randint(1, 9999)
+    deadline = time.monotonic() + REMOTE_IMAGE_DEADLINE
+    pending = {_remote_image_executor.submit(_request_remote_image, keywords, seed)}
+    hedged, unreachable = False, 0
+    
+    while pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        
+        wait_for = remaining if hedged else min(remaining, REMOTE_IMAGE_HEDGE_DELAY)
+        done, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+        
+        for future in done:
+            try:
+                result = future.result()
+            except requests.ConnectionError:
+                unreachable += 1
+                continue
+            if result:
+                for other in pending:
+                    other.cancel()
+                return result
+        
+        if not hedged and time.monotonic() < deadline:
+            # Primary is slow or failed: fire one backup request
+            pending.add(_remote_image_executor.submit(_request_remote_image, keywords, seed))
+            hedged = True
+    
+    for other in pending:
+        other.cancel()
+    if unreachable and not pending:
+        _remote_image_state['down_until'] = time.monotonic() + REMOTE_IMAGE_COOLDOWN
+    return None
+
+def _placeholder_font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        # Pillow < 10.1 has no sized default font
+        return ImageFont.load_default()
+
+def draw_placeholder_image(keywords, width=600, height=350):
+    """Draw a simple labelled picture locally so a DLP never ships without a visual"""
+    label = re.sub(r'[^A-Za-z0-9 \-]', ' ', str(keywords or "Lesson Visual"))
+    label = re.sub(r'\s+', ' ', label).strip().title() or "Lesson Visual"
+    
+    seed = int(hashlib.md5(label.encode('utf-8')).hexdigest()[:8], 16)
+    rng = random.Random(seed)
+    hue = rng.random()
+    
+    def rgb(h, l, s):
+        return tuple(int(c * 255) for c in colorsys.hls_to_rgb(h % 1.0, l, s))
+    
+    top, bottom = rgb(hue, 0.85, 0.55), rgb(hue + 0.08, 0.65, 0.55)
+    
+    img = Image.new('RGB', (width, height), top)
+    draw = ImageDraw.Draw(img)
+    
+    for y in range(height):
+        t = y / max(1, height - 1)
+        draw.line([(0, y), (width, y)], fill=tuple(int(a + (b - a) * t) for a, b in zip(top, bottom)))
+    
+    for _ in range(6):
+        r = rng.randint(20, 70)
+        x, y = rng.randint(0, width), rng.randint(0, height)
+        draw.ellipse([x - r, y - r, x + r, y + r], outline=rgb(hue + 0.5, 0.45, 0.5), width=4)
+    
+    font = _placeholder_font(40)
+    lines, current = [], ""
+    for word in label.split():
+        candidate = f"{current} {word}".strip()
+        if current and draw.textlength(candidate, font=font) > width - 60:
+            lines.append(current)
+            current = word
+        else:
+            current = candidate
+    lines.append(current)
+    
+    text = "\n".join(lines[:3])
+    box = draw.multiline_textbbox((0, 0), text, font=font, align='center')
+    x = (width - (box[2] - box[0])) / 2
+    y = (height - (box[3] - box[1])) / 2
+    draw.multiline_text((x + 2, y + 2), text, font=font, fill=(255, 255, 255), align='center')
+    draw.multiline_text((x, y), text, font=font, fill=rgb(hue, 0.2, 0.6), align='center')
+    
+    out = io.BytesIO()
+    img.save(out, format='PNG')
+    out.seek(0)
+    return out
+
+def get_lesson_image(keywords):
+    """Run the image provider chain. Returns (BytesIO, source) where source is clipart/remote/placeholder."""
+    img_data = find_clipart(keywords)
+    if img_data:
+        return img_data, "clipart"
+    
+    img_data = fetch_ai_image_hedged(keywords)
+    if img_data:
+        return img_data, "remote"
+    
+    return draw_placeholder_image(keywords), "placeholder"
+
+# --- 6A. IMAGE PROCESSING ---
+IMAGE_DISPLAY_WIDTH_IN = 3.5   # Width of the lesson picture inside the DOCX
+IMAGE_TARGET_DPI = 150         # Enough for print, small enough for mobile data
+IMAGE_JPEG_QUALITY = 80
+IMAGE_CACHE_MAX_ENTRIES = 64
+
+_image_cache = shared('image_cache', OrderedDict)
+_image_cache_lock = shared('image_cache_lock', threading.Lock)
+
+def _read_image_bytes(image_source):
+    """Return raw bytes from an UploadedFile, BytesIO, file-like or bytes object"""
+    if image_source is None:
+        return None
+    if isinstance(image_source, (bytes, bytearray)):
+        return bytes(image_source)
+    if hasattr(image_source, 'getvalue'):
+        return image_source.getvalue()
+    if hasattr(image_source, 'read'):
+        if hasattr(image_source, 'seek'):
+            image_source.seek(0)
+        return image_source.read()
+    return None
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+def _encode_image(raw_bytes):
+    """
+    Rotate, downscale and recompress an image for embedding in the DOCX.
+    Returns (bytes, upright): upright is False when the EXIF orientation had to be applied.
+    """
+    with Image.open(io.BytesIO(raw_bytes)) as img:
+        upright = img.getexif().get(EXIF_ORIENTATION_TAG, 1) == 1
+        img = ImageOps.exif_transpose(img)
+        
+        max_px = int(IMAGE_DISPLAY_WIDTH_IN * IMAGE_TARGET_DPI)
+        if img.width > max_px:
+            new_height = max(1, round(img.height * max_px / img.width))
+            img = img.resize((max_px, new_height), Image.LANCZOS)
+        
+        has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+        out = io.BytesIO()
+        if has_alpha:
+            # Keep transparency (diagrams, clipart) as optimized PNG
+            img.save(out, format='PNG', optimize=True, dpi=(IMAGE_TARGET_DPI, IMAGE_TARGET_DPI))
+        else:
+            # Photos become progressive JPEG
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            img.save(out, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True,
+                     progressive=True, dpi=(IMAGE_TARGET_DPI, IMAGE_TARGET_DPI))
+        return out.getvalue(), upright
+
+def prepare_image_for_docx(image_source):
+    """
+    Returns a BytesIO with the image resized and recompressed for the DOCX.
+    Results are cached by content digest so reruns and repeated images are free.
+    Falls back to the original bytes if Pillow cannot read the image.
+    """
+    raw_bytes = _read_image_bytes(image_source)
+    if not raw_bytes:
+        return None
+    
+    digest = hashlib.sha256(raw_bytes).hexdigest()
+    
+    with _image_cache_lock:
+        cached = _image_cache.get(digest)
+        if cached is not None:
+            _image_cache.move_to_end(digest)
+            return io.BytesIO(cached)
+    
+    try:
+        processed, upright = _encode_image(raw_bytes)
+        # Never make an already small image bigger, unless the original would show sideways
+        if upright and len(processed) > len(raw_bytes):
+            processed = raw_bytes
+    except Exception:
+        return io.BytesIO(raw_bytes)
+    
+    with _image_cache_lock:
+        _image_cache[digest] = processed
+        _image_cache.move_to_end(digest)
+        while len(_image_cache) > IMAGE_CACHE_MAX_ENTRIES:
+            _image_cache.popitem(last=False)
+    
+    return io.BytesIO(processed)
+
+# --- 7. DOCX HELPERS ---
+def set_cell_background(cell, color_hex):
+    """Sets the background color of a table cell."""
+    shading_elm = parse_xml(r'<w:shd {} w:fill="{}"/>'.format(nsdecls('w'), color_hex))
+    cell._tc.get_or_add_tcPr().append(shading_elm)
+
+def format_text(paragraph, text):
+    """
+    Writes text into a paragraph. Math expressions become Word equations (see 7A);
+    any other ^ (superscript) and _ (subscript) runs are kept as plain formatting.
+    """
+    if not text:
+        return
+
+    for is_math, segment in split_math(str(text)):
+        omml = math_to_omml(segment) if is_math else None
+        if omml is not None:
+            paragraph._p.append(parse_xml(omml))
+        else:
+            _format_scripts(paragraph, segment)
+
+def _format_scripts(paragraph, text):
+    """Parses text for single-token ^ (superscript) and _ (subscript) runs."""
+    if not text:
+        return
+
+    pattern = r"([^\^_]*)(([\^_])([0-9a-zA-Z\-]+))(.*)"
+    current_text = str(text)
+    
+    if "^" not in current_text and "_" not in current_text:
+        paragraph.add_run(current_text)
+        return
+
+    while True:
+        match = re.match(pattern, current_text)
+        if match:
+            pre_text = match.group(1)
+            marker = match.group(3)
+            script_text = match.group(4)
+            rest = match.group(5)
+            
+            if pre_text:
+                paragraph.add_run(pre_text)
+            
+            run = paragraph.add_run(script_text)
+            if marker == '^':
+                run.font.superscript = True
+            elif marker == '_':
+                run.font.subscript = True
+                
+            current_text = rest
+            if not current_text:
+                break
+        else:
+            paragraph.add_run(current_text)
+            break
+
+def add_row(table, label, content, bold_label=True):
+    """Adds a row and applies formatting to the content."""
+    row_cells = table.add_row().cells
+    
+    p_lbl = row_cells[0].paragraphs[0]
+    run_lbl = p_lbl.add_run(label)
+    if bold_label:
+        run_lbl.bold = True
+    
+    text_content = ""
+    if isinstance(content, list):
+        text_content = "\n".join([str(item) for item in content])
+    else:
+        text_content = str(content) if content else ""
+    
+    format_text(row_cells[1].paragraphs[0], text_content)
+    return row_cells
+
+def add_section_header(table, text):
+    """Adds a full-width section header with Blue background."""
+    row = table.add_row()
+    row.cells[0].merge(row.cells[1])
+    cell = row.cells[0]
+    cell.text = text
+    cell.paragraphs[0].runs[0].bold = True
+    set_cell_background(cell, "BDD7EE")
+
+def parse_multiple_choice_question(q_text):
+    """Parse a multiple choice question in format: question|A. choice1|B. choice2|C. choice3|D. choice4"""
+    if not q_text:
+        return "No question provided", []
+    
+    parts = q_text.split('|')
+    
+    if len(parts) < 5:
+        return q_text, []
+    
+    question = parts[0].strip()
+    choices = []
+    
+    for i in range(1, min(5, len(parts))):
+        choice = parts[i].strip()
+        if not re.match(r'^[A-D]\.', choice):
+            choice_prefix = ['A.', 'B.', 'C.', 'D.'][i-1]
+            choice = f"{choice_prefix} {choice}"
+        choices.append(choice)
+    
+    while len(choices) < 4:
+        choices.append(f"{['A.', 'B.', 'C.', 'D.'][len(choices)]} Choice placeholder")
+    
+    return question, choices
+
+def parse_answer_letter(q_text):
+    """Letter of the correct choice when the question ends with it ("...|D. choice4|B"), else ''"""
+    parts = (q_text or '').split('|')
+    if len(parts) < 6:
+        return ''
+    match = re.fullmatch(r'\s*(?:[^\W\d_]+\s*:\s*)?([A-Da-d])\.?\s*', parts[5])
+    return match.group(1).upper() if match else ''
+
+def add_assessment_row(table, label, eval_sec):
+    """Special function to add assessment row with multiple choice questions."""
+    row_cells = table.add_row().cells
+    
+    p_lbl = row_cells[0].paragraphs[0]
+    run_lbl = p_lbl.add_run(label)
+    run_lbl.bold = True
+    
+    fill_assessment_cell(row_cells[1], eval_sec)
+    return row_cells
+
+def fill_assessment_cell(content_cell, eval_sec):
+    """Writes the 5-item multiple choice quiz into a cell, replacing its content."""
+    for paragraph in content_cell.paragraphs:
+        p = paragraph._element
+        p.getparent().remove(p)
+    
+    p_header = content_cell.add_paragraph()
+    header_run = p_header.add_run("ASSESSMENT (5-item Multiple Choice Quiz)")
+    header_run.bold = True
+    
+    p_dir = content_cell.add_paragraph()
+    p_dir.add_run("DIRECTIONS: Read each question carefully. Choose the letter of the correct answer from options A, B, C, and D.")
+    
+    content_cell.add_paragraph()
+    
+    for i in range(1, 6):
+        question_key = f'assess_q{i}'
+        raw_question = eval_sec.get(question_key, f'Question {i}')
+        
+        question_text, choices = parse_multiple_choice_question(raw_question)
+        
+        p_question = content_cell.add_paragraph()
+        
+        num_run = p_question.add_run(f"{i}. ")
+        num_run.bold = True
+        
+        if question_text:
+            format_text(p_question, question_text)
+        
+        if choices:
+            for choice in choices:
+                p_choice = content_cell.add_paragraph()
+                p_choice.paragraph_format.left_indent = Inches(0.3)
+                
+                choice_match = re.match(r'^([A-D]\.)\s*(.*)', choice)
+                if choice_match:
+                    letter_part = choice_match.group(1)
+                    text_part = choice_match.group(2)
+                    
+                    letter_run = p_choice.add_run(f"{letter_part} ")
+                    letter_run.bold = True
+                    
+                    if text_part:
+                        format_text(p_choice, text_part)
+                else:
+                    format_text(p_choice, choice)
+        else:
+            for letter in ['A.', 'B.', 'C.', 'D.']:
+                p_choice = content_cell.add_paragraph()
+                p_choice.paragraph_format.left_indent = Inches(0.3)
+                letter_run = p_choice.add_run(f"{letter} ")
+                letter_run.bold = True
+                p_choice.add_run(f"Choice {letter[0]}")
+        
+        if i < 5:
+            content_cell.add_paragraph()
+
+def add_school_header(doc, title_text, school=None):
+    """Adds the DepEd / division / school header and the document title."""
+    school = school or get_school_config()
+    header_para = doc.add_paragraph()
+    header_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    
+    dept_run = header_para.add_run(f"{school['department']}\n")
+    dept_run.bold = True
+    dept_run.font.size = Pt(12)
+    
+    div_run = header_para.add_run(f"{school['division']}\n")
+    div_run.bold = True
+    div_run.font.size = Pt(11)
+    
+    school_run = header_para.add_run(f"{school['name']}\n\n")
+    school_run.bold = True
+    school_run.font.size = Pt(14)
+    
+    title = doc.add_paragraph(title_text)
+    title.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    title.runs[0].bold = True
+    title.runs[0].font.size = Pt(14)
+
+def add_signature_table(doc, teacher_name, principal_name, school=None):
+    """Adds the Prepared by / Noted by signature block."""
+    school = school or get_school_config()
+    sig_table = doc.add_table(rows=1, cols=2)
+    sig_table.autofit = False
+    
+    sig_table.columns[0].width = Inches(4.0)
+    sig_table.columns[1].width = Inches(4.0)
+    
+    row = sig_table.rows[0]
+    
+    teacher_cell = row.cells[0]
+    
+    teacher_header_p = teacher_cell.add_paragraph()
+    teacher_header_run = teacher_header_p.add_run("Prepared by:")
+    teacher_header_run.bold = True
+    
+    teacher_cell.add_paragraph()
+    
+    teacher_name_p = teacher_cell.add_paragraph()
+    teacher_name_run = teacher_name_p.add_run(teacher_name)
+    teacher_name_run.bold = True
+    
+    teacher_position_p = teacher_cell.add_paragraph()
+    teacher_position_p.add_run(school['teacher_position'])
+    
+    principal_cell = row.cells[1]
+    
+    principal_header_p = principal_cell.add_paragraph()
+    principal_header_run = principal_header_p.add_run("Noted by:")
+    principal_header_run.bold = True
+    
+    principal_cell.add_paragraph()
+    
+    principal_name_p = principal_cell.add_paragraph()
+    principal_name_run = principal_name_p.add_run(principal_name)
+    principal_name_run.bold = True
+    
+    principal_position_p = principal_cell.add_paragraph()
+    principal_position_p.add_run(school['principal_position'])
+
+_docx_skeletons = shared('docx_skeletons', dict)
+
+def new_school_document(school, title_text, landscape=False):
+    """
+    New Document with page setup and the school header already in place. The
+    skeleton is built once per school/title/orientation and reopened from bytes.
+    """
+    key = (school['id'], title_text, landscape)
+    skeleton = _docx_skeletons.get(key)
+    if skeleton is None:
+        doc = Document()
+        section = doc.sections[0]
+        if landscape:
+            section.orientation = WD_ORIENT.LANDSCAPE
+            section.page_width, section.page_height = Mm(297), Mm(210)
+        else:
+            section.page_width, section.page_height = Mm(210), Mm(297)
+        section.top_margin = Inches(0.5)
+        section.bottom_margin = Inches(0.5)
+        section.left_margin = Inches(0.5)
+        section.right_margin = Inches(0.5)
+        add_school_header(doc, title_text, school)
+        buffer = io.BytesIO()
+        doc.save(buffer)
+        skeleton = _docx_skeletons[key] = buffer.getvalue()
+    return Document(io.BytesIO(skeleton))
+
+# --- 7A. MATH EQUATIONS (OMML) ---
+# Inline math in AI text, e.g. "(x+1)^2/(x-3)", "x_1 = (-b ± √(b^2-4ac))/2a" or
+# "$\frac{1}{2}$", is written as native Word equations instead of plain runs.
+# The linear syntax follows what the model writes: ^ and _ for scripts, / for
+# fractions (a parenthesized numerator or denominator loses its parentheses),
+# √ or \sqrt for roots and the common LaTeX commands.
+MATH_EQUATIONS_ENABLED = os.environ.get('DLP_MATH_EQUATIONS', '1') != '0'
+MATH_CACHE_MAX_ENTRIES = 2048
+
+MATH_COMMANDS = {
+    'pm': '±', 'mp': '∓', 'times': '×', 'div': '÷', 'cdot': '·', 'le': '≤', 'leq': '≤',
+    'ge': '≥', 'geq': '≥', 'ne': '≠', 'neq': '≠', 'approx': '≈', 'infty': '∞', 'degree': '°',
+    'circ': '°', 'angle': '∠', 'triangle': '△', 'perp': '⊥', 'parallel': '∥', 'to': '→',
+    'rightarrow': '→', 'in': '∈', 'cup': '∪', 'cap': '∩', 'subset': '⊂', 'pi': 'π',
+    'theta': 'θ', 'alpha': 'α', 'beta': 'β', 'gamma': 'γ', 'delta': 'δ', 'Delta': 'Δ',
+    'lambda': 'λ', 'mu': 'μ', 'sigma': 'σ', 'Sigma': 'Σ', 'omega': 'ω', 'left': '', 'right': '',
+}
+MATH_FUNCTIONS = ('sin', 'cos', 'tan', 'cot', 'sec', 'csc', 'log', 'ln', 'exp', 'lim', 'max', 'min')
+MATH_OPERATORS = '+-−–=<>±∓×÷·≤≥≠≈*,|:'
+
+_MATH_NS = 'xmlns:m="http://schemas.openxmlformats.org/officeDocument/2006/math"'
+_MATH_TOKEN = re.compile(r"\s+|\\([A-Za-z]+|.)|(\d+(?:\.\d+)?)|([A-Za-z]+)|(.)", re.S)
+# Pandoc's rule for $...$: no space just inside either $, no digit right after the
+# closing one, so "$5 and $10" stays money
+_MATH_DELIMITED = re.compile(r"\$(?=\S)([^$\n]*?\S)\$(?!\d)|\\\((.+?)\\\)")
+_MATH_TRIGGER = re.compile(r"[\^_][({\[A-Za-z0-9+\-−]|[√∛]|\\(?:frac|d?frac|sqrt)\b|\)/|/\(")
+# Inside $...$ an operator or a lone variable is enough
+_MATH_DELIMITED_TRIGGER = re.compile(_MATH_TRIGGER.pattern + r"|[=<>≤≥±×÷+\-−*/]|\b[A-Za-z]\b")
+_MATH_WORD = re.compile(r"[A-Za-z0-9().\[\]{}+\-−–*/=<>±∓×÷·≤≥≠≈^_√∛\\|'°π]+")
+_MATH_LETTER_RUN = re.compile(r"(?<!\\)[A-Za-z]{3,}")
+_MATH_TRAILING = re.compile(r"[.,;:!?]+$")
+
+_math_cache = shared('math_cache', OrderedDict)
+_math_cache_lock = shared('math_cache_lock', threading.Lock)
+_math_cache_stats = shared('math_cache_stats', lambda: {'hits': 0, 'misses': 0})
+
+def _m_run(text, plain=False):
+    style = '<m:rPr><m:sty m:val="p"/></m:rPr>' if plain else ''
+    return f'<m:r>{style}<m:t xml:space="preserve">{html.escape(text, quote=False)}</m:t></m:r>'
+
+def _tokenize_math(expr):
+    """[(kind, text, space_before)] with kinds num, letter, func, cmd and char"""
+    tokens, space = [], False
+    for match in _MATH_TOKEN.finditer(expr):
+        command, number, letters, char = match.groups()
+        if match.group().isspace():
+            space = True
+            continue
+        if command is not None:
+            if command in ('frac', 'dfrac', 'tfrac', 'sqrt'):
+                tokens.append(('cmd', command.replace('dfrac', 'frac').replace('tfrac', 'frac'), space))
+            elif command in MATH_FUNCTIONS:
+                tokens.append(('func', command, space))
+            else:
+                tokens.append(('char', MATH_COMMANDS.get(command, command), space))
+        elif number is not None:
+            tokens.append(('num', number, space))
+        elif letters is not None:
+            if letters in MATH_FUNCTIONS:
+                tokens.append(('func', letters, space))
+            else:
+                tokens.extend(('letter', letter, space and i == 0) for i, letter in enumerate(letters))
+        else:
+            tokens.append(('char', char, space))
+        space = False
+    return [token for token in tokens if token[1] != '']
+
+class _MathParser:
+    """Recursive-descent parser from the linear syntax to OMML markup"""
+    CLOSERS = {'(': ')', '[': ']', '{': '}'}
+
+    def __init__(self, expr):
+        self.tokens = _tokenize_math(expr)
+        self.pos = 0
+
+    def peek(self, offset=0):
+        index = self.pos + offset
+        return self.tokens[index] if index < len(self.tokens) else (None, None, False)
+
+    def take(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        xml = self.expression(None)
+        while self.pos < len(self.tokens):          # stray closing brackets
+            xml += _m_run(self.take()[1]) + self.expression(None)
+        return xml
+
+    def expression(self, closer):
+        """Operands and operators up to the closing bracket; operands joined by / become fractions"""
+        parts = []
+        while True:
+            kind, text, _ = self.peek()
+            if kind is None or (kind == 'char' and text in (closer, ')', ']', '}')):
+                return ''.join(parts)
+            if kind == 'char' and (text in MATH_OPERATORS or text in ('/', '^', '_')):
+                self.take()
+                parts.append(_m_run(text))
+                continue
+            numerator = self.operand()
+            while self.peek()[:2] == ('char', '/'):
+                self.take()
+                if self.peek()[0] is None:
+                    numerator = (numerator[0] + _m_run('/'), '')
+                    break
+                denominator = self.operand()
+                numerator = (f'<m:f><m:num>{numerator[1] or numerator[0]}</m:num>'
+                             f'<m:den>{denominator[1] or denominator[0]}</m:den></m:f>', '')
+            parts.append(numerator[0])
+
+    def operand(self):
+        """
+        Juxtaposed factors without spaces or operators between them: "2a", "(x+1)^2".
+        Returns (xml, bare xml) where bare drops the brackets of a lone group.
+        """
+        factors = [self.factor()]
+        while True:
+            kind, text, space = self.peek()
+            if kind is None or space or (kind == 'char' and (
+                    text in MATH_OPERATORS or text in ('/', '^', '_', ')', ']', '}'))):
+                break
+            factors.append(self.factor())
+        if len(factors) == 1:
+            return factors[0]
+        return ''.join(xml for xml, _ in factors), ''
+
+    def factor(self):
+        """A primary with optional ^ and _ scripts"""
+        base, bare = self.primary()
+        sup = sub = None
+        while self.peek()[:2] in (('char', '^'), ('char', '_')) and self.peek(1)[0] is not None:
+            marker = self.take()[1]
+            sign = ''
+            if self.peek()[0] == 'char' and self.peek()[1] in '+-−':
+                sign = _m_run(self.take()[1])
+            xml, script_bare = self.primary()
+            script = sign + (script_bare or xml)
+            if marker == '^':
+                sup = script
+            else:
+                sub = script
+        if sup is not None and sub is not None:
+            return f'<m:sSubSup><m:e>{base}</m:e><m:sub>{sub}</m:sub><m:sup>{sup}</m:sup></m:sSubSup>', ''
+        if sup is not None:
+            return f'<m:sSup><m:e>{base}</m:e><m:sup>{sup}</m:sup></m:sSup>', ''
+        if sub is not None:
+            return f'<m:sSub><m:e>{base}</m:e><m:sub>{sub}</m:sub></m:sSub>', ''
+        return base, bare
+
+    def argument(self):
+        xml, bare = self.primary()
+        return bare or xml
+
+    def primary(self):
+        kind, text, _ = self.take()
+        if kind is None:
+            return '', ''
+        if kind == 'func':
+            return _m_run(text, plain=True), ''
+        if kind == 'cmd' and text == 'frac':
+            numerator = self.argument()
+            return f'<m:f><m:num>{numerator}</m:num><m:den>{self.argument()}</m:den></m:f>', ''
+        if (kind == 'cmd' and text == 'sqrt') or text in ('√', '∛'):
+            degree = '3' if text == '∛' else ''
+            if kind == 'cmd' and self.peek()[:2] == ('char', '['):
+                self.take()
+                degree = self.expression(']')
+                self.take()
+            radicand = self.argument()
+            if degree:
+                return f'<m:rad><m:deg>{_m_run(degree) if text == "∛" else degree}</m:deg><m:e>{radicand}</m:e></m:rad>', ''
+            return (f'<m:rad><m:radPr><m:degHide m:val="1"/></m:radPr><m:deg/>'
+                    f'<m:e>{radicand}</m:e></m:rad>'), ''
+        if kind == 'char' and text in self.CLOSERS:
+            closer = self.CLOSERS[text]
+            inner = self.expression(closer)
+            closed = self.peek()[:2] == ('char', closer)
+            if closed:
+                self.take()
+            if text == '{':
+                return inner, inner
+            return _m_run(text) + inner + (_m_run(closer) if closed else ''), inner
+        return _m_run(text), ''
+
+def math_to_omml(expr):
+    """OMML <m:oMath> markup for one expression, or None if it can't be parsed. Memoized."""
+    with _math_cache_lock:
+        if expr in _math_cache:
+            _math_cache.move_to_end(expr)
+            _math_cache_stats['hits'] += 1
+            return _math_cache[expr]
+    try:
+        omml = f'<m:oMath {_MATH_NS}>{_MathParser(expr).parse()}</m:oMath>'
+        parse_xml(omml)
+    except Exception:
+        omml = None
+    with _math_cache_lock:
+        _math_cache_stats['misses'] += 1
+        _math_cache[expr] = omml
+        while len(_math_cache) > MATH_CACHE_MAX_ENTRIES:
+            _math_cache.popitem(last=False)
+    return omml
+
+def _is_math_word(word):
+    """Operand or operator that may sit inside an expression (single letters, 4ac, (x-3), ±)"""
+    if len(word) == 1:
+        return word.isalnum() or word in MATH_OPERATORS or word in '/√'
+    return bool(_MATH_WORD.fullmatch(word)) and not word.isalpha() and not any(
+        run.group() not in MATH_FUNCTIONS for run in _MATH_LETTER_RUN.finditer(word))
+
+def _is_operator_word(word):
+    return all(char in MATH_OPERATORS or char == '/' for char in word)
+
+def split_math(text):
+    """
+    Splits text into [(is_math, segment)]. \\(...\\) is always math, and so is $...$ when it
+    follows the pandoc rules and holds an operator, variable or script. Otherwise a
+    math span is a run of space-separated math words containing a script, root, \\frac or
+    a bracketed fraction; trailing punctuation and plain words end the span.
+    """
+    if not MATH_EQUATIONS_ENABLED:
+        return [(False, text)]
+    segments, last = [], 0
+    for match in _MATH_DELIMITED.finditer(text):
+        if match.group(1) and not _MATH_DELIMITED_TRIGGER.search(match.group(1)):
+            continue
+        segments.extend(_split_implicit_math(text[last:match.start()]))
+        segments.append((True, match.group(1) or match.group(2)))
+        last = match.end()
+    segments.extend(_split_implicit_math(text[last:]))
+    return [segment for segment in segments if segment[1]]
+
+def _split_implicit_math(text):
+    if not _MATH_TRIGGER.search(text):
+        return [(False, text)]
+    
+    # (start, end) of every word and whether it can be part of an expression
+    words = []
+    for match in re.finditer(r'\S+', text):
+        start, end = match.span()
+        trailing = _MATH_TRAILING.search(match.group())
+        core_end = end - (len(trailing.group()) if trailing and trailing.start() > 0 else 0)
+        core = text[start:core_end]
+        words.append((start, core_end, core, _is_math_word(core), core_end != end))
+    
+    segments, plain_start, i = [], 0, 0
+    while i < len(words):
+        if not words[i][3]:
+            i += 1
+            continue
+        j = i
+        while j + 1 < len(words) and words[j + 1][3] and not words[j][4]:
+            j += 1
+        run = words[i:j + 1]
+        # Leading/trailing operators and lone letters not attached to an operator are prose
+        while run and (_is_operator_word(run[0][2]) or (
+                len(run[0][2]) == 1 and run[0][2].isalpha() and not (len(run) > 1 and _is_operator_word(run[1][2])))):
+            run = run[1:]
+        while run and (_is_operator_word(run[-1][2]) or (
+                len(run[-1][2]) == 1 and run[-1][2].isalpha() and not (len(run) > 1 and _is_operator_word(run[-2][2])))):
+            run = run[:-1]
+        if run and any(_MATH_TRIGGER.search(word[2]) for word in run):
+            segments.append((False, text[plain_start:run[0][0]]))
+            segments.append((True, text[run[0][0]:run[-1][1]]))
+            plain_start = run[-1][1]
+        i = j + 1
+    segments.append((False, text[plain_start:]))
+    return segments
+
+def get_math_cache_stats():
+    with _math_cache_lock:
+        return dict(_math_cache_stats, entries=len(_math_cache))
+
+# --- 8. DOCX CREATOR ---
+# The DLP is built in three steps so the parts that only need the form inputs
+# (header, top table, curriculum rows, signatures) can be laid out while the AI
+# is still answering: start_lesson_docx -> fill_lesson_docx (per section) -> finish_lesson_docx.
+LESSON_DOCX_GROUPS = {
+    'objectives': ('obj_1', 'obj_2', 'obj_3'),
+    'topic': ('topic',),
+    'integration': ('integration_within', 'integration_across'),
+    'resources': ('resources',),
+    'procedure': ('procedure',),
+    'evaluation': ('evaluation',),
+}
+
+_docx_image_executor = shared('docx_image_executor',
+                              lambda: ThreadPoolExecutor(max_workers=4, thread_name_prefix="docx-image"))
+
+def _clear_cell(cell):
+    """Remove everything from a cell, leaving one empty paragraph."""
+    for paragraph in cell.paragraphs:
+        p = paragraph._element
+        p.getparent().remove(p)
+    cell.add_paragraph()
+
+def _lesson_image(visual_prompt):
+    img_data, _source = get_lesson_image(visual_prompt)
+    return prepare_image_for_docx(img_data)
+
+def start_lesson_docx(inputs, teacher_name, principal_name, uploaded_image=None):
+    """Lay out the whole DLP skeleton and fill every input-only part. Returns the builder state."""
+    school = get_school_config(inputs.get('school'))
+    doc = new_school_document(school, "Daily Lesson Log (DLL) / Daily Lesson Plan (DLP)")
+
+    table_top = doc.add_table(rows=1, cols=4)
+    table_top.style = 'Table Grid'
+    table_top.autofit = False
+    
+    table_top.columns[0].width = Inches(2.5)
+    table_top.columns[1].width = Inches(1.15)
+    table_top.columns[2].width = Inches(1.15)
+    table_top.columns[3].width = Inches(2.5)
+
+    def fill_cell(idx, label, value):
+        cell = table_top.rows[0].cells[idx]
+        p = cell.paragraphs[0]
+        p.add_run(label).bold = True
+        p.add_run("\n")
+        format_text(p, value)
+
+    fill_cell(0, "Subject Area:", inputs['subject'])
+    fill_cell(1, "Grade Level:", inputs['grade'])
+    fill_cell(2, "Quarter:", inputs['quarter'])
+    fill_cell(3, "Date:", date.today().strftime('%B %d, %Y'))
+
+    table_main = doc.add_table(rows=0, cols=2)
+    table_main.style = 'Table Grid'
+    table_main.autofit = False
+    
+    table_main.columns[0].width = Inches(2.0)
+    table_main.columns[1].width = Inches(5.3)
+
+    cells = {}
+
+    add_section_header(table_main, "I. CURRICULUM CONTENT, STANDARD AND LESSON COMPETENCIES")
+    add_row(table_main, "A. Content Standard", inputs['content_std'])
+    add_row(table_main, "B. Performance Standard", inputs['perf_std'])
+    
+    row_comp = table_main.add_row().cells
+    row_comp[0].paragraphs[0].add_run("C. Learning Competencies").bold = True
+    p_comp = row_comp[1].paragraphs[0]
+    p_comp.add_run("Competency: ").bold = True
+    format_text(p_comp, inputs['competency'])
+    cells['objectives'] = row_comp[1]
+
+    cells['topic'] = add_row(table_main, "D. Content", "")[1]
+    cells['integration'] = add_row(table_main, "E. Integration", "")[1]
+
+    add_section_header(table_main, "II. LEARNING RESOURCES")
+    cells['resources'] = [
+        add_row(table_main, label, "")[1] for label in (
+            "Teacher Guide", "Learner's Materials(LMs)", "Textbooks",
+            "Learning Resource (LR) Portal", "Other Learning Resources"
+        )
+    ]
+
+    add_section_header(table_main, "III. TEACHING AND LEARNING PROCEDURE")
+    cells['procedure'] = [
+        add_row(table_main, label, "")[1] for label in (
+            "A. Activating Prior Knowledge", "B. Establishing Lesson Purpose",
+            "C. Developing Understanding", "D. Making Generalization"
+        )
+    ]
+
+    add_section_header(table_main, "IV. EVALUATING LEARNING")
+    cells['evaluation'] = [
+        add_row(table_main, label, "")[1] for label in (
+            "A. Assessment", "B. Assignment", "C. Remarks", "D. Reflection"
+        )
+    ]
+
+    doc.add_paragraph()
+
+    add_signature_table(doc, teacher_name, principal_name, school)
+
+    image_future = None
+    if uploaded_image:
+        image_future = _docx_image_executor.submit(prepare_image_for_docx, uploaded_image)
+
+    return {
+        'doc': doc,
+        'inputs': inputs,
+        'cells': cells,
+        'filled': {},
+        'uploaded_image': bool(uploaded_image),
+        'image_future': image_future,
+        'image_prompt': None,
+        'image_paragraph': None,
+    }
+
+def _fill_objectives(state, ai_data):
+    cell = state['cells']['objectives']
+    _clear_cell(cell)
+    objs = f"1. {ai_data.get('obj_1','')}\n2. {ai_data.get('obj_2','')}\n3. {ai_data.get('obj_3','')}"
+    p_comp = cell.paragraphs[0]
+    p_comp.add_run("Competency: ").bold = True
+    format_text(p_comp, state['inputs']['competency'])
+    p_comp.add_run("\n\nObjectives:\n").bold = True
+    p_comp.add_run(objs)
+
+def _fill_text(cell, text):
+    _clear_cell(cell)
+    format_text(cell.paragraphs[0], str(text) if text else "")
+
+def _fill_procedure(state, proc):
+    review_cell, cell_img, developing_cell, generalization_cell = state['cells']['procedure']
+    
+    _fill_text(review_cell, proc.get('review', ''))
+    
+    _clear_cell(cell_img)
+    format_text(cell_img.paragraphs[0], proc.get('purpose_situation', ''))
+    cell_img.paragraphs[0].add_run("\n")
+    # The picture goes in at finish time; fetching it overlaps the rest of the stream
+    state['image_paragraph'] = cell_img.add_paragraph()
+    cell_img.add_paragraph(f"\nVocabulary:\n{proc.get('vocabulary','')}")
+    
+    if not state['uploaded_image']:
+        raw_prompt = proc.get('visual_prompt', 'school')
+        if raw_prompt != state['image_prompt']:
+            state['image_prompt'] = raw_prompt
+            state['image_future'] = _docx_image_executor.submit(_lesson_image, raw_prompt)
+
+    developing_content = f"Activity: {proc.get('activity_main','')}\n\n"
+    developing_content += f"EXPLICITATION: {proc.get('explicitation','')}\n\n"
+    developing_content += f"Group 1: {proc.get('group_1','')}\n"
+    developing_content += f"Group 2: {proc.get('group_2','')}\n"
+    developing_content += f"Group 3: {proc.get('group_3','')}"
+    
+    _fill_text(developing_cell, developing_content)
+    _fill_text(generalization_cell, proc.get('generalization', ''))
+
+def _fill_evaluation(state, eval_sec):
+    assessment_cell, assignment_cell, remarks_cell, reflection_cell = state['cells']['evaluation']
+    fill_assessment_cell(assessment_cell, eval_sec)
+    _fill_text(assignment_cell, eval_sec.get('assignment', ''))
+    _fill_text(remarks_cell, eval_sec.get('remarks', ''))
+    _fill_text(reflection_cell, eval_sec.get('reflection', ''))
+
+def fill_lesson_docx(state, ai_data, final=False):
+    """
+    Fill every AI section of the DLP whose keys are present in ai_data. Safe to call
+    repeatedly with a growing ai_data; sections are rewritten only if they changed.
+    With final=True missing sections are filled with empty values.
+    """
+    for group, keys in LESSON_DOCX_GROUPS.items():
+        if not final and not all(key in ai_data for key in keys):
+            continue
+        
+        signature = json.dumps([ai_data.get(key) for key in keys], sort_keys=True, default=str)
+        if state['filled'].get(group) == signature:
+            continue
+        state['filled'][group] = signature
+        
+        if group == 'objectives':
+            _fill_objectives(state, ai_data)
+        elif group == 'topic':
+            _fill_text(state['cells']['topic'], ai_data.get('topic', ''))
+        elif group == 'integration':
+            _fill_text(state['cells']['integration'],
+                       f"Within: {ai_data.get('integration_within','')}\nAcross: {ai_data.get('integration_across','')}")
+        elif group == 'resources':
+            r = ai_data.get('resources') or {}
+            for cell, key in zip(state['cells']['resources'], ('guide', 'materials', 'textbook', 'portal', 'other')):
+                _fill_text(cell, r.get(key, ''))
+        elif group == 'procedure':
+            _fill_procedure(state, ai_data.get('procedure') or {})
+        elif group == 'evaluation':
+            _fill_evaluation(state, ai_data.get('evaluation') or {})
+
+def lesson_docx_image(state):
+    """The prepared lesson picture (BytesIO) of a builder state, or None"""
+    return state['image_future'].result() if state['image_future'] else None
+
+def finish_lesson_docx(state):
+    """Insert the lesson picture and save. Returns a BytesIO positioned at 0."""
+    p_i = state['image_paragraph']
+    if p_i is not None:
+        img_data = lesson_docx_image(state)
+        if img_data:
+            try:
+                p_i.alignment = WD_ALIGN_PARAGRAPH.CENTER
+                run_i = p_i.add_run()
+                run_i.add_picture(img_data, width=Inches(IMAGE_DISPLAY_WIDTH_IN))
+            except:
+                p_i.alignment = None
+                p_i.add_run("[Image Error]")
+        else:
+            p_i.add_run("[No Image Available]")
+
+    buffer = io.BytesIO()
+    state['doc'].save(buffer)
+    buffer.seek(0)
+    return buffer
+
+def create_docx(inputs, ai_data, teacher_name, principal_name, uploaded_image):
+    if isinstance(ai_data, LessonPlan):
+        ai_data = lesson_to_dict(ai_data)
+    state = start_lesson_docx(inputs, teacher_name, principal_name, uploaded_image)
+    fill_lesson_docx(state, ai_data, final=True)
+    return finish_lesson_docx(state)
+
+def render_lesson_plan(inputs, ai_data, teacher_name, principal_name, image=None):
+    """UI-independent renderer: ai_data (dict or LessonPlan) -> DOCX bytes"""
+    return create_docx(inputs, ai_data, teacher_name, principal_name, image).getvalue()
+
+def render_dual_language_plans(inputs, plans, teacher_name, principal_name, image=None):
+    """
+    {language: ai_data} -> {language: DOCX bytes}. The picture is fetched and
+    prepared once for the first document and reused for the others.
+    """
+    documents = {}
+    for language, ai_data in plans.items():
+        if isinstance(ai_data, LessonPlan):
+            ai_data = lesson_to_dict(ai_data)
+        state = start_lesson_docx(inputs, teacher_name, principal_name, image)
+        fill_lesson_docx(state, ai_data, final=True)
+        documents[language] = finish_lesson_docx(state).getvalue()
+        image = image or lesson_docx_image(state)
+    return documents
+
+# --- 8A. WEEKLY DLL CREATOR ---
+# (label, source, key): source is "header", "input" (same all week), "resource" (same all week),
+# "day" (one value per day) or "blank" (filled in by the teacher after teaching)
+DLL_ROWS = (
+    ("I. OBJECTIVES", "header", None),
+    ("A. Content Standards", "input", 'content_std'),
+    ("B. Performance Standards", "input", 'perf_std'),
+    ("C. Learning Competencies/Objectives", "day", 'objectives'),
+    ("II. CONTENT", "day", 'topic'),
+    ("III. LEARNING RESOURCES", "header", None),
+    ("A. Teacher's Guide pages", "resource", 'guide'),
+    ("B. Learner's Materials pages", "resource", 'materials'),
+    ("C. Textbook pages", "resource", 'textbook'),
+    ("D. Learning Resource (LR) Portal", "resource", 'portal'),
+    ("E. Other Learning Resources", "resource", 'other'),
+    ("IV. PROCEDURES", "header", None),
+    ("A. Reviewing previous lesson or presenting the new lesson", "day", 'review'),
+    ("B. Establishing a purpose for the lesson", "day", 'purpose'),
+    ("C. Presenting examples/instances of the new lesson", "day", 'examples'),
+    ("D. Discussing new concepts and practicing new skills", "day", 'discussion'),
+    ("E. Developing mastery", "day", 'mastery'),
+    ("F. Finding practical applications of concepts and skills in daily living", "day", 'application'),
+    ("G. Making generalizations and abstractions about the lesson", "day", 'generalization'),
+    ("H. Evaluating learning", "day", 'evaluation'),
+    ("I. Additional activities for application or remediation", "day", 'assignment'),
+    ("V. REMARKS", "blank", None),
+    ("VI. REFLECTION", "blank", None),
+)
+
+DLL_LABEL_WIDTH = Inches(1.6)
+DLL_DAY_WIDTH = Inches(1.8)
+
+def create_weekly_docx(inputs, dll_data, teacher_name, principal_name):
+    """Landscape Monday-Friday DLL. The whole grid is created once and filled in bulk."""
+    school = get_school_config(inputs.get('school'))
+    doc = new_school_document(school, "Daily Lesson Log (DLL)", landscape=True)
+    
+    info = doc.add_paragraph()
+    info.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    for label, value in (("Subject Area: ", inputs['subject']), ("   Grade Level: ", inputs['grade']),
+                         ("   Quarter: ", inputs['quarter']),
+                         ("   Week of: ", date.today().strftime('%B %d, %Y'))):
+        info.add_run(label).bold = True
+        info.add_run(str(value))
+    
+    n_cols = len(DLL_DAYS) + 1
+    table = doc.add_table(rows=len(DLL_ROWS) + 1, cols=n_cols)
+    table.style = 'Table Grid'
+    table.autofit = False
+    
+    # One pass over the grid instead of rows[i].cells lookups per cell
+    cells = table._cells
+    for col_index, column in enumerate(table.columns):
+        column.width = DLL_LABEL_WIDTH if col_index == 0 else DLL_DAY_WIDTH
+    for index, cell in enumerate(cells):
+        cell.width = DLL_LABEL_WIDTH if index % n_cols == 0 else DLL_DAY_WIDTH
+    
+    for col_index, day_name in enumerate(DLL_DAYS, 1):
+        cell = cells[col_index]
+        run = cell.paragraphs[0].add_run(day_name.upper())
+        run.bold = True
+        cell.paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER
+        set_cell_background(cell, "BDD7EE")
+    
+    resources = dll_data.get('resources', {})
+    days = dll_data.get('days', [])
+    merges = []
+    
+    for row_index, (label, source, key) in enumerate(DLL_ROWS, 1):
+        row_cells = cells[row_index * n_cols:(row_index + 1) * n_cols]
+        row_cells[0].paragraphs[0].add_run(label).bold = True
+        
+        if source == "header":
+            set_cell_background(row_cells[0], "BDD7EE")
+            merges.append((row_cells[0], row_cells[-1]))
+        elif source in ("input", "resource"):
+            value = inputs.get(key, '') if source == "input" else resources.get(key, '')
+            format_text(row_cells[1].paragraphs[0], str(value or ''))
+            merges.append((row_cells[1], row_cells[-1]))
+        elif source == "day":
+            for day_index, cell in enumerate(row_cells[1:]):
+                day = days[day_index] if day_index < len(days) else {}
+                format_text(cell.paragraphs[0], str(day.get(key, '') or ''))
+    
+    # Merge last so the precomputed cell list stays valid while filling
+    for first, last in merges:
+        first.merge(last)
+    
+    doc.add_paragraph()
+    add_signature_table(doc, teacher_name, principal_name, school)
+    
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+def render_weekly_log(inputs, dll_data, teacher_name, principal_name):
+    """UI-independent renderer: DLL data -> DOCX bytes"""
+    return create_weekly_docx(inputs, dll_data, teacher_name, principal_name).getvalue()
+
+# --- 8B. BULK ARCHIVES ---
+# Bulk exports are written into a ZIP one document at a time, as each one is rendered.
+# Small archives stay in memory; the process-wide spool budget caps how much, and the
+# rest rolls over to temp files on disk. Finished archives are published under
+# static/archives/ and served from disk by Streamlit's static file route, which
+# supports HTTP range requests (needs server.enableStaticServing, see .streamlit/config.toml).
+ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "archives")
+ARCHIVE_URL_PREFIX = "app/static/archives"
+ARCHIVE_MEMORY_BUDGET = int(os.environ.get("DLP_ARCHIVE_MEMORY_MB", "64")) * 1024 * 1024
+ARCHIVE_SPOOL_BYTES = 8 * 1024 * 1024      # Largest in-memory spool for a single archive
+ARCHIVE_TTL_SECONDS = 24 * 3600
+
+_archive_budget_lock = shared('archive_budget_lock', threading.Lock)
+_archive_spool_claimed = shared('archive_spool_claimed', lambda: [0])
+
+def _claim_spool_bytes():
+    with _archive_budget_lock:
+        grant = max(0, min(ARCHIVE_SPOOL_BYTES, ARCHIVE_MEMORY_BUDGET - _archive_spool_claimed[0]))
+        _archive_spool_claimed[0] += grant
+        return grant
+
+def _release_spool_bytes(grant):
+    with _archive_budget_lock:
+        _archive_spool_claimed[0] -= grant
+
+def open_bulk_archive():
+    """Start a ZIP archive backed by a spooled temp file. Returns the archive state."""
+    grant = _claim_spool_bytes()
+    if grant:
+        spool = tempfile.SpooledTemporaryFile(max_size=grant)
+    else:
+        # Memory budget used up by other exports: go straight to disk
+        spool = tempfile.TemporaryFile()
+    return {
+        'file': spool,
+        'zip': zipfile.ZipFile(spool, 'w', zipfile.ZIP_DEFLATED, compresslevel=6),
+        'grant': grant,
+        'names': set(),
+    }
+
+def add_to_bulk_archive(archive, file_name, data):
+    """Write one document into the archive; the caller can drop data right after."""
+    name = file_name
+    counter = 2
+    while name in archive['names']:
+        stem, ext = os.path.splitext(file_name)
+        name = f"{stem}_{counter}{ext}"
+        counter += 1
+    archive['names'].add(name)
+    archive['zip'].writestr(name, data)
+    return name
+
+def close_bulk_archive(archive, dest_path):
+    """Finish the ZIP and copy it to dest_path in fixed-size chunks."""
+    try:
+        archive['zip'].close()
+        archive['file'].seek(0)
+        os.makedirs(os.path.dirname(dest_path) or '.', exist_ok=True)
+        tmp_path = dest_path + ".part"
+        with open(tmp_path, 'wb') as out:
+            shutil.copyfileobj(archive['file'], out, 1024 * 1024)
+        os.replace(tmp_path, dest_path)
+    finally:
+        archive['file'].close()
+        _release_spool_bytes(archive['grant'])
+    return dest_path
+
+def discard_bulk_archive(archive):
+    """Drop an unfinished archive and give back its memory budget."""
+    archive['zip'].close()
+    archive['file'].close()
+    _release_spool_bytes(archive['grant'])
+
+def cleanup_bulk_archives(max_age=ARCHIVE_TTL_SECONDS):
+    """Delete published archives older than max_age seconds."""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return
+    cutoff = time.time() - max_age
+    for token in os.listdir(ARCHIVE_DIR):
+        folder = os.path.join(ARCHIVE_DIR, token)
+        try:
+            if os.path.isdir(folder) and os.path.getmtime(folder) < cutoff:
+                shutil.rmtree(folder, ignore_errors=True)
+        except OSError:
+            continue
+
+def publish_bulk_archive(archive, download_name):
+    """Close the archive into the static folder. Returns (path on disk, URL path)."""
+    cleanup_bulk_archives()
+    token = secrets.token_urlsafe(16)
+    safe_name = re.sub(r'[^A-Za-z0-9_.\-]+', '_', download_name)
+    path = close_bulk_archive(archive, os.path.join(ARCHIVE_DIR, token, safe_name))
+    return path, f"{ARCHIVE_URL_PREFIX}/{token}/{safe_name}"
+
+def show_archive_download(url, file_name, label):
+    """Download link served from disk (the download attribute forces a save dialog)."""
+    st.markdown(
+        f'<a href="{url}" download="{file_name}" target="_blank" '
+        f'style="display:block;text-align:center;padding:0.5em;border-radius:0.5em;'
+        f'background:#800000;color:white;text-decoration:none;font-weight:bold;">{label}</a>',
+        unsafe_allow_html=True
+    )
+
+# --- 8C. STUDENT HANDOUTS ---
+# Printable handouts derived from the same ai_data as the DLP, with no model calls:
+# quiz sheets in two sets (Set B has the questions and choices in another order),
+# the answer key for both sets and cut-out group activity cards. They are built on
+# their own threads while the DLP document is being finished.
+HANDOUT_KINDS = ('quiz', 'answer_key', 'group_cards')
+HANDOUT_LABELS = {'quiz': "Quiz Sheets (Sets A & B)", 'answer_key': "Answer Key", 'group_cards': "Group Activity Cards"}
+HANDOUT_FILE_SUFFIXES = {'quiz': "Quiz", 'answer_key': "AnswerKey", 'group_cards': "GroupCards"}
+QUIZ_SETS = ('A', 'B')
+CHOICE_LETTERS = ('A', 'B', 'C', 'D')
+
+_handout_executor = shared('handout_executor',
+                           lambda: ThreadPoolExecutor(max_workers=3, thread_name_prefix="handout"))
+
+QuizItem = shared('QuizItem', lambda: namedtuple('QuizItem', ('number', 'question', 'choices', 'answer')))
+
+def _different_order(rng, items):
+    """Shuffled copy of items that is not in the original order (when it can differ)"""
+    order = list(items)
+    rng.shuffle(order)
+    if len(order) > 1 and order == list(items):
+        order = order[1:] + order[:1]
+    return order
+
+def quiz_sets(ai_data):
+    """
+    {'A': [QuizItem], 'B': [QuizItem]}. Set A is the DLP's order. Set B reorders
+    questions and choices with a seed taken from the questions, so the same lesson
+    always gets the same Set B. number is the question's number in Set A; answer
+    is a choice index, or None when the plan does not say which choice is correct.
+    """
+    evaluation = ai_data.get('evaluation') or {}
+    items = []
+    for i in range(1, 6):
+        raw = evaluation.get(f'assess_q{i}', '')
+        if not raw:
+            continue
+        question, choices = parse_multiple_choice_question(raw)
+        texts = [re.sub(r'^[A-D]\.\s*', '', choice) for choice in choices]
+        letter = parse_answer_letter(raw)
+        answer = CHOICE_LETTERS.index(letter) if letter and texts else None
+        items.append(QuizItem(i, question, tuple(texts), answer))
+    
+    seed = hashlib.sha256("\n".join(item.question for item in items).encode('utf-8')).hexdigest()
+    rng = random.Random(seed)
+    set_b = []
+    for item in _different_order(rng, items):
+        order = _different_order(rng, range(len(item.choices)))
+        answer = order.index(item.answer) if item.answer is not None else None
+        set_b.append(item._replace(choices=tuple(item.choices[k] for k in order), answer=answer))
+    return {'A': items, 'B': set_b}
+
+def _handout_ai_data(ai_data):
+    return lesson_to_dict(ai_data) if isinstance(ai_data, LessonPlan) else ai_data
+
+def _add_lesson_line(doc, inputs, ai_data):
+    p = doc.add_paragraph()
+    p.add_run(f"{inputs['subject']} · {inputs['grade']} · Quarter {inputs['quarter']}").bold = True
+    if ai_data.get('topic'):
+        p.add_run("\nLesson: ")
+        format_text(p, ai_data['topic'])
+
+def _add_blank_fields(doc, labels):
+    table = doc.add_table(rows=1, cols=len(labels))
+    for cell, label in zip(table.rows[0].cells, labels):
+        cell.paragraphs[0].add_run(f"{label}: ").bold = True
+        cell.paragraphs[0].add_run("_" * 18)
+
+def build_quiz_sheet(inputs, ai_data, school=None):
+    """Both quiz sets, one per page, ready to print. Returns DOCX bytes"""
+    ai_data = _handout_ai_data(ai_data)
+    school = school or get_school_config(inputs.get('school'))
+    doc = new_school_document(school, "Quiz")
+    for n, (set_name, items) in enumerate(quiz_sets(ai_data).items()):
+        if n:
+            doc.add_page_break()
+        heading = doc.add_paragraph()
+        heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        heading.add_run(f"SET {set_name}").bold = True
+        _add_lesson_line(doc, inputs, ai_data)
+        _add_blank_fields(doc, ("Name", "Grade & Section", "Date"))
+        doc.add_paragraph().add_run(f"Score: ______ / {len(items)}").bold = True
+        doc.add_paragraph(
+            "DIRECTIONS: Read each question carefully. Write the letter of the correct answer on the blank before the number."
+        )
+        for position, item in enumerate(items, 1):
+            p = doc.add_paragraph()
+            p.paragraph_format.space_before = Pt(6)
+            p.add_run(f"_____ {position}. ").bold = True
+            format_text(p, item.question)
+            for letter, choice in zip(CHOICE_LETTERS, item.choices):
+                p_choice = doc.add_paragraph()
+                p_choice.paragraph_format.left_indent = Inches(0.6)
+                p_choice.paragraph_format.space_after = Pt(0)
+                p_choice.add_run(f"{letter}. ").bold = True
+                format_text(p_choice, choice)
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+def build_answer_key(inputs, ai_data, school=None):
+    """Teacher's key: the correct letter of every question in both sets. Returns DOCX bytes"""
+    ai_data = _handout_ai_data(ai_data)
+    school = school or get_school_config(inputs.get('school'))
+    sets = quiz_sets(ai_data)
+    doc = new_school_document(school, "Answer Key")
+    _add_lesson_line(doc, inputs, ai_data)
+    
+    set_b = {item.number: (position, item) for position, item in enumerate(sets['B'], 1)}
+    table = doc.add_table(rows=1, cols=4)
+    table.style = 'Table Grid'
+    for cell, label in zip(table.rows[0].cells, ("Set A No.", "Set A Answer", "Set B No.", "Set B Answer")):
+        cell.paragraphs[0].add_run(label).bold = True
+        set_cell_background(cell, "BDD7EE")
+    missing = False
+    for item in sets['A']:
+        position_b, item_b = set_b[item.number]
+        row = table.add_row().cells
+        row[0].text = str(item.number)
+        row[2].text = str(position_b)
+        for cell, entry in ((row[1], item), (row[3], item_b)):
+            if entry.answer is None:
+                missing = True
+                cell.text = "____"
+            else:
+                cell.paragraphs[0].add_run(f"{CHOICE_LETTERS[entry.answer]}. ").bold = True
+                format_text(cell.paragraphs[0], entry.choices[entry.answer])
+    if missing:
+        doc.add_paragraph(
+            "Some answers were not included in the lesson plan. Write them in before checking the papers; "
+            "a Set B answer is the same choice text as its Set A answer."
+        )
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+def build_group_cards(inputs, ai_data, school=None):
+    """One bordered card per group task, to cut out and hand to each group. Returns DOCX bytes"""
+    ai_data = _handout_ai_data(ai_data)
+    school = school or get_school_config(inputs.get('school'))
+    procedure = ai_data.get('procedure') or {}
+    doc = new_school_document(school, "Group Activity Cards")
+    for number in (1, 2, 3):
+        task = procedure.get(f'group_{number}', '')
+        if not task:
+            continue
+        card = doc.add_table(rows=1, cols=1)
+        card.style = 'Table Grid'
+        cell = card.rows[0].cells[0]
+        title = cell.paragraphs[0]
+        title.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        title.add_run(f"GROUP {number}").bold = True
+        set_cell_background(cell, "BDD7EE")
+        p = cell.add_paragraph()
+        p.add_run(f"{inputs['subject']} · {inputs['grade']}").italic = True
+        if ai_data.get('topic'):
+            p.add_run("\nLesson: ")
+            format_text(p, ai_data['topic'])
+        p_task = cell.add_paragraph()
+        p_task.add_run("Task: ").bold = True
+        format_text(p_task, task)
+        p_members = cell.add_paragraph()
+        p_members.add_run("Members: ").bold = True
+        p_members.add_run("\n" + "\n".join("_" * 40 for _ in range(3)))
+        doc.add_paragraph()
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+HANDOUT_BUILDERS = {'quiz': build_quiz_sheet, 'answer_key': build_answer_key, 'group_cards': build_group_cards}
+
+def start_lesson_handouts(inputs, ai_data, kinds=HANDOUT_KINDS):
+    """Submit the handout builds; {kind: future of DOCX bytes}. Start them before finishing the DLP"""
+    ai_data = copy.deepcopy(_handout_ai_data(ai_data))
+    school = get_school_config(inputs.get('school'))
+    return {kind: _handout_executor.submit(HANDOUT_BUILDERS[kind], inputs, ai_data, school) for kind in kinds}
+
+def render_lesson_handouts(inputs, ai_data, kinds=HANDOUT_KINDS):
+    """UI-independent: {kind: DOCX bytes} for the given handout kinds"""
+    return {kind: future.result() for kind, future in start_lesson_handouts(inputs, ai_data, kinds).items()}
+
+def handout_file_name(inputs, kind, language=None):
+    return lesson_file_name(inputs, language)[:-len('.docx')] + f"_{HANDOUT_FILE_SUFFIXES[kind]}.docx"
+
+# --- 9. MAIN STREAMLIT APP ---
+def show_quarter_planner(teacher_name, principal_name):
+    """Quarter planner mode: one coherent DLP per competency for a whole quarter"""
+    st.subheader("🗓️ Quarter Planner")
+    st.caption("One outline for the whole quarter, then every lesson builds on the one before it.")
+    
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        subject = st.text_input("Subject Area", value=profile_default('subject'), placeholder="e.g., Mathematics", key="plan_subject")
+    with col2:
+        grade = st.selectbox("Grade Level", GRADE_OPTIONS, index=option_index(GRADE_OPTIONS, profile_default('grade'), 6), key="plan_grade")
+    with col3:
+        quarter = st.selectbox("Quarter", QUARTER_OPTIONS, index=option_index(QUARTER_OPTIONS, profile_default('quarter'), 2), key="plan_quarter")
+    
+    show_quarter_competency_fill(subject, grade, quarter)
     
-    p_dir = content_cell.add_paragraph()
-    p_dir.add_run("DIRECTIONS: Read each question carefully. Choose the letter of the correct answer from options A, B, C, and D.")
+    content_std = st.text_area("Content Standard", placeholder="The learner demonstrates understanding of...", key="plan_content_std")
+    perf_std = st.text_area("Performance Standard", placeholder="The learner is able to...", key="plan_perf_std")
+    competencies_text = st.text_area(
+        "Learning Competencies (one per line, in teaching order)",
+        placeholder="M7AL-IIIa-1: ...\nM7AL-IIIa-2: ...\nM7AL-IIIb-1: ...",
+        height=200,
+        key="plan_competencies"
+    )
     
-    content_cell.add_paragraph()
+    has_api_key = bool(st.session_state.get('api_key') or st.session_state.get('saved_api_key'))
     
-    for i in range(1, 6):
-        question_key = f'assess_q{i}'
-        raw_question = eval_sec.get(question_key, f'Question {i}')
+    if st.button("🚀 Generate Quarter Plan", type="primary", use_container_width=True, disabled=not has_api_key):
+        competencies = [line.strip() for line in competencies_text.splitlines() if line.strip()]
+        if not all([subject, grade, quarter, content_std, perf_std]) or not competencies:
+            st.error("Please fill all required fields")
+            return
         
-        question_text, choices = parse_multiple_choice_question(raw_question)
+        plan_inputs = {
+            'subject': subject, 'grade': grade, 'quarter': quarter,
+            'content_std': content_std, 'perf_std': perf_std,
+            'school': st.session_state.get('school_id')
+        }
         
-        p_question = content_cell.add_paragraph()
+        progress_bar = st.progress(0.0, text=f"Planning {len(competencies)} lessons...")
+        done = []
+        archive = open_bulk_archive()
         
-        num_run = p_question.add_run(f"{i}. ")
-        num_run.bold = True
+        def on_lesson(index, lesson_inputs, ai_data):
+            done.append(index)
+            # Render and zip each lesson as soon as it arrives so only one DOCX is held at a time
+            add_to_bulk_archive(archive, quarter_lesson_file_name(lesson_inputs, index + 1),
+                                render_lesson_plan(lesson_inputs, ai_data, teacher_name, principal_name))
+            progress_bar.progress(len(done) / len(competencies),
+                                  text=f"Lesson {index + 1} ready ({len(done)}/{len(competencies)})")
         
-        if question_text:
-            format_text(p_question, question_text)
+        try:
+            with st.spinner("🤖 Generating quarter plan..."):
+                results = plan_quarter(
+                    plan_inputs, competencies,
+                    st.session_state.get('api_key') or st.session_state.get('saved_api_key'),
+                    on_progress=_streamlit_progress, on_error=st.error, on_lesson=on_lesson
+                )
+        except BaseException:
+            # Includes Streamlit's rerun/stop: the spool's memory grant must go back to the budget
+            discard_bulk_archive(archive)
+            raise
         
-        if choices:
-            for choice in choices:
-                p_choice = content_cell.add_paragraph()
-                p_choice.paragraph_format.left_indent = Inches(0.3)
-                
-                choice_match = re.match(r'^([A-D]\.)\s*(.*)', choice)
-                if choice_match:
-                    letter_part = choice_match.group(1)
-                    text_part = choice_match.group(2)
-                    
-                    letter_run = p_choice.add_run(f"{letter_part} ")
-                    letter_run.bold = True
-                    
-                    if text_part:
-                        format_text(p_choice, text_part)
-                else:
-                    format_text(p_choice, choice)
-        else:
-            for letter in ['A.', 'B.', 'C.', 'D.']:
-                p_choice = content_cell.add_paragraph()
-                p_choice.paragraph_format.left_indent = Inches(0.3)
-                letter_run = p_choice.add_run(f"{letter} ")
-                letter_run.bold = True
-                p_choice.add_run(f"Choice {letter[0]}")
+        if not results:
+            discard_bulk_archive(archive)
+            st.error("Failed to generate the quarter plan. Please try again.")
+            return
         
-        if i < 5:
-            content_cell.add_paragraph()
-
-# --- 8. DOCX CREATOR ---
-def create_docx(inputs, ai_data, teacher_name, principal_name, uploaded_image):
-    doc = Document()
-    
-    section = doc.sections[0]
-    section.page_width = Mm(210)
-    section.page_height = Mm(297)
-    section.top_margin = Inches(0.5)
-    section.bottom_margin = Inches(0.5)
-    section.left_margin = Inches(0.5)
-    section.right_margin = Inches(0.5)
-
-    header_para = doc.add_paragraph()
-    header_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    
-    dept_run = header_para.add_run("DEPARTMENT OF EDUCATION REGION XI\n")
-    dept_run.bold = True
-    dept_run.font.size = Pt(12)
-    
-    div_run = header_para.add_run("DIVISION OF DAVAO DEL SUR\n")
-    div_run.bold = True
-    div_run.font.size = Pt(11)
+        with st.spinner("📦 Packaging DOCX files..."):
+            zip_name = f"DLP_{subject}_{grade}_Q{quarter}_{date.today()}.zip"
+            archive_path, archive_url = publish_bulk_archive(archive, zip_name)
+        # Only compact LessonPlans and the archive location stay in session state, not the documents
+        st.session_state.quarter_plan = {
+            'lessons': [(lesson_inputs, lesson_from_json(ai_data)) for lesson_inputs, ai_data in results],
+            'archive_path': archive_path,
+            'archive_url': archive_url,
+            'zip_name': zip_name,
+        }
+        st.success(f"✅ {len(results)} DLPs generated for {subject} - {grade} - Quarter {quarter}")
+        show_replay_reference()
     
-    school_run = header_para.add_run("MANUAL NATIONAL HIGH SCHOOL\n\n")
-    school_run.bold = True
-    school_run.font.size = Pt(14)
+    quarter_plan = st.session_state.get('quarter_plan')
+    if not quarter_plan:
+        return
     
-    title = doc.add_paragraph("Daily Lesson Log (DLL) / Daily Lesson Plan (DLP)")
-    title.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    title.runs[0].bold = True
-    title.runs[0].font.size = Pt(14)
-
-    table_top = doc.add_table(rows=1, cols=4)
-    table_top.style = 'Table Grid'
-    table_top.autofit = False
+    if os.path.exists(quarter_plan['archive_path']):
+        show_archive_download(quarter_plan['archive_url'], quarter_plan['zip_name'],
+                              f"📦 Download all {len(quarter_plan['lessons'])} lessons (.zip)")
+    else:
+        st.warning("The ZIP archive has expired. Generate the quarter plan again to download all lessons.")
     
-    table_top.columns[0].width = Inches(2.5)
-    table_top.columns[1].width = Inches(1.15)
-    table_top.columns[2].width = Inches(1.15)
-    table_top.columns[3].width = Inches(2.5)
+    for n, (lesson_inputs, plan) in enumerate(quarter_plan['lessons'], 1):
+        with st.expander(f"Lesson {n}: {plan.content.topic or lesson_inputs['competency']}"):
+            st.write(f"**Competency:** {lesson_inputs['competency']}")
+            st.write(f"**Review:** {plan.procedure.review}")
+            # Rendered on demand, one lesson per click, instead of keeping every DOCX in memory
+            if st.button(f"📄 Prepare Lesson {n} (.docx)", key=f"quarter_prepare_{n}",
+                         use_container_width=True):
+                st.session_state.quarter_prepared = n
+            if st.session_state.get('quarter_prepared') == n:
+                st.download_button(
+                    label=f"📥 Download Lesson {n} (.docx)",
+                    data=render_lesson_plan(lesson_inputs, plan, teacher_name, principal_name),
+                    file_name=quarter_lesson_file_name(lesson_inputs, n),
+                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                    use_container_width=True,
+                    key=f"quarter_download_{n}"
+                )
 
-    def fill_cell(idx, label, value):
-        cell = table_top.rows[0].cells[idx]
-        p = cell.paragraphs[0]
-        p.add_run(label).bold = True
-        p.add_run("\n")
-        format_text(p, value)
+def quarter_lesson_file_name(lesson_inputs, number):
+    return f"DLP_{lesson_inputs['subject']}_{lesson_inputs['grade']}_Q{lesson_inputs['quarter']}_L{number}_{date.today()}.docx"
 
-    fill_cell(0, "Subject Area:", inputs['subject'])
-    fill_cell(1, "Grade Level:", inputs['grade'])
-    fill_cell(2, "Quarter:", inputs['quarter'])
-    fill_cell(3, "Date:", date.today().strftime('%B %d, %Y'))
+def show_replay_reference():
+    """Reference of the generation just logged, so a teacher can quote it when reporting a problem"""
+    replay_id = last_replay_id()
+    if replay_id:
+        st.caption(f"🧾 Reference: {replay_id} (mention it when reporting a problem with this plan)")
 
-    table_main = doc.add_table(rows=0, cols=2)
-    table_main.style = 'Table Grid'
-    table_main.autofit = False
+def show_weekly_log(teacher_name, principal_name):
+    """Weekly DLL mode: Monday-Friday in one landscape table from one model call"""
+    st.subheader("📅 Weekly Daily Lesson Log (DLL)")
+    st.caption("All five days are generated together and laid out side by side.")
     
-    table_main.columns[0].width = Inches(2.0)
-    table_main.columns[1].width = Inches(5.3)
-
-    objs = f"1. {ai_data.get('obj_1','')}\n2. {ai_data.get('obj_2','')}\n3. {ai_data.get('obj_3','')}"
-    r = ai_data.get('resources', {})
-    proc = ai_data.get('procedure', {})
-    eval_sec = ai_data.get('evaluation', {})
-
-    add_section_header(table_main, "I. CURRICULUM CONTENT, STANDARD AND LESSON COMPETENCIES")
-    add_row(table_main, "A. Content Standard", inputs['content_std'])
-    add_row(table_main, "B. Performance Standard", inputs['perf_std'])
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        subject = st.text_input("Subject Area", value=profile_default('subject'), placeholder="e.g., Mathematics", key="dll_subject")
+    with col2:
+        grade = st.selectbox("Grade Level", GRADE_OPTIONS, index=option_index(GRADE_OPTIONS, profile_default('grade'), 6), key="dll_grade")
+    with col3:
+        quarter = st.selectbox("Quarter", QUARTER_OPTIONS, index=option_index(QUARTER_OPTIONS, profile_default('quarter'), 2), key="dll_quarter")
     
-    row_comp = table_main.add_row().cells
-    row_comp[0].paragraphs[0].add_run("C. Learning Competencies").bold = True
-    p_comp = row_comp[1].paragraphs[0]
-    p_comp.add_run("Competency: ").bold = True
-    format_text(p_comp, inputs['competency'])
-    p_comp.add_run("\n\nObjectives:\n").bold = True
-    p_comp.add_run(objs)
+    show_competency_search(subject, grade, quarter, key_prefix="dll_")
+    
+    content_std = st.text_area("Content Standard", placeholder="The learner demonstrates understanding of...", key="dll_content_std")
+    perf_std = st.text_area("Performance Standard", placeholder="The learner is able to...", key="dll_perf_std")
+    competency = st.text_area("Learning Competencies for the week", placeholder="Competency codes and descriptions...", key="dll_competency")
+    lesson_topic = st.text_area("Week Topic (optional)", placeholder="Leave blank for AI to generate", key="dll_topic")
+    
+    has_api_key = bool(st.session_state.get('api_key') or st.session_state.get('saved_api_key'))
+    
+    if st.button("🚀 Generate Weekly DLL", type="primary", use_container_width=True, disabled=not has_api_key):
+        if not all([subject, grade, quarter, content_std, perf_std, competency]):
+            st.error("Please fill all required fields")
+            return
+        
+        inputs = normalize_job_inputs({
+            'subject': subject, 'grade': grade, 'quarter': quarter,
+            'content_std': content_std, 'perf_std': perf_std,
+            'competency': competency, 'lesson_topic': lesson_topic,
+            'school': st.session_state.get('school_id')
+        }, _streamlit_progress)
+        
+        with st.spinner("🤖 Generating Monday to Friday..."):
+            dll_data = generate_weekly_log(
+                inputs, st.session_state.get('api_key') or st.session_state.get('saved_api_key'),
+                on_progress=_streamlit_progress, on_error=st.error, on_raw_response=_streamlit_raw_response
+            )
+        
+        if not dll_data:
+            st.error("Failed to generate AI content. Please try again.")
+            return
+        
+        with st.spinner("📄 Creating DOCX file..."):
+            docx_bytes = render_weekly_log(inputs, dll_data, teacher_name, principal_name)
+        
+        for day_name, day in zip(DLL_DAYS, dll_data['days']):
+            with st.expander(f"{day_name}: {day.get('topic', '')}"):
+                st.write(day.get('objectives', ''))
+        
+        st.download_button(
+            label="📥 Download Weekly DLL (.docx)",
+            data=docx_bytes,
+            file_name=f"DLL_{subject}_{grade}_Q{quarter}_{date.today()}.docx",
+            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+            use_container_width=True
+        )
+        st.success(f"✅ Weekly DLL generated for {subject} - {grade} - Quarter {quarter}")
+        show_replay_reference()
 
-    add_row(table_main, "D. Content", ai_data.get('topic', ''))
-    add_row(table_main, "E. Integration", f"Within: {ai_data.get('integration_within','')}\nAcross: {ai_data.get('integration_across','')}")
+def _apply_competency(entry, key_prefix):
+    st.session_state[f"{key_prefix}competency"] = format_competency(entry)
+    st.session_state[f"{key_prefix}content_std"] = entry['content_std']
+    st.session_state[f"{key_prefix}perf_std"] = entry['perf_std']
 
-    add_section_header(table_main, "II. LEARNING RESOURCES")
-    add_row(table_main, "Teacher Guide", r.get('guide', ''))
-    add_row(table_main, "Learner's Materials(LMs)", r.get('materials', ''))
-    add_row(table_main, "Textbooks", r.get('textbook', ''))
-    add_row(table_main, "Learning Resource (LR) Portal", r.get('portal', ''))
-    add_row(table_main, "Other Learning Resources", r.get('other', ''))
+def _apply_quarter_competencies(entries):
+    st.session_state.plan_competencies = "\n".join(format_competency(entry) for entry in entries)
+    if not st.session_state.get('plan_content_std'):
+        st.session_state.plan_content_std = entries[0]['content_std']
+    if not st.session_state.get('plan_perf_std'):
+        st.session_state.plan_perf_std = entries[0]['perf_std']
 
-    add_section_header(table_main, "III. TEACHING AND LEARNING PROCEDURE")
-    add_row(table_main, "A. Activating Prior Knowledge", proc.get('review', ''))
-    
-    row_img = table_main.add_row().cells
-    row_img[0].paragraphs[0].add_run("B. Establishing Lesson Purpose").bold = True
+def show_quarter_competency_fill(subject, grade, quarter):
+    """Quarter planner: fill the competency list from the guide when it covers this quarter"""
+    entries = curriculum_competencies(subject, grade, quarter)
+    if not entries:
+        return
+    st.button(
+        f"📋 Fill the {len(entries)} competencies of this quarter from the curriculum guide",
+        key="plan_competency_fill", on_click=_apply_quarter_competencies, args=(entries,)
+    )
+
+def show_competency_search(subject, grade, quarter, key_prefix=""):
+    """
+    Autocomplete from the curriculum guide; fills competency and both standards.
+    Only offered for a subject and grade the guide list actually covers.
+    """
+    if not curriculum_competencies(subject, grade):
+        if subject:
+            st.caption(f"🔎 Competency search is not available for {subject} · {grade}: the curriculum guide "
+                       "list (curriculum/competencies.csv) has no entries for it yet. Type the competency below.")
+        return
     
-    cell_img = row_img[1]
-    format_text(cell_img.paragraphs[0], proc.get('purpose_situation', ''))
-    cell_img.paragraphs[0].add_run("\n")
+    query = st.text_input(
+        "🔎 Find competency (code or keywords)",
+        placeholder="e.g., M7NS-Ia or venn diagram",
+        key=f"{key_prefix}competency_search"
+    )
+    if not query:
+        return
     
-    img_data = None
-    if uploaded_image:
-        img_data = uploaded_image
-    else:
-        raw_prompt = proc.get('visual_prompt', 'school')
-        img_data = fetch_ai_image(raw_prompt)
+    matches = search_competencies(query, subject, grade, quarter) or search_competencies(query, subject, grade)
+    if not matches:
+        st.caption("No match in the curriculum guide list. Type the competency below.")
+        return
     
-    if img_data:
-        try:
-            p_i = cell_img.add_paragraph()
-            p_i.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            run_i = p_i.add_run()
-            run_i.add_picture(img_data, width=Inches(3.5))
-        except:
-            cell_img.add_paragraph("[Image Error]")
+    labels = [format_competency(entry) for entry in matches]
+    choice = st.selectbox("Matching competencies", labels, key=f"{key_prefix}competency_choice")
+    entry = matches[labels.index(choice)]
+    st.caption(f"{entry['subject']} · {entry['grade']} · Quarter {entry['quarter']}")
+    st.button(
+        "Use this competency", key=f"{key_prefix}competency_apply",
+        on_click=_apply_competency, args=(entry, key_prefix)
+    )
+
+def queue_lesson_from_form(inputs, teacher_name, principal_name, dual_language, different_version):
+    """Queue the form's lesson and tell the teacher what happened"""
+    api_key = st.session_state.get('api_key') or st.session_state.get('saved_api_key')
+    job_id, created = enqueue_lesson(get_profile_id(), inputs, api_key, teacher_name, principal_name,
+                                     dual_language=dual_language, different_version=different_version)
+    if created:
+        st.success("📥 Lesson queued. It is generated as soon as the connection is back; "
+                   "you can close this page and download it later under 📥 Queued lessons.")
     else:
-        cell_img.add_paragraph("[No Image Available]")
-        
-    cell_img.add_paragraph(f"\nVocabulary:\n{proc.get('vocabulary','')}")
+        st.info("📥 This lesson is already in your queue.")
+    return job_id
 
-    developing_content = f"Activity: {proc.get('activity_main','')}\n\n"
-    developing_content += f"EXPLICITATION: {proc.get('explicitation','')}\n\n"
-    developing_content += f"Group 1: {proc.get('group_1','')}\n"
-    developing_content += f"Group 2: {proc.get('group_2','')}\n"
-    developing_content += f"Group 3: {proc.get('group_3','')}"
+def show_lesson_queue():
+    """The teacher's queued lessons: status, retries and downloads (read on click) of finished ones"""
+    profile_id = get_profile_id()
+    jobs = load_queued_jobs(profile_id)
+    if not jobs:
+        return
     
-    add_row(table_main, "C. Developing Understanding", developing_content)
-    add_row(table_main, "D. Making Generalization", proc.get('generalization', ''))
+    waiting = sum(job['status'] in ('queued', 'running') for job in jobs)
+    with st.expander(f"📥 Queued lessons ({waiting} waiting)" if waiting else "📥 Queued lessons",
+                     expanded=bool(waiting)):
+        if waiting:
+            st.caption("Queued lessons are generated in the background once the AI can be reached. "
+                       "Press Refresh to see new results.")
+            st.button("🔄 Refresh", key="queue_refresh")
+        delivered = st.session_state.setdefault('queue_delivered', set())
+        for job in jobs:
+            inputs = job['inputs']
+            if job['status'] == 'done' and job['id'] not in delivered:
+                # The run was added to the history in the database; reload it on next use
+                st.session_state.get('generation_history', {}).pop(lesson_history_key(inputs), None)
+                delivered.add(job['id'])
+            
+            st.markdown(f"**{inputs.get('subject')} · {inputs.get('grade')} · Q{inputs.get('quarter')}** — "
+                        f"{QUEUE_STATUS_LABELS[job['status']]}")
+            st.caption(str(inputs.get('competency') or '')[:160])
+            if job['status'] == 'queued' and job['attempts']:
+                next_try = time.strftime('%H:%M', time.localtime(job['next_try']))
+                st.caption(f"Attempt {job['attempts']} of {QUEUE_MAX_ATTEMPTS} did not work "
+                           f"({job['error']}); trying again at {next_try}")
+            elif job['status'] == 'failed':
+                st.caption(f"Gave up after {job['attempts']} attempts: {job['error']}")
+            
+            columns = st.columns(len(job['documents']) + 1)
+            for column, file_name in zip(columns, job['documents']):
+                with column:
+                    st.download_button(
+                        label=f"📥 {file_name}",
+                        data=functools.partial(load_queued_document, profile_id, job['id'], file_name),
+                        file_name=file_name,
+                        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                        use_container_width=True,
+                        key=f"queue_download_{job['id']}_{file_name}"
+                    )
+            if job['status'] != 'running':
+                with columns[-1]:
+                    label = "🗑️ Cancel" if job['status'] == 'queued' else "🗑️ Remove"
+                    if st.button(label, key=f"queue_remove_{job['id']}", use_container_width=True):
+                        remove_queued_job(profile_id, job['id'])
+                        st.rerun()
+            st.markdown("---")
 
-    add_section_header(table_main, "IV. EVALUATING LEARNING")
-    add_assessment_row(table_main, "A. Assessment", eval_sec)
-    add_row(table_main, "B. Assignment", eval_sec.get('assignment', ''))
-    add_row(table_main, "C. Remarks", eval_sec.get('remarks', ''))
-    add_row(table_main, "D. Reflection", eval_sec.get('reflection', ''))
+def show_generation_history(inputs, teacher_name, principal_name, uploaded_image):
+    """Compare earlier runs of this lesson field by field and build a DLP from the chosen parts"""
+    runs = get_generation_history(inputs)
+    if len(runs) < 2:
+        return
+    
+    lesson_key = lesson_history_key(inputs)
+    ai_runs = [lesson_to_dict(run['plan']) for run in runs]
+    labels = [
+        f"Run {n} · {time.strftime('%b %d %H:%M', time.localtime(run['created']))}"
+        for n, run in enumerate(runs, 1)
+    ]
+    
+    with st.expander(f"🕘 Earlier versions of this lesson ({len(runs)})", expanded=False):
+        st.caption("Pick the version to keep for each changed field. No new AI request is made.")
+        col_a, col_b = st.columns(2)
+        with col_a:
+            run_a = st.selectbox("Compare", range(len(runs)), index=len(runs) - 2,
+                                 format_func=labels.__getitem__, key="history_run_a")
+        with col_b:
+            run_b = st.selectbox("With", range(len(runs)), index=len(runs) - 1,
+                                 format_func=labels.__getitem__, key="history_run_b")
+        
+        changes = diff_lesson_data(ai_runs[run_a], ai_runs[run_b])
+        if not changes:
+            st.info("Both versions have the same objectives, procedure and evaluation.")
+        
+        picks = {}
+        for section in HISTORY_DIFF_SECTIONS:
+            section_changes = [change for change in changes if change[0] == section]
+            if not section_changes:
+                continue
+            st.markdown(f"#### {section.title()} ({len(section_changes)} changed)")
+            for _, field, old_value, new_value in section_changes:
+                st.markdown(f"**{field}**: {word_diff_markdown(old_value, new_value)}")
+                picks[(section, field)] = st.radio(
+                    f"Keep {field}", [run_a, run_b], index=1, horizontal=True,
+                    format_func=labels.__getitem__, label_visibility="collapsed",
+                    key=f"history_pick_{run_a}_{run_b}_{section}_{field}"
+                )
+        
+        if st.button("🧩 Build DLP from selected versions", use_container_width=True):
+            merged = merge_lesson_runs(ai_runs, picks, base=run_b)
+            docx_buffer = create_docx(inputs, merged, teacher_name, principal_name, uploaded_image)
+            st.session_state.merged_docx = (lesson_key, docx_buffer.getvalue())
+        
+        merged_docx = st.session_state.get('merged_docx')
+        if merged_docx and merged_docx[0] == lesson_key:
+            st.download_button(
+                label="📥 Download merged DLP (.docx)",
+                data=merged_docx[1],
+                file_name=f"DLP_{inputs['subject']}_{inputs['grade']}_Q{inputs['quarter']}_{date.today()}_merged.docx",
+                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                use_container_width=True
+            )
 
-    doc.add_paragraph()
+def require_admin():
+    """
+    True once this session has entered DLP_ADMIN_PIN. Cross-teacher views stay
+    closed when no PIN is configured.
+    """
+    if st.session_state.get('admin_unlocked'):
+        return True
+    if not ADMIN_PIN:
+        st.info("🔒 This view is for school administrators. Set DLP_ADMIN_PIN on the server to enable it.")
+        return False
+    pin = st.text_input("Admin PIN", type="password", key="admin_pin")
+    if pin and secrets.compare_digest(pin, ADMIN_PIN):
+        st.session_state.admin_unlocked = True
+        st.rerun()
+    elif pin:
+        st.error("Wrong PIN")
+    return False
 
-    sig_table = doc.add_table(rows=1, cols=2)
-    sig_table.autofit = False
-    
-    sig_table.columns[0].width = Inches(4.0)
-    sig_table.columns[1].width = Inches(4.0)
+def show_usage_dashboard():
+    """Token use, cost by prompt stage and projected quota exhaustion from the usage ledger"""
+    st.subheader("📊 AI Usage")
+    col_scope, col_days = st.columns(2)
+    with col_scope:
+        scope = st.radio("Show", ["My usage", "All teachers"], horizontal=True, key="usage_scope")
+    with col_days:
+        days = st.slider("Days", 1, 30, 7, key="usage_days")
+    if scope == "All teachers" and not require_admin():
+        return
+    profile_id = get_profile_id() if scope == "My usage" else None
     
-    row = sig_table.rows[0]
+    totals = usage_summary(days, group_by=(), profile_id=profile_id)
+    if not totals:
+        st.info("No AI calls recorded yet.")
+        return
+    total = totals[0]
     
-    teacher_cell = row.cells[0]
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("AI calls", total['calls'])
+    col2.metric("Tokens", f"{total['prompt_tokens'] + total['completion_tokens']:,}")
+    col3.metric("Errors (quota)", f"{total['errors']} ({total['quota_errors']})")
+    col4.metric("Avg latency", f"{total['avg_latency_s']}s")
     
-    teacher_header_p = teacher_cell.add_paragraph()
-    teacher_header_run = teacher_header_p.add_run("Prepared by:")
-    teacher_header_run.bold = True
+    st.markdown("#### Cost by stage")
+    stages = usage_summary(days, group_by=('stage',), profile_id=profile_id)
+    st.dataframe(sorted(stages, key=lambda r: r['prompt_tokens'] + r['completion_tokens'], reverse=True),
+                 use_container_width=True)
     
-    teacher_cell.add_paragraph()
+    st.markdown("#### Daily use by teacher, key and model")
+    rows = usage_summary(days, profile_id=profile_id)
+    names = load_teacher_names([row['profile_id'] for row in rows])
+    for row in rows:
+        row['teacher'] = names[row.pop('profile_id')]
+    st.dataframe(rows, use_container_width=True)
     
-    teacher_name_p = teacher_cell.add_paragraph()
-    teacher_name_run = teacher_name_p.add_run(teacher_name)
-    teacher_name_run.bold = True
+    st.markdown("#### Daily quota (today)")
+    st.caption(f"Limits per key and model: {QUOTA_REQUESTS_PER_DAY} requests"
+               + (f", {QUOTA_TOKENS_PER_DAY:,} tokens" if QUOTA_TOKENS_PER_DAY else "") + " per day")
+    my_key = st.session_state.get('api_key')
+    for projection in project_quota():
+        if profile_id and (not my_key or projection['key_digest'] != _api_key_digest(my_key)):
+            continue
+        label = f"Key …{projection['key_digest'][-6:]} · {projection['model']}: {projection['calls']} calls, {projection['tokens']:,} tokens"
+        st.progress(min(1.0, projection['used_fraction']), text=label)
+        if projection['exhausted_at']:
+            when = time.strftime('%H:%M', time.localtime(projection['exhausted_at']))
+            st.warning(f"At today's rate this key runs out of {projection['limit']} around {when}.")
+
+def show_coverage_dashboard():
+    """Department heads' view: competency coverage, who is generating, latency and fallback rates"""
+    st.subheader("🗂️ Plan Coverage")
+    if not require_admin():
+        return
     
-    teacher_position_p = teacher_cell.add_paragraph()
-    teacher_position_p.add_run("Teacher III")
+    col_since, col_school = st.columns(2)
+    with col_since:
+        since = st.date_input("Since", value=school_year_start(), key="coverage_since")
+    schools = load_schools()
+    with col_school:
+        school = st.selectbox("School", ["All schools"] + list(schools), key="coverage_school",
+                              format_func=lambda sid: schools[sid]['name'] if sid in schools else sid)
     
-    principal_cell = row.cells[1]
+    started = time.perf_counter()
+    df = load_plan_analytics(time.mktime(since.timetuple()))
+    if school != "All schools":
+        df = df[df['school'] == school]
+    if df.empty:
+        st.info("No plans generated in this period yet.")
+        return
+    summary = plan_analytics_summary(df)
+    st.caption(f"{len(df):,} plans loaded and summarized in {(time.perf_counter() - started) * 1000:.0f} ms")
     
-    principal_header_p = principal_cell.add_paragraph()
-    principal_header_run = principal_header_p.add_run("Noted by:")
-    principal_header_run.bold = True
+    totals = summary['totals']
+    col1, col2, col3, col4, col5 = st.columns(5)
+    col1.metric("Plans", f"{totals['plans']:,}")
+    col2.metric("Teachers", totals['teachers'])
+    col3.metric("Competencies", totals['competencies'])
+    col4.metric("With placeholders", f"{totals['fallback_rate']:.1%}")
+    col5.metric("Median time", f"{totals['median_s']:.1f}s")
     
-    principal_cell.add_paragraph()
+    st.markdown("#### Coverage by subject, grade and quarter")
+    coverage = summary['coverage']
+    st.dataframe(coverage, use_container_width=True, hide_index=True)
+    if 'coverage' in coverage:
+        chart = coverage.dropna(subset=['coverage'])
+        if not chart.empty:
+            st.bar_chart(chart.assign(label=chart['grade'] + " Q" + chart['quarter'])
+                         .pivot_table(index='label', columns='subject', values='coverage'))
+        
+        in_guide = chart[['subject', 'grade', 'quarter']].drop_duplicates().itertuples(index=False)
+        options = [tuple(row) for row in in_guide]
+        if options:
+            picked = st.selectbox("Competencies without a plan", options,
+                                  format_func=lambda o: f"{o[0]} · {o[1]} · Q{o[2]}", key="coverage_gaps")
+            gaps = uncovered_competencies(df, *picked)
+            if gaps.empty:
+                st.success("Every competency in the guide has a plan.")
+            else:
+                st.dataframe(gaps, use_container_width=True, hide_index=True)
     
-    principal_name_p = principal_cell.add_paragraph()
-    principal_name_run = principal_name_p.add_run(principal_name)
-    principal_name_run.bold = True
+    st.markdown("#### Who is generating")
+    teachers = summary['teachers']
+    names = load_teacher_names(list(teachers['profile_id']))
+    teachers = teachers.assign(
+        teacher=teachers['profile_id'].map(names),
+        last_plan=pd.to_datetime(teachers['last_ts'], unit='s').dt.strftime('%Y-%m-%d'),
+    )
+    st.dataframe(teachers[['teacher', 'plans', 'competencies', 'fallback_rate', 'failed', 'last_plan']],
+                 use_container_width=True, hide_index=True)
     
-    principal_position_p = principal_cell.add_paragraph()
-    principal_position_p.add_run("Principal III")
-
-    buffer = io.BytesIO()
-    doc.save(buffer)
-    buffer.seek(0)
-    return buffer
+    st.markdown("#### Latency and failures")
+    daily = summary['daily']
+    st.line_chart(daily[['median_s', 'p90_s']])
+    st.line_chart(daily[['fallback_rate', 'failure_rate']])
+    st.dataframe(summary['by_kind'], use_container_width=True)
 
-# --- 9. MAIN STREAMLIT APP ---
 def main():
     if 'show_instructions' not in st.session_state:
         st.session_state.show_instructions = False
@@ -1052,11 +5846,26 @@ def main():
     if 'api_key' not in st.session_state:
         st.session_state.api_key = st.session_state.saved_api_key
     
+    init_profile_session()
+    set_usage_context(profile_id=get_profile_id())
+    start_queue_worker()
+    school_id = current_school_id()
+    
     if st.session_state.show_instructions:
         show_api_key_instructions_page()
         return
     
-    add_custom_header()
+    schools = load_schools()
+    if len(schools) > 1:
+        school_ids = list(schools)
+        school_id = st.sidebar.selectbox(
+            "🏫 School", school_ids, index=school_ids.index(school_id),
+            format_func=lambda sid: schools[sid]['name']
+        )
+        st.session_state.school_id = school_id
+    school = get_school_config(school_id)
+    
+    add_custom_header(school)
     
     st.markdown('<p class="app-title">Daily Lesson Plan (DLP) Generator</p>', unsafe_allow_html=True)
     
@@ -1085,8 +5894,8 @@ def main():
     with st.sidebar:
         st.header("📋 User Information")
         
-        teacher_name = st.text_input("Teacher Name", value="RICHARD P. SAMORANOS")
-        principal_name = st.text_input("Principal Name", value="ROSALITA A. ESTROPIA")
+        teacher_name = st.text_input("Teacher Name", value=profile_default('teacher_name', school['teacher_name']))
+        principal_name = st.text_input("Principal Name", value=profile_default('principal_name', school['principal_name']))
         
         st.markdown("---")
         st.info("Upload an image (optional) for the lesson")
@@ -1102,27 +5911,52 @@ def main():
             st.markdown("---")
             st.success("🔑 API Key Status: SAVED")
             st.caption("Your key is saved for future use")
+        
+        st.markdown("---")
+        st.checkbox(
+            "⚡ Hedge slow requests",
+            key="hedge_requests",
+            help="If the AI is slow, ask a second Gemini model too and use whichever answers first"
+        )
+        if st.session_state.get('hedge_requests'):
+            stats = get_hedge_stats()
+            st.caption(
+                f"Hedged {stats['hedged']}/{stats['requests']} ({stats['hedge_rate']:.0%}) · "
+                f"backup wins {stats['secondary_wins']} · extra tokens {stats['extra_tokens']} · "
+                f"threshold {stats['threshold_seconds']:.1f}s"
+            )
+        
+        st.markdown("---")
+        mode = st.radio("Mode", ["Single DLP", "Weekly DLL", "Quarter Planner", "Usage", "Coverage"], horizontal=True)
+    
+    if mode == "Usage":
+        show_usage_dashboard()
+        return
+    if mode == "Coverage":
+        show_coverage_dashboard()
+        return
+    if mode == "Quarter Planner":
+        show_quarter_planner(teacher_name, principal_name)
+        return
+    if mode == "Weekly DLL":
+        show_weekly_log(teacher_name, principal_name)
+        return
     
     col1, col2, col3 = st.columns(3)
     with col1:
-        subject = st.text_input("Subject Area", placeholder="e.g., Mathematics")
+        subject = st.text_input("Subject Area", value=profile_default('subject'), placeholder="e.g., Mathematics")
     
     with col2:
-        grade_options = [
-            "Kinder",
-            "Grade 1", "Grade 2", "Grade 3", "Grade 4", "Grade 5", "Grade 6",
-            "Grade 7", "Grade 8", "Grade 9", "Grade 10",
-            "Grade 11", "Grade 12"
-        ]
-        grade = st.selectbox("Grade Level", grade_options, index=6)
+        grade = st.selectbox("Grade Level", GRADE_OPTIONS, index=option_index(GRADE_OPTIONS, profile_default('grade'), 6))
     
     with col3:
-        quarter_options = ["I", "II", "III", "IV"]
-        quarter = st.selectbox("Quarter", quarter_options, index=2)
+        quarter = st.selectbox("Quarter", QUARTER_OPTIONS, index=option_index(QUARTER_OPTIONS, profile_default('quarter'), 2))
+    
+    show_competency_search(subject, grade, quarter)
     
-    content_std = st.text_area("Content Standard", placeholder="The learner demonstrates understanding of...")
-    perf_std = st.text_area("Performance Standard", placeholder="The learner is able to...")
-    competency = st.text_area("Learning Competency", placeholder="Competency code and description...")
+    content_std = st.text_area("Content Standard", placeholder="The learner demonstrates understanding of...", key="content_std")
+    perf_std = st.text_area("Performance Standard", placeholder="The learner is able to...", key="perf_std")
+    competency = st.text_area("Learning Competency", placeholder="Competency code and description...", key="competency")
     
     st.markdown("---")
     
@@ -1165,9 +5999,48 @@ def main():
     
     st.markdown("---")
     
+    inputs = {
+        'subject': subject,
+        'grade': grade,
+        'quarter': quarter,
+        'content_std': content_std,
+        'perf_std': perf_std,
+        'competency': competency,
+        'school': school_id
+    }
+    
+    dual_language = st.checkbox(
+        "🌐 Make both English and Filipino versions",
+        key="dual_language",
+        help="For subjects like Araling Panlipunan and ESP: the plan is written in your language "
+             "and translated into the other one while it is being generated"
+    )
+    different_version = st.checkbox(
+        "🎲 Give me a different version",
+        key="different_version",
+        help="If a teammate is generating the same lesson right now, the result is normally shared. "
+             "Tick this to get a separate version of your own."
+    )
+    
     has_api_key = bool(api_key or st.session_state.saved_api_key or st.session_state.get('api_key'))
+    queued_inputs = dict(inputs, obj_cognitive=obj_cognitive, obj_psychomotor=obj_psychomotor,
+                         obj_affective=obj_affective, lesson_topic=lesson_topic)
+    
+    col_generate, col_queue = st.columns([3, 2])
+    with col_generate:
+        generate_clicked = st.button("🚀 Generate DLP", type="primary", use_container_width=True, disabled=not has_api_key)
+    with col_queue:
+        queue_clicked = st.button("📥 Queue for later", use_container_width=True, disabled=not has_api_key,
+                                  help="On a weak connection: the lesson is generated in the background "
+                                       "and waits for you under 📥 Queued lessons")
+    
+    if queue_clicked:
+        if all([subject, grade, quarter, content_std, perf_std, competency]):
+            queue_lesson_from_form(queued_inputs, teacher_name, principal_name, dual_language, different_version)
+        else:
+            st.error("Please fill all required fields")
     
-    if st.button("🚀 Generate DLP", type="primary", use_container_width=True, disabled=not has_api_key):
+    if generate_clicked:
         if not has_api_key:
             st.error("❌ Please enter and save your Google Gemini API Key in the sidebar first!")
             return
@@ -1176,6 +6049,12 @@ def main():
             st.error("Please fill all required fields")
             return
         
+        # The result is kept as a job: if this page stops, it waits under 📥 Queued lessons
+        job = start_interactive_job(
+            get_profile_id(), queued_inputs, st.session_state.get('api_key') or st.session_state.get('saved_api_key'),
+            teacher_name, principal_name, dual_language=dual_language
+        )
+        
         user_provided_topic = lesson_topic and lesson_topic.strip()
         user_provided_objectives = obj_cognitive and obj_psychomotor and obj_affective
         
@@ -1191,88 +6070,166 @@ def main():
         else:
             st.info("🔧 AI will generate all lesson content for you")
         
-        with st.spinner("🤖 Generating lesson content..."):
-            ai_data = generate_lesson_content(
-                subject, grade, quarter, 
-                content_std, perf_std, competency,
-                obj_cognitive if obj_cognitive else None,
-                obj_psychomotor if obj_psychomotor else None,
-                obj_affective if obj_affective else None,
-                lesson_topic if user_provided_topic else None
-            )
+        # Input-only parts of the DOCX are built now; AI sections fill in as they stream
+        docx_state = start_lesson_docx(inputs, teacher_name, principal_name, uploaded_image)
+        streamed = {}
+        stream_status = st.empty()
+        
+        def on_section(key, value):
+            streamed[key] = value
+            fill_lesson_docx(docx_state, streamed)
+            stream_status.caption(f"📄 Received {len(streamed)} sections: {', '.join(streamed)}")
+        
+        try:
+            with st.spinner("🤖 Generating lesson content..."):
+                ai_data, records = call_with_replay_records(
+                    generate_lesson_content,
+                    subject, grade, quarter, 
+                    content_std, perf_std, competency,
+                    obj_cognitive if obj_cognitive else None,
+                    obj_psychomotor if obj_psychomotor else None,
+                    obj_affective if obj_affective else None,
+                    lesson_topic if user_provided_topic else None,
+                    on_section=on_section,
+                    dual_language=dual_language,
+                    coalesce=not different_version
+                )
+        except BaseException:
+            if job:
+                release_queued_job(*job)
+            raise
+        stream_status.empty()
+        
+        plans = None
+        if dual_language and ai_data:
+            plans = ai_data
+            ai_data = next(iter(plans.values()))
             
         if ai_data:
             st.success("✅ AI content generated successfully!")
+            plan = lesson_from_json(ai_data)
+            add_generation_history(inputs, plan)
+            
+            # Handouts come from the same content and build while the DLP is finished
+            handouts = start_lesson_handouts(inputs, ai_data)
+            with st.spinner("📄 Creating DOCX file..."):
+                # Only sections changed by validation/repair are rewritten here
+                fill_lesson_docx(docx_state, ai_data, final=True)
+                docx_buffer = finish_lesson_docx(docx_state)
+            documents = {lesson_file_name(inputs): docx_buffer.getvalue()}
+            if plans:
+                primary_language, translated_language = list(plans)
+                with st.spinner(f"📄 Creating the {LANGUAGE_LABELS[translated_language]} DOCX file..."):
+                    # Same layout and picture as the first document; only the text differs
+                    translated_docx = render_lesson_plan(
+                        inputs, plans[translated_language], teacher_name, principal_name,
+                        lesson_docx_image(docx_state)
+                    )
+                documents = {lesson_file_name(inputs, primary_language): docx_buffer.getvalue(),
+                             lesson_file_name(inputs, translated_language): translated_docx}
+            if job and retry_placeholders(job[0], used_placeholders(ai_data, records)):
+                # Same rule as the worker: placeholder sections are tried again in the background
+                _retry_queued_job(*job, "some sections are placeholder text")
+                st.caption("A complete version is generated in the background, under 📥 Queued lessons.")
+            elif job:
+                _deliver_queued_job(*job, documents)
+                st.session_state.setdefault('queue_delivered', set()).add(job[0]['id'])
+            save_profile_defaults(
+                teacher_name=teacher_name, principal_name=principal_name,
+                subject=subject, grade=grade, quarter=quarter, school=school_id
+            )
             
             st.subheader("📚 Generated Lesson Content")
             col_topic, col_integration = st.columns(2)
             
             with col_topic:
                 st.info("**Main Topic**")
-                st.write(ai_data.get('topic', 'N/A'))
+                st.write(plan.content.topic or 'N/A')
             
             with col_integration:
                 st.info("**Integration**")
-                st.write(f"Within Subject: {ai_data.get('integration_within', 'N/A')}")
-                st.write(f"Across Subjects: {ai_data.get('integration_across', 'N/A')}")
+                st.write(f"Within Subject: {plan.content.integration_within or 'N/A'}")
+                st.write(f"Across Subjects: {plan.content.integration_across or 'N/A'}")
             
             st.subheader("📋 Generated Objectives")
             col_obj_pre1, col_obj_pre2, col_obj_pre3 = st.columns(3)
             
             with col_obj_pre1:
                 st.info("**Cognitive**")
-                st.write(ai_data.get('obj_1', 'N/A'))
+                st.write(plan.objectives.obj_1 or 'N/A')
             
             with col_obj_pre2:
                 st.info("**Psychomotor**")
-                st.write(ai_data.get('obj_2', 'N/A'))
+                st.write(plan.objectives.obj_2 or 'N/A')
             
             with col_obj_pre3:
                 st.info("**Affective**")
-                st.write(ai_data.get('obj_3', 'N/A'))
+                st.write(plan.objectives.obj_3 or 'N/A')
             
             with st.expander("📝 Preview Assessment Questions"):
-                for i in range(1, 6):
-                    question_key = f'assess_q{i}'
-                    raw_question = ai_data.get('evaluation', {}).get(question_key, '')
-                    if raw_question:
-                        question_text, choices = parse_multiple_choice_question(raw_question)
-                        st.markdown(f"**Question {i}:** {question_text}")
-                        if choices:
-                            for choice in choices:
-                                st.write(f"  {choice}")
+                for i, item in enumerate(assessment_items(plan), 1):
+                    if item.question or item.choices:
+                        st.markdown(f"**Question {i}:** {item.question}")
+                        for choice in item.choices:
+                            st.write(f"  {choice}")
+                        answer = parse_answer_letter(getattr(plan.evaluation, f'assess_q{i}'))
+                        if answer:
+                            st.caption(f"✓ Answer: {answer}")
                         st.markdown("---")
             
             with st.expander("📄 Preview All Generated Content"):
                 st.json(ai_data)
             
-            inputs = {
-                'subject': subject,
-                'grade': grade,
-                'quarter': quarter,
-                'content_std': content_std,
-                'perf_std': perf_std,
-                'competency': competency
-            }
-            
-            with st.spinner("📄 Creating DOCX file..."):
-                docx_buffer = create_docx(inputs, ai_data, teacher_name, principal_name, uploaded_image)
+            if plans:
+                col_primary, col_translated = st.columns(2)
+                for column, language, data in ((col_primary, primary_language, docx_buffer),
+                                               (col_translated, translated_language, translated_docx)):
+                    with column:
+                        st.download_button(
+                            label=f"📥 Download DLP – {LANGUAGE_LABELS[language]} (.docx)",
+                            data=data,
+                            file_name=lesson_file_name(inputs, language),
+                            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                            use_container_width=True,
+                            key=f"download_dlp_{language}"
+                        )
+            else:
+                st.download_button(
+                    label="📥 Download DLP (.docx)",
+                    data=docx_buffer,
+                    file_name=lesson_file_name(inputs),
+                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                    use_container_width=True
+                )
             
-            st.download_button(
-                label="📥 Download DLP (.docx)",
-                data=docx_buffer,
-                file_name=f"DLP_{subject}_{grade}_Q{quarter}_{date.today()}.docx",
-                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                use_container_width=True
-            )
+            st.markdown("**🧾 Student handouts**")
+            handout_columns = st.columns(len(handouts))
+            for column, (kind, future) in zip(handout_columns, handouts.items()):
+                with column:
+                    st.download_button(
+                        label=f"📥 {HANDOUT_LABELS[kind]}",
+                        data=future.result(),
+                        file_name=handout_file_name(inputs, kind),
+                        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                        use_container_width=True,
+                        key=f"download_handout_{kind}"
+                    )
             
             st.balloons()
             st.success(f"✅ DLP generated for {subject} - {grade} - Quarter {quarter}")
+            show_replay_reference()
             
             if st.session_state.saved_api_key:
                 st.info("💡 Your API key is saved. You can use the app again without re-entering it!")
         else:
             st.error("Failed to generate AI content. Please try again.")
+            if job:
+                _retry_queued_job(*job, "the lesson could not be generated")
+                st.caption("It is also tried again in the background, under 📥 Queued lessons.")
+    
+    show_lesson_queue()
+    if all([subject, content_std, perf_std, competency]):
+        show_generation_history(inputs, teacher_name, principal_name, uploaded_image)
 
 if __name__ == "__main__":
     main()